@@ -0,0 +1,259 @@
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from source.benchmarks.fake_openai_server import FakeOpenAIServer
+from source.benchmarks.synthetic import synthetic_dataset, ensure_config
+
+DATASETS = {
+    # dataset -> (precreate module, run_experiment module)
+    "quality": ("source.experiments.quality.precreate_pages", "source.experiments.quality.run_experiment"),
+    "infinity_bench": ("source.experiments.infinity_bench.longbook_choice_eng.precreate_pages", "source.experiments.infinity_bench.longbook_choice_eng.run_experiment"),
+}
+DEFAULT_WORDS = {"quality": 5_000, "infinity_bench": 100_000} # words per synthetic document, about the averages of the datasets
+PERCENTILES = (50, 95, 99)
+
+class StageTimes:
+    """Wall-clock seconds of every call per stage, recorded from all threads of a run."""
+
+    def __init__(self):
+        self._times = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._times.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        """{stage: {"count", "mean", "p50", "p95", "p99"}} in seconds."""
+        summary = {}
+        with self._lock:
+            for stage, times in self._times.items():
+                values = np.array(times)
+                summary[stage] = {"count": len(times), "mean": float(values.mean())}
+                for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                    summary[stage][f"p{q}"] = float(value)
+        return summary
+
+    def timed_function(self, function, stage):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def timed_class(self, cls, method, stage):
+        """Subclass of cls whose method is timed, retries and backoff sleeps of the model call included."""
+        times = self
+
+        def timed(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return getattr(super(subclass, self), method)(*args, **kwargs)
+            finally:
+                times.add(stage, time.perf_counter() - start)
+
+        subclass = type(cls.__name__, (cls,), {method: timed})
+        return subclass
+
+
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def count_answers(identifier):
+    """Answers stored by the experiment run identifier in the current folder, its _ERRORS file is not counted."""
+    answers = 0
+    for path in glob.glob(f"experiments/artifacts/answers/**/*-{identifier}.jsonl", recursive=True):
+        with open(path, "r", encoding="utf-8") as f:
+            answers += sum(1 for line in f if line.strip())
+    return answers
+
+def run_level(dataset, workers, data_path, workdir, base_url, gisting_workers, expected_documents, expected_questions):
+    """
+    Runs the precreate and the experiment script of a dataset with workers threads in this (fresh) process.
+    The scripts are configured through their module constants, the way a user edits them.
+    They log failed documents and questions instead of raising, so the level is marked as failed (with the
+    reason in "failed") if fewer documents were precreated or fewer questions answered than expected.
+    """
+    import importlib
+
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    # the scripts log every call to the terminal, keep that in the level's folder
+    sys.stderr = open("stderr.log", "w")
+    ensure_config()
+
+    precreate_name, run_name = DATASETS[dataset]
+    times = StageTimes()
+
+    precreate = importlib.import_module(precreate_name)
+    precreate.OPENAI_BASE_URL = base_url
+    precreate.RESPONSE_CACHE_PATH = None
+    precreate.SENTENCE_CACHE_PATH = None
+    precreate.PREPROCESSED_DATA_PATH = data_path
+    precreate.MAX_WORKERS = workers
+    precreate.GISTING_MAX_WORKERS = gisting_workers
+    precreate.OpenAI_RAModel_Pagination = times.timed_class(precreate.OpenAI_RAModel_Pagination, "paginate", "pagination")
+    precreate.OpenAI_RAModel_Gisting = times.timed_class(precreate.OpenAI_RAModel_Gisting, "shorten_page", "gisting")
+    precreate.precreate_pages_for_doc = times.timed_function(precreate.precreate_pages_for_doc, "document")
+
+    start = time.perf_counter()
+    precreate.precreate_pages_for_all_docs()
+    precreate_seconds = time.perf_counter() - start
+    precreate_rss = peak_rss_mb()
+    documents = len([f for f in os.listdir(precreate.STORED_SHORTENED_PAGES_FOLDER_PATH) if f.endswith(".json")])
+
+    run = importlib.import_module(run_name)
+    run.OPENAI_BASE_URL = base_url
+    run.RESPONSE_CACHE_PATH = None
+    run.PREPROCESSED_DATA_PATH = data_path
+    run.STORED_PAGES_FOLDER_PATH = precreate.STORED_PAGES_FOLDER_PATH
+    run.STORED_SHORTENED_PAGES_FOLDER_PATH = precreate.STORED_SHORTENED_PAGES_FOLDER_PATH
+    run.PAGE_STORE_PATH = None
+    run.USE_ASYNC = False
+    run.MAX_WORKERS = workers
+    run.LOOKUP_BACKEND = "openai"
+    run.OpenAI_RAModel_Lookup = times.timed_class(run.OpenAI_RAModel_Lookup, "lookup", "lookup")
+    run.OpenAI_QAModel_MultipleChoice = times.timed_class(run.OpenAI_QAModel_MultipleChoice, "answer_question", "qa")
+    run.load_read_agent = times.timed_function(run.load_read_agent, "load_document")
+    run.run_experiment_for_question = times.timed_function(run.run_experiment_for_question, "question")
+
+    start = time.perf_counter()
+    run.run_experiment_for_all_docs(f"sweep-{workers}", {"max_lookup_pages": 6})
+    run_seconds = time.perf_counter() - start
+
+    stages = times.summary()
+    questions = count_answers(f"sweep-{workers}")
+
+    failures = []
+    if documents != expected_documents:
+        failures.append(f"{documents} of {expected_documents} documents precreated")
+    if questions != expected_questions:
+        failures.append(f"{questions} of {expected_questions} questions answered")
+    return {
+        "dataset": dataset,
+        "workers": workers,
+        "documents": documents,
+        "precreate_seconds": precreate_seconds,
+        "documents_per_second": documents / precreate_seconds if precreate_seconds else 0.0,
+        "questions": questions,
+        "run_seconds": run_seconds,
+        "questions_per_second": questions / run_seconds if run_seconds else 0.0,
+        "precreate_peak_rss_mb": precreate_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stages,
+        "failed": ", ".join(failures) or None,
+        "stderr_log": os.path.join(workdir, "stderr.log"),
+    }
+
+
+def sweep(datasets, worker_levels, documents, questions, words=None, gisting_workers=8, latency=0.1, jitter=0.05,
+          input_tokens_per_second=None, output_tokens_per_second=400, rate_429=0.0, rate_5xx=0.0, workdir=None):
+    """
+    Runs the full precreate + experiment pipeline of every dataset once per worker count against a local fake server.
+    Every level runs in its own spawned process, so the peak RSS is that of the level alone.
+    :return: List[dict] - One result of run_level per dataset and worker count, failed levels included.
+    """
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix="concurrency_sweep_"))
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+
+    with FakeOpenAIServer(port=0, latency=latency, jitter=jitter, input_tokens_per_second=input_tokens_per_second,
+                          output_tokens_per_second=output_tokens_per_second, rate_429=rate_429, rate_5xx=rate_5xx) as server:
+        for dataset in datasets:
+            data_path = os.path.join(workdir, f"{dataset}_synthetic.json")
+            with open(data_path, "w", encoding="utf-8") as f:
+                json.dump(synthetic_dataset(dataset, documents, questions, (words or DEFAULT_WORDS)[dataset]), f)
+
+            for workers in worker_levels:
+                level_dir = os.path.join(workdir, f"{dataset}_{workers}")
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    result = executor.submit(run_level, dataset, workers, data_path, level_dir, server.url, gisting_workers,
+                                             documents, documents * questions).result()
+                results.append(result)
+                if result["failed"]:
+                    logging.error(f"[{dataset} workers={workers}] level failed ({result['failed']}), see {result['stderr_log']}")
+                else:
+                    logging.info(format_result(result))
+
+        logging.info(f"Fake server: {server.stats()}")
+
+    return results
+
+def format_result(result):
+    stages = " ".join(
+        f"{stage} p50/p95/p99 {s['p50']:.2f}/{s['p95']:.2f}/{s['p99']:.2f}s"
+        for stage, s in result["stages"].items()
+    )
+    return (f"[{result['dataset']} workers={result['workers']}] {result['documents']} docs in {result['precreate_seconds']:.1f}s, "
+            f"{result['questions']} questions in {result['run_seconds']:.1f}s ({result['questions_per_second']:.2f} q/s), "
+            f"peak RSS {result['peak_rss_mb']:.0f} MB | {stages}")
+
+def print_table(results):
+    print(f"{'dataset':<16}{'workers':>8}{'docs/s':>9}{'q/s':>9}{'RSS MB':>9}  stage p50 / p95 / p99 (s)")
+    for result in results:
+        stages = ", ".join(f"{stage} {s['p50']:.2f}/{s['p95']:.2f}/{s['p99']:.2f}" for stage, s in result["stages"].items())
+        if result["failed"]:
+            print(f"{result['dataset']:<16}{result['workers']:>8}  FAILED: {result['failed']}, see {result['stderr_log']}")
+            continue
+        print(f"{result['dataset']:<16}{result['workers']:>8}{result['documents_per_second']:>9.2f}{result['questions_per_second']:>9.2f}"
+              f"{result['peak_rss_mb']:>9.0f}  {stages}")
+    for dataset in dict.fromkeys(result["dataset"] for result in results):
+        completed = [r for r in results if r["dataset"] == dataset and not r["failed"]]
+        if not completed:
+            print(f"{dataset}: no level completed, no throughput to compare")
+            continue
+        best = max(completed, key=lambda r: r["questions_per_second"])
+        print(f"{dataset}: highest question throughput with {best['workers']} workers ({best['questions_per_second']:.2f} q/s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrency sweep of the precreate and experiment scripts against a local fake OpenAI server.")
+    parser.add_argument("--datasets", nargs="+", choices=sorted(DATASETS), default=["quality", "infinity_bench"])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4, 8, 16, 32], help="MAX_WORKERS levels of the scripts")
+    parser.add_argument("--gisting-workers", type=int, default=8, help="GISTING_MAX_WORKERS of the precreate scripts")
+    parser.add_argument("--documents", type=int, default=8)
+    parser.add_argument("--questions", type=int, default=5, help="questions per document")
+    parser.add_argument("--words", type=int, default=None, help="words per document, defaults to the dataset average")
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--input-tps", type=float, default=None)
+    parser.add_argument("--output-tps", type=float, default=400)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--workdir", default=None, help="folder for datasets, artifacts and logs of the levels, a temporary folder by default")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    words = {dataset: args.words for dataset in DATASETS} if args.words else None
+    results = sweep(args.datasets, args.workers, args.documents, args.questions, words, args.gisting_workers,
+                    args.latency, args.jitter, args.input_tps, args.output_tps, args.rate_429, args.rate_5xx, args.workdir)
+
+    print_table(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+    if any(result["failed"] for result in results):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_PORT = 8000 # python -m source.benchmarks.fake_openai_server listens on 127.0.0.1:8000 by default
+CHARS_PER_TOKEN = 4 # the server does not tokenize, prompt and completion tokens are estimated from the length
+
+
+def count_fake_tokens(text):
+    """Token estimate of the fake server, about CHARS_PER_TOKEN characters per token."""
+    return max(1, (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN)
+
+def fake_completion(prompt, max_tokens=None):
+    """
+    Deterministic, prompt-shaped answer to one of the prompts of the RA and QA models: a label of the passage for
+    pagination, the first words of the passage for gisting, a page list for lookup and [[k]] for multiple choice QA.
+    The same prompt always gets the same answer, which is chosen by the SHA-256 of the prompt.
+    :return: (str, str) - The kind of prompt and the answer.
+    """
+    rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+
+    if "There are some numbered labels between the paragraphs" in prompt:
+        labels = re.findall(r"^<(\d+)>$", prompt, re.M)
+        if not labels:
+            return "pagination", "There is no label in the passage."
+        # like the LLM, prefer a transition in the second half of the passage
+        label = labels[len(labels) // 2 + rng.randrange(len(labels) - len(labels) // 2)]
+        # in the form utils.parse_pause_point accepts, so the pause point is taken and not the fallback after retries
+        return "pagination", f"Break point: <{label}>\n Because the topic changes after this paragraph."
+
+    if "Please shorten the following passage." in prompt:
+        words = prompt.split("Passage:", 1)[-1].split()
+        limit = max(1, len(words) // 4)
+        if max_tokens:
+            limit = min(limit, max_tokens)
+        return "gisting", " ".join(words[:limit])
+
+    if "Which 1 to" in prompt and "look up Page" in prompt:
+        page_ids = [int(page_id) for page_id in re.findall(r"^<Page (\d+)>$", prompt, re.M)]
+        max_lookup_pages = re.search(r"Which 1 to (\d+) page", prompt)
+        max_lookup_pages = int(max_lookup_pages.group(1)) if max_lookup_pages else 1
+        if not page_ids:
+            return "lookup", "I do not need to look up any page."
+        chosen = sorted(rng.sample(page_ids, min(len(page_ids), 1 + rng.randrange(max_lookup_pages))))
+        return "lookup", f"I want to look up Page {chosen} to answer the question."
+
+    if "provide your answer as [[1]]" in prompt:
+        options = len(re.findall(r"^\[\[\d+\]\]:", prompt, re.M)) or 4
+        return "qa", f"The context points to this option. [[{1 + rng.randrange(options)}]]"
+
+    if "[Start of Question]:" in prompt:
+        context = prompt.split("[Start of Context]:", 1)[-1].split("[End of Context]", 1)[0].split()
+        if not context:
+            return "qa", "Not found in context."
+        start = rng.randrange(len(context))
+        return "qa", " ".join(context[start:start + 1 + rng.randrange(8)])
+
+    return "other", "OK"
+
+
+class FakeOpenAIServer:
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, latency=0.0, jitter=0.0, input_tokens_per_second=None,
+                 output_tokens_per_second=None, rate_429=0.0, rate_5xx=0.0, retry_after=1.0, seed=42):
+        """
+        Local OpenAI-compatible chat completions server for load tests and benchmarks without API costs.
+        Answers POST /v1/chat/completions with fake_completion and a usage block, so every RA and QA model,
+        the runners and the precreate scripts work against it unchanged (point OPENAI_BASE_URL at url).
+        Each request is handled in its own thread and sleeps for the simulated model time before answering.
+
+        Args:
+            port (int): Port to listen on, 0 picks a free port.
+            latency (float): Seconds every request takes at least.
+            jitter (float): Up to this many seconds are added at random.
+            input_tokens_per_second (float): Prompt processing speed, None for no prompt dependent latency.
+            output_tokens_per_second (float): Generation speed, None for no completion dependent latency.
+            rate_429 (float): Share of requests answered with 429 and a Retry-After header.
+            rate_5xx (float): Share of requests answered with a 500 or 503 server error.
+            retry_after (float): Seconds sent in the Retry-After header of a 429.
+            seed (int): Seed of the latency jitter and the injected errors.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.input_tokens_per_second = input_tokens_per_second
+        self.output_tokens_per_second = output_tokens_per_second
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._in_flight = 0
+        self._max_in_flight = 0
+        self._thread = None
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+
+    @property
+    def url(self):
+        """Base URL for the OpenAI clients, e.g. http://127.0.0.1:8000/v1."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """Serves in a background thread, returns the server."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="FakeOpenAIServer", daemon=True)
+        self._thread.start()
+        logging.info(f"Fake OpenAI server listening on {self.url}")
+        return self
+
+    def serve_forever(self):
+        logging.info(f"Fake OpenAI server listening on {self.url}")
+        self._server.serve_forever()
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        """Requests by kind and status, and the highest number of requests handled at the same time."""
+        with self._lock:
+            return {"requests": dict(self._counts), "in_flight": self._in_flight, "max_in_flight": self._max_in_flight}
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def _draw(self):
+        """(injected error status or None, jitter seconds) of the next request."""
+        with self._lock:
+            error = self._rng.random()
+            jitter = self._rng.random() * self.jitter
+        if error < self.rate_429:
+            return 429, jitter
+        if error < self.rate_429 + self.rate_5xx:
+            return (500 if error < self.rate_429 + self.rate_5xx / 2 else 503), jitter
+        return None, jitter
+
+    def handle_chat_completion(self, request):
+        """:return: (int, dict, dict) - HTTP status, extra headers and the JSON body."""
+        with self._lock:
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+        try:
+            status, jitter = self._draw()
+            if status is not None:
+                time.sleep(self.latency + jitter)
+                self._count(str(status))
+                if status == 429:
+                    return 429, {"retry-after": str(self.retry_after)}, _error_body("Rate limit reached (fake server).", "rate_limit_exceeded")
+                return status, {}, _error_body("The server had an error while processing your request (fake server).", "server_error")
+
+            prompt = "\n".join(str(message.get("content", "")) for message in request.get("messages", []))
+            kind, content = fake_completion(request.get("messages", [{}])[-1].get("content", ""), request.get("max_tokens"))
+            prompt_tokens = count_fake_tokens(prompt)
+            completion_tokens = count_fake_tokens(content)
+
+            seconds = self.latency + jitter
+            if self.input_tokens_per_second:
+                seconds += prompt_tokens / self.input_tokens_per_second
+            if self.output_tokens_per_second:
+                seconds += completion_tokens / self.output_tokens_per_second
+            time.sleep(seconds)
+            self._count(kind)
+
+            return 200, {}, {
+                "id": "chatcmpl-fake-" + hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:24],
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "fake"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "prompt_tokens_details": {"cached_tokens": 0},
+                },
+            }
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+
+def _error_body(message, code):
+    return {"error": {"message": message, "type": code, "param": None, "code": code}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the API, so clients reuse their connections
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send(400, {}, _error_body("Invalid JSON body.", "invalid_request_error"))
+            return
+
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            self._send(*self.server.fake.handle_chat_completion(request))
+        else:
+            self._send(404, {}, _error_body(f"Unknown path {self.path}.", "not_found"))
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send(200, {}, self.server.fake.stats())
+        elif self.path.rstrip("/").endswith("/models"):
+            self._send(200, {}, {"object": "list", "data": [{"id": "fake", "object": "model", "owned_by": "fake"}]})
+        else:
+            self._send(404, {}, _error_body(f"Unknown path {self.path}.", "not_found"))
+
+    def _send(self, status, headers, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug(f"[Fake OpenAI server] {self.address_string()} {format % args}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deterministic local stand-in for the OpenAI chat completions API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every request takes at least")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many seconds are added at random")
+    parser.add_argument("--input-tps", type=float, default=None, help="prompt tokens processed per second")
+    parser.add_argument("--output-tps", type=float, default=None, help="completion tokens generated per second")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="share of requests answered with 500/503")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds of a 429")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    server = FakeOpenAIServer(args.host, args.port, args.latency, args.jitter, args.input_tps, args.output_tps,
+                              args.rate_429, args.rate_5xx, args.retry_after, args.seed)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info(f"Fake OpenAI server stopped: {server.stats()}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
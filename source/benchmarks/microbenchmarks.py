@@ -0,0 +1,350 @@
+import io
+import gc
+import os
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import contextlib
+
+import nltk
+
+from source.benchmarks.synthetic import synthetic_text, ensure_config
+
+ensure_config()
+
+from source.method.ReadAgent import ReadAgent # reads the API key from config.py on import
+from source.method.GistMemory import GistMemory
+from source.method.utils import safe_sentence_split, count_tokens, save_pages_to_json, load_pages_from_json
+from source.experiments.utils import extract_number
+from source.experiments.quality.eval import evaluate_accuracy
+
+DEFAULT_SIZES = [10_000, 200_000, 2_000_000] # words per synthetic document
+DEFAULT_TOLERANCE = 0.25 # a benchmark regressed if it is this much slower than its baseline, stored with a saved baseline
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "microbenchmarks.json") # committed baseline checked by source.benchmarks.self_check
+CALIBRATION_LOOPS = 2_000_000 # iterations of the pure Python loop whose time scales a baseline measured on another machine
+MIN_REGRESSION_SECONDS = 0.002 # and at least this much slower, differences below are timer noise
+QUESTIONS_PER_RUN = 20 # questions answered per answer_question measurement
+LOOKUP_PAGES = 6 # pages expanded per question, the default max_lookup_pages
+WORDS_PER_ANSWER = 20 # the answer file of a document has one entry per this many words
+
+logger = logging.getLogger(__name__) # the benchmarks log at INFO while the ReadAgent logs are silenced
+
+
+class _PresplitSentences:
+    """Sentence splitter stub returning the precomputed sentences, so create_pages is timed without the NLTK split."""
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+
+    def split(self, text, max_words):
+        return list(self.sentences)
+
+class _StubPagination:
+    """Instant paginator answering the middle label of the passage, no model call."""
+
+    def paginate(self, preceding, passage, end_tag):
+        labels = re.findall(r"^<(\d+)>$", passage, re.M)
+        return f"<{labels[len(labels) // 2]}>" if labels else ""
+
+class _StubLookup:
+    """Instant lookup model choosing LOOKUP_PAGES pages spread over the document."""
+
+    def __init__(self, pages):
+        step = max(1, pages // LOOKUP_PAGES)
+        self.response = f"I want to look up Page {list(range(0, pages, step))[:LOOKUP_PAGES]} to answer the question."
+
+    def lookup(self, article, question, max_lookup_pages, article_tokens=None):
+        return self.response, {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+
+class _StubQA:
+    def answer_question(self, context, question, options, context_tokens=None):
+        return "[[1]]", {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+
+
+def _punkt_missing():
+    try:
+        nltk.data.find("tokenizers/punkt_tab/english/")
+    except LookupError:
+        return "the NLTK punkt_tab data is not installed, run nltk.download('punkt_tab')"
+    return None
+
+def _tiktoken_missing():
+    try:
+        count_tokens("probe")
+    except Exception as e:
+        return f"the tiktoken cl100k_base encoding is unavailable, it is downloaded on first use ({type(e).__name__})"
+    return None
+
+def unavailable(name):
+    """Why the benchmark name cannot run on this machine (e.g. offline, without the NLTK or tiktoken data), None if it can."""
+    requirement = REQUIREMENTS.get(name)
+    return requirement() if requirement is not None else None
+
+def prepare_document(words, workdir, seed=42):
+    """Synthetic document of about words words with its sentences, pages, gists, pages file and answer files."""
+    rng = random.Random(seed)
+    document = {"words": words, "text": synthetic_text(words, rng)}
+    if _punkt_missing() is None:
+        document["sentences"] = safe_sentence_split(document["text"])
+    else:
+        # the synthetic sentences all end with a period, only the sentence_split benchmark needs NLTK itself
+        document["sentences"] = re.split(r"(?<=\.)\s+", document["text"].strip())
+
+    agent = ReadAgent(_StubPagination(), None, None, None, sentence_splitter=_PresplitSentences(document["sentences"]))
+    document["pages"] = agent.create_pages(document["text"])
+    # gists are the first quarter of every page, about the compression of the gisting prompt
+    document["shortened_pages"] = []
+    for page in document["pages"]:
+        page_words = " ".join(page).split()
+        document["shortened_pages"].append(" ".join(page_words[:max(1, len(page_words) // 4)]))
+
+    document["pages_path"] = os.path.join(workdir, f"pages_{words}.json")
+    save_pages_to_json([list(page) for page in document["pages"]], document["pages_path"])
+
+    answers = []
+    for a in range(max(1, words // WORDS_PER_ANSWER)):
+        choice = rng.randint(1, 4)
+        answers.append({
+            "question_id": f"q{a}",
+            "llm_answer": f"The passage says so. [[{choice}]]",
+            "predicted_choice": choice,
+            "correct_choice": choice == 1,
+            "used_tokens": rng.randint(1_000, 50_000),
+            "hard": a % 2,
+        })
+    document["answers"] = [answer["llm_answer"] for answer in answers]
+    document["answers_folder"] = os.path.join(workdir, f"answers_{words}")
+    os.makedirs(document["answers_folder"], exist_ok=True)
+    with open(os.path.join(document["answers_folder"], "answers.jsonl"), "w", encoding="utf-8") as f:
+        for answer in answers:
+            f.write(json.dumps(answer) + "\n")
+
+    return document
+
+
+def bench_sentence_split(document):
+    return lambda: safe_sentence_split(document["text"])
+
+def bench_create_pages(document):
+    agent = ReadAgent(_StubPagination(), None, None, None, sentence_splitter=_PresplitSentences(document["sentences"]))
+    return lambda: agent.create_pages(document["text"])
+
+def bench_compile_memory(document):
+    return lambda: GistMemory(document["pages"], document["shortened_pages"])
+
+def bench_answer_question(document):
+    agent = ReadAgent(None, None, _StubLookup(len(document["pages"])), _StubQA())
+    agent.pages = document["pages"]
+    agent.shortened_pages = document["shortened_pages"]
+    agent.compile_memory()
+    options = ["the captain", "the queen", "the river", "the letter"]
+
+    def answer_questions():
+        for _ in range(QUESTIONS_PER_RUN):
+            agent.answer_question("Who opened the hidden door?", options, max_lookup_pages=LOOKUP_PAGES)
+    return answer_questions
+
+def bench_count_tokens(document):
+    return lambda: count_tokens(document["text"])
+
+def bench_load_pages(document):
+    return lambda: load_pages_from_json(document["pages_path"])
+
+def bench_extract_number(document):
+    return lambda: [extract_number(answer) for answer in document["answers"]]
+
+def bench_eval_aggregation(document):
+    def evaluate():
+        with contextlib.redirect_stdout(io.StringIO()):
+            evaluate_accuracy(document["answers_folder"])
+    return evaluate
+
+BENCHMARKS = {
+    "sentence_split": bench_sentence_split, # safe_sentence_split of the whole document
+    "create_pages": bench_create_pages, # pagination windows of create_pages with an instant paginator
+    "compile_memory": bench_compile_memory, # lookup and gist articles of GistMemory
+    "answer_question": bench_answer_question, # article assembly of QUESTIONS_PER_RUN questions with instant models
+    "count_tokens": bench_count_tokens, # tiktoken count of the whole document
+    "load_pages": bench_load_pages, # load_pages_from_json of the document's pages
+    "extract_number": bench_extract_number, # extract_number over one answer per WORDS_PER_ANSWER words
+    "eval_aggregation": bench_eval_aggregation, # quality evaluate_accuracy over the same answers
+}
+REQUIREMENTS = {
+    # benchmark -> check returning why it cannot run, these are skipped instead of failing
+    "sentence_split": _punkt_missing,
+    "count_tokens": _tiktoken_missing,
+}
+
+
+def measure(function, repeat):
+    """Best wall-clock seconds of repeat calls, with the garbage collector off during each call like timeit."""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            function()
+            seconds = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def run_benchmarks(sizes=DEFAULT_SIZES, names=None, repeat=3, workdir=None):
+    """
+    Runs every benchmark on a synthetic document of every size.
+    :return: dict - {"<benchmark>/<words>": best seconds}.
+    """
+    names = names or list(BENCHMARKS)
+    for name in list(names):
+        reason = unavailable(name)
+        if reason is not None:
+            logger.warning(f"Skipping the {name} benchmark: {reason}")
+            names = [other for other in names if other != name]
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="microbenchmarks_", dir=workdir) as folder:
+        for words in sizes:
+            start = time.perf_counter()
+            document = prepare_document(words, folder)
+            logger.info(f"Prepared document of {words} words ({len(document['sentences'])} sentences, {len(document['pages'])} pages) in {time.perf_counter() - start:.1f}s")
+            for name in names:
+                key = f"{name}/{words}"
+                results[key] = measure(BENCHMARKS[name](document), repeat)
+                logger.info(f"{key}: {results[key] * 1000:.2f} ms")
+    return results
+
+
+def calibrate(repeat=5):
+    """Best seconds of a fixed pure Python loop, the speed of this machine that baseline timings are scaled by."""
+    def loop():
+        total = 0
+        for k in range(CALIBRATION_LOOPS):
+            total += k * k
+        return total
+    return measure(loop, repeat)
+
+def environment():
+    """Machine description stored with a baseline, timings are only comparable on the same machine."""
+    return {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count()}
+
+def save_baseline(results, path, repeat, tolerance=DEFAULT_TOLERANCE):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    baseline = {"environment": environment(), "calibration": calibrate(), "repeat": repeat, "tolerance": tolerance, "results": results}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, indent=4)
+        f.write("\n")
+    logger.info(f"Saved baseline of {len(results)} benchmarks to {path}")
+
+def compare_to_baseline(results, baseline, tolerance=None, min_seconds=MIN_REGRESSION_SECONDS, scale=1.0):
+    """
+    Compares results to the results of a baseline file.
+    :param tolerance: float - Defaults to the tolerance stored with the baseline.
+    :param scale: float - Factor of the baseline timings, see baseline_scale.
+    :return: List[dict] - The regressions, benchmarks more than tolerance (and min_seconds) slower than their baseline.
+    """
+    if tolerance is None:
+        tolerance = baseline.get("tolerance", DEFAULT_TOLERANCE)
+    regressions = []
+    for key, seconds in results.items():
+        reference = baseline["results"].get(key)
+        if reference is None:
+            logger.info(f"{key}: no baseline")
+            continue
+        reference *= scale
+        if seconds > reference * (1 + tolerance) and seconds - reference > min_seconds:
+            regressions.append({"benchmark": key, "baseline": reference, "seconds": seconds, "ratio": seconds / reference})
+    return regressions
+
+def baseline_scale(baseline):
+    """
+    How much slower this machine is than the one the baseline was measured on, by the calibration loop.
+    1.0 on the same machine, so a baseline is only rescaled when it comes from another one.
+    """
+    if baseline.get("environment") == environment() or not baseline.get("calibration"):
+        return 1.0
+    return calibrate() / baseline["calibration"]
+
+def check_baseline(path=DEFAULT_BASELINE, workdir=None):
+    """
+    Runs the benchmarks and sizes of a baseline file with its repeat count and compares them with its tolerance.
+    :return: List[dict] - The regressions, see compare_to_baseline.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    names = list(dict.fromkeys(key.split("/")[0] for key in baseline["results"]))
+    sizes = sorted({int(key.split("/")[1]) for key in baseline["results"]})
+    scale = baseline_scale(baseline)
+    if scale != 1.0:
+        logger.warning(f"Baseline {path} was measured on another machine, its timings are scaled by {scale:.2f}")
+    results = run_benchmarks(sizes, names, baseline.get("repeat", 3), workdir)
+    print_table(results, baseline, scale)
+    return compare_to_baseline(results, baseline, scale=scale)
+
+def print_regressions(regressions):
+    for regression in regressions:
+        print(f"REGRESSION {regression['benchmark']}: {regression['seconds'] * 1000:.2f} ms, "
+              f"{regression['ratio']:.2f}x the baseline of {regression['baseline'] * 1000:.2f} ms")
+
+def print_table(results, baseline=None, scale=1.0):
+    print(f"{'benchmark':<32}{'ms':>12}{'baseline ms':>14}{'ratio':>8}")
+    for key, seconds in results.items():
+        reference = (baseline or {}).get("results", {}).get(key)
+        if reference:
+            reference *= scale
+            print(f"{key:<32}{seconds * 1000:>12.2f}{reference * 1000:>14.2f}{seconds / reference:>8.2f}")
+        else:
+            print(f"{key:<32}{seconds * 1000:>12.2f}{'-':>14}{'-':>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the CPU hot paths (no API calls) on synthetic documents.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="words per synthetic document")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), default=None)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best one counts")
+    parser.add_argument("--save-baseline", default=None, help="JSON file to store the results as baseline in")
+    parser.add_argument("--check-baseline", default=None, help="JSON baseline to compare with, exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help=f"allowed slowdown, defaults to the one stored with the baseline (saved: {DEFAULT_TOLERANCE})")
+    parser.add_argument("--workdir", default=None, help="folder for the temporary benchmark files")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    # the pagination and page loading log every document, keep only the benchmark output
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    results = run_benchmarks(args.sizes, args.benchmarks, args.repeat, args.workdir)
+
+    baseline = None
+    scale = 1.0
+    if args.check_baseline:
+        with open(args.check_baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        scale = baseline_scale(baseline)
+        if scale != 1.0:
+            logger.warning(f"Baseline {args.check_baseline} was measured on another machine ({baseline.get('environment')}), "
+                           f"its timings are scaled by {scale:.2f}")
+    print_table(results, baseline, scale)
+
+    if args.save_baseline:
+        save_baseline(results, args.save_baseline, args.repeat,
+                      DEFAULT_TOLERANCE if args.tolerance is None else args.tolerance)
+
+    if baseline is not None:
+        regressions = compare_to_baseline(results, baseline, args.tolerance, scale=scale)
+        print_regressions(regressions)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
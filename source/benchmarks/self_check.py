@@ -0,0 +1,77 @@
+import sys
+import random
+import logging
+import argparse
+
+from source.benchmarks.synthetic import WORDS, ensure_config
+
+ensure_config()
+
+from source.benchmarks.fake_openai_server import fake_completion
+from source.benchmarks.microbenchmarks import check_baseline
+from source.method.RAModels import OpenAI_RAModel_Pagination
+from source.method.utils import parse_pause_point
+
+PAGINATION_PASSAGES = 200 # passages the fake pagination answers are checked on
+
+
+def check_fake_pagination(passages=PAGINATION_PASSAGES, seed=0):
+    """
+    The pagination answers of the fake server parse (utils.parse_pause_point) to the label it chose, a label in the
+    second half of the passage. Otherwise every fake pagination call is retried and falls back to the last label,
+    and runs against the fake server never take the real pause point path.
+    :return: List[str] - The failures.
+    """
+    rng = random.Random(seed)
+    paginator = OpenAI_RAModel_Pagination("fake", None)
+    failures = []
+    for _ in range(passages):
+        start = rng.randrange(1000)
+        labels = list(range(start, start + 1 + rng.randrange(20)))
+        passage = []
+        for label in labels:
+            passage.append(" ".join(rng.choice(WORDS) for _ in range(12)) + ".")
+            passage.append(f"<{label}>")
+        prompt = paginator.build_prompt("", "\n".join(passage), "" if rng.random() < 0.2 else "Next sentence.\n...")
+
+        kind, answer = fake_completion(prompt)
+        pause_point = parse_pause_point(answer)
+        if kind != "pagination" or pause_point not in labels[len(labels) // 2:]:
+            failures.append(f"fake pagination answer {answer!r} for labels {labels[0]}-{labels[-1]} parses to {pause_point}")
+    return failures
+
+def check_microbenchmarks():
+    """
+    The microbenchmarks are no slower than the committed baseline (microbenchmarks.DEFAULT_BASELINE) beyond the
+    tolerance stored with it. Benchmarks whose data is unavailable offline are skipped with a warning.
+    :return: List[str] - The failures, one per regressed benchmark.
+    """
+    return [f"{regression['benchmark']} took {regression['seconds'] * 1000:.2f} ms, "
+            f"{regression['ratio']:.2f}x the baseline of {regression['baseline'] * 1000:.2f} ms"
+            for regression in check_baseline()]
+
+CHECKS = {
+    "fake_pagination": check_fake_pagination,
+    "microbenchmarks": check_microbenchmarks,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Checks of the benchmark tooling, exits with 1 if one fails.")
+    parser.add_argument("--checks", nargs="+", choices=list(CHECKS), default=list(CHECKS))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    failed = False
+    for name in args.checks:
+        failures = CHECKS[name]()
+        for failure in failures[:10]:
+            print(f"FAIL {name}: {failure}")
+        print(f"{name}: {'FAILED' if failures else 'OK'}")
+        failed = failed or bool(failures)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+import sys
+import types
+import random
+
+WORDS = """
+the a of and to in was he she it his her that with as for had on at by from they but not this have were which one
+captain ship storm river mountain forest village king queen letter door window night morning house road city war
+said asked looked walked turned opened found knew thought believed remembered watched waited returned followed
+old young dark bright quiet long small great strange cold warm last first final hidden distant silent broken
+""".split()
+
+
+def synthetic_text(words, rng):
+    """Deterministic article of about the given number of words, in paragraphs of sentences."""
+    paragraphs = []
+    count = 0
+    while count < words:
+        sentences = []
+        for _ in range(rng.randint(3, 8)):
+            sentence = [rng.choice(WORDS) for _ in range(rng.randint(6, 24))]
+            sentences.append(" ".join(sentence).capitalize() + ".")
+            count += len(sentence)
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+def synthetic_dataset(dataset, documents, questions, words, seed=42):
+    """Preprocessed dataset file content in the format the precreate and experiment scripts of the dataset read."""
+    rng = random.Random(seed)
+    data = {}
+    for d in range(documents):
+        doc_id = f"doc-{d}"
+        article = synthetic_text(words, rng)
+        items = []
+        for q in range(questions):
+            question = "What happened to the " + " ".join(rng.choice(WORDS) for _ in range(6)) + "?"
+            options = [" ".join(rng.choice(WORDS) for _ in range(5)) for _ in range(4)]
+            gold = rng.randint(1, 4)
+            if dataset == "quality":
+                items.append({"question_unique_id": f"{doc_id}-q{q}", "question": question, "options": options, "gold_label": gold, "difficult": q % 2})
+            else:
+                items.append({"question_id": f"{doc_id}-q{q}", "input": question, "options": options, "gold_choice": gold})
+        if dataset == "quality":
+            data[doc_id] = {"article": article, "questions": {f"{doc_id}-set": items}}
+        else:
+            data[doc_id] = {"context": article, "entries": items}
+    return data
+
+def ensure_config():
+    """The scripts and ReadAgent read the API key from config.py; without one, a placeholder key is used (the fake server and the stubbed models accept any key)."""
+    try:
+        import config
+    except ImportError:
+        sys.modules["config"] = types.SimpleNamespace(OPENAI_API_KEY="sk-fake")
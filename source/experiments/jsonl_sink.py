@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+class JsonlSink:
+    """
+    Buffered JSONL writer for the results of a run, shared by all worker threads (and the asyncio event loop).
+    write() only puts the serialized line on a queue; one writer thread appends the lines in batches, keeping every
+    file open, and flushes + fsyncs them every flush_interval seconds or flush_bytes bytes, whichever comes first.
+    Lines are written whole and in the order they were queued, so the files stay valid JSONL however many threads write.
+    """
+
+    def __init__(self, flush_interval=1.0, flush_bytes=1 << 20):
+        """
+        Args:
+            flush_interval (float): Maximum seconds a queued line waits before it is written and fsynced.
+            flush_bytes (int): Pending bytes that trigger a write before the interval is over.
+        """
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+
+        self._queue = queue.Queue()
+        self._files = {}
+        self._error = None
+        self._closed = False
+        self._lines_written = 0
+        self._flushes = 0
+
+        self._thread = threading.Thread(target=self._run, name="JsonlSink", daemon=True)
+        self._thread.start()
+
+    def write(self, data, file_path):
+        """Queues one dictionary as a JSON line for file_path."""
+        self._raise_writer_error()
+        if self._closed:
+            raise ValueError("JsonlSink is closed.")
+        self._queue.put((file_path, json.dumps(data) + "\n"))
+
+    def flush(self):
+        """Blocks until every line queued so far is written and fsynced."""
+        self._raise_writer_error()
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        done.wait()
+        self._raise_writer_error()
+
+    def close(self):
+        """Writes the remaining lines, fsyncs and closes all files and stops the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put((_CLOSE, None))
+        self._thread.join()
+        logging.info(f"[JsonlSink] wrote {self._lines_written} lines in {self._flushes} flushes")
+        self._raise_writer_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _raise_writer_error(self):
+        if self._error is not None:
+            raise RuntimeError("JsonlSink writer thread failed") from self._error
+
+    def _run(self):
+        pending = {}
+        pending_bytes = 0
+        oldest = None
+
+        while True:
+            timeout = None if oldest is None else max(0.0, oldest + self.flush_interval - time.monotonic())
+            try:
+                target, item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                target, item = None, None
+
+            if target is _FLUSH or target is _CLOSE:
+                self._write_pending(pending)
+                pending, pending_bytes, oldest = {}, 0, None
+                if target is _CLOSE:
+                    self._close_files()
+                    return
+                item.set()
+                continue
+
+            if target is not None:
+                pending.setdefault(target, []).append(item)
+                pending_bytes += len(item)
+                if oldest is None:
+                    oldest = time.monotonic()
+
+            if oldest is not None and (pending_bytes >= self.flush_bytes or time.monotonic() - oldest >= self.flush_interval):
+                self._write_pending(pending)
+                pending, pending_bytes, oldest = {}, 0, None
+
+    def _write_pending(self, pending):
+        if self._error is not None:
+            return
+        try:
+            for file_path, lines in pending.items():
+                f = self._files.get(file_path)
+                if f is None:
+                    f = self._files[file_path] = open(file_path, "a")
+                f.write("".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+                self._lines_written += len(lines)
+            if pending:
+                self._flushes += 1
+        except Exception as e:
+            logging.exception("[JsonlSink] failed to write results")
+            self._error = e
+
+    def _close_files(self):
+        for f in self._files.values():
+            try:
+                f.close()
+            except Exception as e:
+                logging.error(f"[JsonlSink] failed to close {f.name}: {e}")
+        self._files = {}
@@ -1,18 +1,26 @@
 import logging
 
 from source.method.ReadAgent import ReadAgent
-from source.method.QAModels import OpenAI_QAModel_Generation
-from source.method.RAModels import OpenAI_RAModel_Pagination, OpenAI_RAModel_Gisting, OpenAI_RAModel_Lookup
-
-from source.experiments.utils import save_jsonl, log_error, create_directories, load_json_file, load_jsonl_file, extract_number
+from source.method.AsyncReadAgent import AsyncReadAgent
+from source.method.QAModels import OpenAI_QAModel_Generation, AsyncOpenAI_QAModel_Generation
+from source.method.RAModels import OpenAI_RAModel_Pagination, OpenAI_RAModel_Gisting, OpenAI_RAModel_Lookup, BM25_RAModel_Lookup, Hybrid_RAModel_Lookup, AsyncOpenAI_RAModel_Pagination, AsyncOpenAI_RAModel_Gisting, AsyncOpenAI_RAModel_Lookup, AsyncBM25_RAModel_Lookup, AsyncHybrid_RAModel_Lookup
+from source.method.ResponseCache import ResponseCache
+from source.method.PageStore import PageStore
+from source.method.RateLimiter import configure_rate_limiter
+from source.method.Metrics import configure_metrics, advance_progress
+from source.method.Tracing import configure_tracing, trace_span
+from source.method.RetryPolicy import is_permanent_error
+
+from source.experiments.scheduler import QuestionScheduler, run_documents_async
+from source.experiments.jsonl_sink import JsonlSink
+from source.experiments.utils import save_jsonl, log_error, create_directories, load_json_file, load_jsonl_file, load_completed_question_ids, extract_number
 
 from datetime import datetime
 from config import OPENAI_API_KEY
 import os
+import asyncio
 
-from openai import OpenAI
-
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from openai import OpenAI, AsyncOpenAI
 
 from datetime import datetime
 
@@ -21,10 +29,27 @@ os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
 
 #OPENAI_MODELSTRING = "gpt-4o-2024-11-20"
 OPENAI_MODELSTRING = "gpt-4o-mini-2024-07-18"
+OPENAI_BASE_URL = None # e.g. "http://127.0.0.1:8000/v1" for the local fake server (python -m source.benchmarks.fake_openai_server); None uses the OpenAI API or the OPENAI_BASE_URL environment variable
+RESPONSE_CACHE_PATH = None # e.g. "experiments/cache/responses.sqlite", identical prompts are then answered from this cache instead of the model (with zero token usage); None measures every call
+RATE_LIMIT_RPM = None # requests per minute of your OpenAI quota, shared by all threads; None disables client-side rate limiting
+RATE_LIMIT_TPM = None # tokens per minute of your OpenAI quota
+METRICS_PATH = None # e.g. "experiments/metrics/run.prom" (Prometheus text file) or "experiments/metrics/run.json" (JSON snapshot), rewritten on every progress line; None disables the export
+METRICS_INTERVAL = 60 # seconds between two progress lines with call counts, latencies, tokens/s and ETA; None disables the metrics unless METRICS_PATH is set
+TRACE_PATH = None # e.g. "experiments/traces/run.json", Chrome trace of documents, questions, model calls, API requests and retry waits for https://ui.perfetto.dev or chrome://tracing; None disables tracing
+USE_ASYNC = False # run all files and questions in one asyncio event loop (AsyncOpenAI) instead of a thread pool
+MAX_IN_FLIGHT_REQUESTS = 200 # upper bound of concurrent API requests in async mode
+MAX_DOCUMENTS_IN_FLIGHT = 8 # documents loaded and answered at the same time in async mode, the others wait in dataset order
+RESUME_RUN_DATE_TIME = None # "%Y-%m-%d_%H-%M" date of an interrupted run, its answer files are continued and answered questions skipped
+MAX_WORKERS = None # threads answering questions in the threaded mode, None for the ThreadPoolExecutor default; 1 runs sequentially
+LOOKUP_BACKEND = "openai" # "openai" (LLM lookup over the whole gist memory), "bm25" (local BM25 page ranking, no API call) or "hybrid" (LLM lookup over the gists of the best BM25 pages)
+BM25_INDEX_ON = "pages" # what the bm25 and hybrid lookups rank, "pages" (full pages) or "gists"
+HYBRID_CANDIDATE_PAGES = 20 # gists shown to the LLM by the hybrid lookup
 
 #PATHS
 STORED_PAGES_FOLDER_PATH = "experiments/artifacts/pages/narrative_qa/test/2025-04-08_13-33-readagent-precreate-pages_gpt4o-mini-Narrative_qa"
 STORED_SHORTENED_PAGES_FOLDER_PATH = "experiments/artifacts/shortened_pages/narrative_qa/test/2025-04-08_13-33-readagent-precreate-pages_gpt4o-mini-Narrative_qa"
+PAGE_STORE_PATH = None # packed store of the precreated pages (python -m source.method.PageStore <pages folder> <shortened pages folder> <store folder>), used instead of the two folders above
+LAZY_PAGE_CACHE_SIZE = 16 # with a PAGE_STORE_PATH, full pages are decoded only when looked up, keeping this many per document; None decodes all pages up front
 STORED_ANSWERS_PATH = "experiments/artifacts/answers/narrative_qa/test"
 
 PREPROCESSED_DATA_PATH = "data/narrativeqa/preprocessed/processed_qaps_test.json"
@@ -40,70 +65,187 @@ def get_file_list(folder_path):
         if os.path.isfile(os.path.join(folder_path, file)) and not file.startswith(".")
     ]
 
-def run_experiment_on_file(file_path, grouped_dataset, openAI_client, hyperparams, stored_answers_file, stored_errors_file):
-    """Run the experiment for a single file."""
-    document_id = os.path.splitext(os.path.basename(file_path))[0]
+def scheduled_documents(file_list, grouped_dataset, stored_errors_file, results_sink=None):
+    """Yields (document_id, [(question_id, questionContent), ...]) for every precreated file."""
+    for file_path in file_list:
+        document_id = os.path.splitext(os.path.basename(file_path))[0]
+        if document_id not in grouped_dataset:
+            logging.error(f"No questions found for document {document_id}")
+            save_jsonl({"document_id": document_id, "error": "No questions found for document"}, stored_errors_file, results_sink)
+            continue
+        yield document_id, list(grouped_dataset[document_id].items())
+
+def load_precreated_pages(readAgent, document_id):
+    """Loads the precreated pages and shortened pages of a document, from the page store if there is one."""
+    if PAGE_STORE_PATH:
+        readAgent.load_pages(PAGE_STORE_PATH, doc_id=document_id, cache_size=LAZY_PAGE_CACHE_SIZE)
+        readAgent.load_shortened_pages(PAGE_STORE_PATH, doc_id=document_id)
+    else:
+        readAgent.load_pages(f"{STORED_PAGES_FOLDER_PATH}/{document_id}.json")
+        readAgent.load_shortened_pages(f"{STORED_SHORTENED_PAGES_FOLDER_PATH}/{document_id}.json")
+
+def load_read_agent(document_id, openAI_client, stored_errors_file, response_cache=None, results_sink=None):
+    """Creates the ReadAgent of a document, shared by the scheduled tasks of all its questions, or None if loading fails."""
     logging.info(f"Processing document: {document_id}")
 
-    # Load the saved nodes
     try:
         # Initialize models
         logging.info("Initializing models...")
-        pagination_model = OpenAI_RAModel_Pagination(modelString=OPENAI_MODELSTRING, client=openAI_client)
-        gisting_model = OpenAI_RAModel_Gisting(modelString=OPENAI_MODELSTRING, client=openAI_client)
-        lookup_model = OpenAI_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client)
-        qa_model = OpenAI_QAModel_Generation(modelString=OPENAI_MODELSTRING, client=openAI_client)
+        pagination_model = OpenAI_RAModel_Pagination(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
+        gisting_model = OpenAI_RAModel_Gisting(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
+        if LOOKUP_BACKEND == "bm25":
+            lookup_model = BM25_RAModel_Lookup(index_on=BM25_INDEX_ON)
+        elif LOOKUP_BACKEND == "hybrid":
+            lookup_model = Hybrid_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, candidate_pages=HYBRID_CANDIDATE_PAGES, index_on=BM25_INDEX_ON)
+        else:
+            lookup_model = OpenAI_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
+        qa_model = OpenAI_QAModel_Generation(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
 
         # Initialize ReadAgent
         readAgent = ReadAgent(pagination_model, gisting_model, lookup_model, qa_model)
 
-        logging.info(f"Processing document {document_id}...")
-
         # Load precreated pages and shortened pages
-        readAgent.load_pages(f"{STORED_PAGES_FOLDER_PATH}/{document_id}.json")    
-        readAgent.load_shortened_pages(f"{STORED_SHORTENED_PAGES_FOLDER_PATH}/{document_id}.json")
+        load_precreated_pages(readAgent, document_id)
         logging.info(f"Loaded precreated pages and shortened_pages for document {document_id}.")
 
-        questions = grouped_dataset[document_id]
+        # Compile the gist memory before the questions of the document are answered concurrently
+        readAgent.compile_memory()
+
+        return readAgent
 
-        # Iterate over questions of the document
-        for question_id, questionContent in questions.items():
-            question = questionContent['question']
-            gold_answers = questionContent['answers']
+    except Exception as e:
+        logging.exception(f"Error processing document {document_id}: {str(e)}")
+        save_jsonl({"document_id": document_id, "error": str(e)}, stored_errors_file, results_sink)
+        return None
+
+def run_experiment_for_question(readAgent, document_id, question, hyperparams, stored_answers_file, stored_errors_file, results_sink=None):
+    question_id, questionContent = question
 
-            answer, looked_up_page_ids, used_input_tokens = readAgent.answer_question(
-                    question=question,
+    try:
+        with trace_span("question", "task", doc_id=document_id, question_id=question_id):
+            answer, looked_up_page_ids, used_tokens = readAgent.answer_question(
+                    question=questionContent['question'],
                     options=None,
-                    max_lookup_pages=hyperparams["max_lookup_pages"]
+                    max_lookup_pages=hyperparams["max_lookup_pages"],
+                    return_usage=True
                 )
+    except Exception as e:
+        advance_progress("questions")
+        if is_permanent_error(e):
+            # fails the same way on every attempt (e.g. context length exceeded), record it and move on
+            logging.error(f"Permanent error for document {document_id}, question {question_id}: {e}")
+            log_error(document_id, question_id, f"{type(e).__name__}: {e}", stored_errors_file, results_sink)
+        else:
+            logging.exception(f"Error processing document {document_id}, question {question_id}: {str(e)}")
+            save_jsonl({"document_id": document_id, "question_id": question_id, "error": str(e)}, stored_errors_file, results_sink)
+        return
+
+    save_answer(document_id, question_id, questionContent, answer, looked_up_page_ids, used_tokens, stored_answers_file, stored_errors_file, results_sink)
+    advance_progress("questions")
+
+async def run_experiment_on_file_async(file_path, grouped_dataset, openAI_client, semaphore, hyperparams, stored_answers_file, stored_errors_file, response_cache=None, results_sink=None):
+    """Async version of run_experiment_on_file, answering all questions of the file concurrently."""
+    document_id = os.path.splitext(os.path.basename(file_path))[0]
+    logging.info(f"Processing document: {document_id}")
 
-            if isinstance(answer, str):
-                logging.info(
-                    f"Document ID: {document_id}, Question ID: {question_id}, Predicted_answer: {answer[:20]}"
-                )
+    try:
+        # Initialize models
+        logging.info("Initializing async models...")
+        pagination_model = AsyncOpenAI_RAModel_Pagination(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, semaphore=semaphore)
+        gisting_model = AsyncOpenAI_RAModel_Gisting(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, semaphore=semaphore)
+        if LOOKUP_BACKEND == "bm25":
+            lookup_model = AsyncBM25_RAModel_Lookup(index_on=BM25_INDEX_ON)
+        elif LOOKUP_BACKEND == "hybrid":
+            lookup_model = AsyncHybrid_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, semaphore=semaphore, candidate_pages=HYBRID_CANDIDATE_PAGES, index_on=BM25_INDEX_ON)
+        else:
+            lookup_model = AsyncOpenAI_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, semaphore=semaphore)
+        qa_model = AsyncOpenAI_QAModel_Generation(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, semaphore=semaphore)
 
-                # Store the answer
-                result = {
-                    "document_id": document_id,
-                    "question_id": question_id,
-                    "question": question,                    
-                    "gold_answers": gold_answers,           
-                    "predicted_answer": answer.replace("\n", " "),
-                    "looked_up_page_ids": looked_up_page_ids,
-                    "used_tokens": used_input_tokens,
-                }
-                save_jsonl(result, stored_answers_file)
-                
-            else:
-                log_error(document_id, question_id, "No valid string answer", stored_errors_file)
+        # Initialize ReadAgent
+        readAgent = AsyncReadAgent(pagination_model, gisting_model, lookup_model, qa_model)
+
+        # Load precreated pages and shortened pages and compile the gist memory, in a thread as both block the event loop
+        with trace_span("load_document", "task", doc_id=document_id):
+            await asyncio.to_thread(load_precreated_pages, readAgent, document_id)
+            await asyncio.to_thread(readAgent.compile_memory)
+        logging.info(f"Loaded precreated pages and shortened_pages for document {document_id}.")
+
+        questions = grouped_dataset[document_id]
+
+        async def answer_and_save(question_id, questionContent):
+            try:
+                with trace_span("question", "task", doc_id=document_id, question_id=question_id):
+                    answer, looked_up_page_ids, used_tokens = await readAgent.answer_question(
+                            question=questionContent['question'],
+                            options=None,
+                            max_lookup_pages=hyperparams["max_lookup_pages"],
+                            return_usage=True
+                        )
+            except Exception as e:
+                # like run_experiment_for_question, a failed question is recorded and the other questions of the file go on
+                advance_progress("questions")
+                if is_permanent_error(e):
+                    logging.error(f"Permanent error for document {document_id}, question {question_id}: {e}")
+                    log_error(document_id, question_id, f"{type(e).__name__}: {e}", stored_errors_file, results_sink)
+                else:
+                    logging.exception(f"Error processing document {document_id}, question {question_id}: {str(e)}")
+                    save_jsonl({"document_id": document_id, "question_id": question_id, "error": str(e)}, stored_errors_file, results_sink)
+                return
+            save_answer(document_id, question_id, questionContent, answer, looked_up_page_ids, used_tokens, stored_answers_file, stored_errors_file, results_sink)
+            advance_progress("questions")
+
+        await asyncio.gather(*(answer_and_save(question_id, questionContent) for question_id, questionContent in questions.items()))
 
     except Exception as e:
         logging.exception(f"Error processing document {document_id}: {str(e)}")
-        save_jsonl({"document_id": document_id, "error": str(e)}, stored_errors_file)
+        save_jsonl({"document_id": document_id, "error": str(e)}, stored_errors_file, results_sink)
+
+async def run_experiment_for_all_files_async(file_list, grouped_dataset, hyperparams, stored_answers_file, stored_errors_file, response_cache=None, results_sink=None):
+    """Async counterpart of the thread pool in run_experiment_for_all_files: all files and questions share one event loop, with at most MAX_DOCUMENTS_IN_FLIGHT documents loaded at a time."""
+    openAI_client = AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL, max_retries=0)
+    semaphore = asyncio.Semaphore(MAX_IN_FLIGHT_REQUESTS)
+
+    try:
+        async def run_document(file_path):
+            await run_experiment_on_file_async(file_path, grouped_dataset, openAI_client, semaphore, hyperparams, stored_answers_file, stored_errors_file, response_cache, results_sink)
+
+        await run_documents_async(((file_path,) for file_path in file_list), run_document, MAX_DOCUMENTS_IN_FLIGHT)
+    finally:
+        await openAI_client.close()
+
+def save_answer(document_id, question_id, questionContent, answer, looked_up_page_ids, used_tokens, stored_answers_file, stored_errors_file, results_sink=None):
+    if isinstance(answer, str):
+        logging.info(
+            f"Document ID: {document_id}, Question ID: {question_id}, Predicted_answer: {answer[:20]}"
+        )
+
+        # Store the answer
+        result = {
+            "document_id": document_id,
+            "question_id": question_id,
+            "question": questionContent['question'],                    
+            "gold_answers": questionContent['answers'],           
+            "predicted_answer": answer.replace("\n", " "),
+            "looked_up_page_ids": looked_up_page_ids,
+            "used_tokens": used_tokens["input_tokens"],
+            "output_tokens": used_tokens["output_tokens"],
+            "cached_tokens": used_tokens["cached_tokens"],
+        }
+        save_jsonl(result, stored_answers_file, results_sink)
+        
+    else:
+        log_error(document_id, question_id, "No valid string answer", stored_errors_file, results_sink)
+
+def remove_answered_questions(grouped_dataset, completed_question_ids):
+    """Copy of the dataset without the questions whose answers are already stored."""
+    return {
+        document_id: {question_id: questionContent for question_id, questionContent in questions.items() if question_id not in completed_question_ids}
+        for document_id, questions in grouped_dataset.items()
+    }
 
 def run_experiment_for_all_files(experiment_identifier, hyperparams):
     """Run a single experiment."""
-    current_date_time = datetime.now().strftime("%Y-%m-%d_%H-%M")
+    current_date_time = RESUME_RUN_DATE_TIME or datetime.now().strftime("%Y-%m-%d_%H-%M")
     stored_answers_file = f"{STORED_ANSWERS_PATH}/{current_date_time}-{experiment_identifier}.jsonl"
     stored_errors_file = f"{STORED_ANSWERS_PATH}/{current_date_time}-{experiment_identifier}_ERRORS.jsonl"
     log_file = f"{LOG_DIR}/{current_date_time}-{experiment_identifier}.log"
@@ -120,7 +262,7 @@ def run_experiment_for_all_files(experiment_identifier, hyperparams):
         logger.handlers.clear()
 
     # File handler
-    file_handler = logging.FileHandler(log_file, mode="w")  # Write logs to file
+    file_handler = logging.FileHandler(log_file, mode="a" if RESUME_RUN_DATE_TIME else "w")  # Write logs to file, appending when resuming
     file_handler.setLevel(logging.INFO)  # Set log level for the file handler
     file_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
     file_handler.setFormatter(file_formatter)
@@ -138,41 +280,59 @@ def run_experiment_for_all_files(experiment_identifier, hyperparams):
     # Load preprocessed dataset
     grouped_dataset = load_json_file(PREPROCESSED_DATA_PATH)
 
+    # Only questions without a stored answer are scheduled, when resuming an interrupted run
+    completed_question_ids = load_completed_question_ids(stored_answers_file)
+    if completed_question_ids:
+        logging.info(f"Resuming {stored_answers_file}: skipping {len(completed_question_ids)} answered questions")
+        grouped_dataset = remove_answered_questions(grouped_dataset, completed_question_ids)
+
     # Initialize models
-    openAI_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"], max_retries=0)
+    openAI_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL, max_retries=0)
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH else None
+    configure_rate_limiter(RATE_LIMIT_RPM, RATE_LIMIT_TPM)
+    results_sink = JsonlSink() # answers and errors are written in batches by one writer thread
 
     # Load precreated nodes
-    file_list = get_file_list(STORED_PAGES_FOLDER_PATH)
+    if PAGE_STORE_PATH:
+        file_list = [f"{document_id}.json" for document_id in PageStore.open(PAGE_STORE_PATH).doc_ids()]
+    else:
+        file_list = get_file_list(STORED_PAGES_FOLDER_PATH)
+
+    metrics = configure_metrics(METRICS_PATH, METRICS_INTERVAL)
+    tracer = configure_tracing(TRACE_PATH)
+    if metrics is not None:
+        metrics.set_total("questions", sum(len(grouped_dataset.get(os.path.splitext(os.path.basename(file_path))[0], {})) for file_path in file_list))
 
     try:
-        #with ThreadPoolExecutor(max_workers=1) as executor: #optionally control amount of parallelity
-        with ThreadPoolExecutor() as executor:
-            logging.info("Using multithreaded run_experiment on all files")
-            futures = [
-                executor.submit(
-                    run_experiment_on_file,
-                    file_path, 
-                    grouped_dataset,
-                    openAI_client, 
-                    hyperparams, 
-                    stored_answers_file, 
-                    stored_errors_file
+        if USE_ASYNC:
+            logging.info(f"Using asyncio run_experiment with up to {MAX_IN_FLIGHT_REQUESTS} requests in flight")
+            asyncio.run(run_experiment_for_all_files_async(file_list, grouped_dataset, hyperparams, stored_answers_file, stored_errors_file, response_cache, results_sink))
+        else:
+            logging.info("Using multithreaded run_experiment, one task per question")
+            scheduler = QuestionScheduler(max_workers=MAX_WORKERS)
+            scheduler.run(
+                scheduled_documents(file_list, grouped_dataset, stored_errors_file, results_sink),
+                load_document=lambda document_id: load_read_agent(document_id, openAI_client, stored_errors_file, response_cache, results_sink),
+                answer_question=lambda readAgent, document_id, question: run_experiment_for_question(
+                    readAgent, document_id, question, hyperparams, stored_answers_file, stored_errors_file, results_sink
                 )
-                for file_path in file_list
-            ]
-
-            for future in as_completed(futures):
-                # check if a thread fails with exception
-                exception = future.exception()
-                if exception:
-                    logging.error(f"Error while running experiment on all files: {exception}")
-
-                    # Propagate the exception
-                    raise exception
+            )
 
     except Exception as e:
         logging.exception(f"While running experiments the following error ocurred: {e}")
 
+    results_sink.close()
+
+    if response_cache is not None:
+        logging.info(f"Response cache: {response_cache.stats()}")
+        response_cache.close()
+
+    if metrics is not None:
+        metrics.close()
+
+    if tracer is not None:
+        tracer.close()
+
     logging.info(f"Experiment {experiment_identifier} completed.")
 
 def run_experiment_batch():
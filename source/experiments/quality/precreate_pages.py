@@ -2,10 +2,15 @@ import logging
 
 from source.method.ReadAgent import ReadAgent
 from source.method.QAModels import OpenAI_QAModel_MultipleChoice
-from source.method.RAModels import OpenAI_RAModel_Pagination, OpenAI_RAModel_Gisting, OpenAI_RAModel_Lookup
+from source.method.RAModels import OpenAI_RAModel_Pagination, TextTiling_RAModel_Pagination, OpenAI_RAModel_Gisting, OpenAI_RAModel_Lookup
+from source.method.ResponseCache import ResponseCache
+from source.method.SentenceSplitter import SentenceSplitter
+from source.method.RateLimiter import configure_rate_limiter
+from source.method.Metrics import configure_metrics, advance_progress
+from source.method.Tracing import configure_tracing, traced_task
 
 
-from source.experiments.utils import save_jsonl, log_error, create_directories, load_json_file, load_jsonl_file
+from source.experiments.utils import save_jsonl, log_error, create_directories, remove_directory_if_empty, load_json_file, load_jsonl_file
 from datetime import datetime
 from config import OPENAI_API_KEY
 import os
@@ -15,14 +20,31 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from openai import OpenAI
 
 OPENAI_MODELSTRING = "gpt-4o-mini-2024-07-18"
+OPENAI_BASE_URL = None # e.g. "http://127.0.0.1:8000/v1" for the local fake server (python -m source.benchmarks.fake_openai_server); None uses the OpenAI API or the OPENAI_BASE_URL environment variable
+RESPONSE_CACHE_PATH = None # e.g. "experiments/cache/responses.sqlite", identical prompts are then answered from this cache instead of the model (with zero token usage); None measures every call
+RATE_LIMIT_RPM = None # requests per minute of your OpenAI quota, shared by all threads; None disables client-side rate limiting
+RATE_LIMIT_TPM = None # tokens per minute of your OpenAI quota
+METRICS_PATH = None # e.g. "experiments/metrics/run.prom" (Prometheus text file) or "experiments/metrics/run.json" (JSON snapshot), rewritten on every progress line; None disables the export
+METRICS_INTERVAL = 60 # seconds between two progress lines with call counts, latencies, tokens/s and ETA; None disables the metrics unless METRICS_PATH is set
+TRACE_PATH = None # e.g. "experiments/traces/run.json", Chrome trace of documents, questions, model calls, API requests and retry waits for https://ui.perfetto.dev or chrome://tracing; None disables tracing
+MAX_WORKERS = None # documents precreated in parallel, None for the ThreadPoolExecutor default; 1 runs sequentially
+GISTING_MAX_WORKERS = 8 # concurrent gisting calls per document, 1 gists pages sequentially
+PIPELINED_GISTING = True # gist pages while pagination is still running instead of after it
+PAGINATION_BACKEND = "openai" # "openai" (LLM pause points) or "texttiling" (local lexical-cohesion pause points, no API calls)
+SENTENCE_CACHE_PATH = "experiments/cache/sentences" # sentence splits of the documents, reused when re-paginating with other settings; None disables it
+SENTENCE_SPLIT_PROCESSES = None # worker processes for the NLTK sentence split, None splits in the document's thread
 
 # Experiment metadata
 EXPERIMENT_IDENTIFIER = "readagent-precreate-pages_gpt4o-mini-Quality_dev"
 CURRENT_DATE_TIME = datetime.now().strftime("%Y-%m-%d_%H-%M")
+RESUME_RUN = None # "<date>-<experiment identifier>" folder name of an interrupted run to continue in, None starts a new run
+RUN_NAME = RESUME_RUN or f"{CURRENT_DATE_TIME}-{EXPERIMENT_IDENTIFIER}"
 
 # Paths
-STORED_PAGES_FOLDER_PATH = f"experiments/artifacts/pages/quality/dev/{CURRENT_DATE_TIME}-{EXPERIMENT_IDENTIFIER}"
-STORED_SHORTENED_PAGES_FOLDER_PATH = f"experiments/artifacts/shortened_pages/quality/dev/{CURRENT_DATE_TIME}-{EXPERIMENT_IDENTIFIER}"
+STORED_PAGES_FOLDER_PATH = f"experiments/artifacts/pages/quality/dev/{RUN_NAME}"
+CHECKPOINT_FOLDER_PATH = f"experiments/checkpoints/pages/quality/dev/{RUN_NAME}" # pagination state of unfinished documents, kept out of the artifacts and removed once all documents are done
+STORED_SHORTENED_PAGES_FOLDER_PATH = f"experiments/artifacts/shortened_pages/quality/dev/{RUN_NAME}"
+PREPROCESSED_DATA_PATH = "data/quality/preprocessed/QuALITY.v1.0.1.htmlstripped_dev_preprocessed.json"
 LOG_DIR = "experiments/logs/"
 LOG_FILE = f"{LOG_DIR}/{CURRENT_DATE_TIME}-quality_dev_precreate_pages.log"
 
@@ -62,26 +84,37 @@ def precreate_pages_for_all_docs():
     logging.info(f"Starting experiment: {EXPERIMENT_IDENTIFIER}")
 
     # Load preprocessed dataset
-    preprocessed_path = "data/quality/preprocessed/QuALITY.v1.0.1.htmlstripped_dev_preprocessed.json"
-    grouped_data = load_json_file(preprocessed_path)
+    grouped_data = load_json_file(PREPROCESSED_DATA_PATH)
 
-    openAI_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"], max_retries=0)
+    # forks its worker processes, so it is created before the metrics reporter or any other thread starts
+    sentence_splitter = SentenceSplitter(SENTENCE_CACHE_PATH, SENTENCE_SPLIT_PROCESSES)
+
+    openAI_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL, max_retries=0)
+
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH else None
+    configure_rate_limiter(RATE_LIMIT_RPM, RATE_LIMIT_TPM)
+    metrics = configure_metrics(METRICS_PATH, METRICS_INTERVAL)
+    tracer = configure_tracing(TRACE_PATH)
+    if metrics is not None:
+        metrics.set_total("documents", len(grouped_data))
 
     try:
-        #with ThreadPoolExecutor(max_workers=5) as executor:
-        with ThreadPoolExecutor() as executor:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
             logging.info("Using multithreaded Precreate_Pages")
             futures = [
                 executor.submit(
-                    precreate_pages_for_doc,
+                    traced_task(precreate_pages_for_doc, "precreate_pages_for_doc", doc_id=doc_id),
                     doc_id,
                     doc_data,
-                    openAI_client
+                    openAI_client,
+                    response_cache,
+                    sentence_splitter
                 )
                 for doc_id, doc_data in grouped_data.items()
             ]
 
             for future in as_completed(futures):
+                advance_progress("documents")
                 # check if a thread fails with exception
                 exception = future.exception()
                 if exception:
@@ -93,35 +126,70 @@ def precreate_pages_for_all_docs():
     except Exception as e:
         logging.exception(f"While precreating pages the following error ocurred: {e}")
 
+    logging.info(f"Sentence splitter: {sentence_splitter.stats()}")
+    sentence_splitter.close()
+
+    if response_cache is not None:
+        logging.info(f"Response cache: {response_cache.stats()}")
+        response_cache.close()
+
+    if metrics is not None:
+        metrics.close()
+
+    if tracer is not None:
+        tracer.close()
+
+    # the checkpoint of a document is removed when it is done, the folder only remains if there is something to resume
+    remove_directory_if_empty(CHECKPOINT_FOLDER_PATH)
+
     logging.info(f"Experiment {EXPERIMENT_IDENTIFIER} completed.")
 
 
 
 def precreate_pages_for_doc( doc_id,
                     doc_data,
-                    openAI_client):
+                    openAI_client, response_cache=None, sentence_splitter=None):
     
+    pages_path = f"{STORED_PAGES_FOLDER_PATH}/{doc_id}.json"
+    shortened_pages_path = f"{STORED_SHORTENED_PAGES_FOLDER_PATH}/{doc_id}.json"
+    checkpoint_path = f"{CHECKPOINT_FOLDER_PATH}/{doc_id}.json"
+
+    if os.path.exists(shortened_pages_path):
+        logging.info(f"Skipping document {doc_id}, pages and shortened_pages already exist.")
+        return
+
     try:
         # Initialize models
         logging.info("Initializing models...")
-        pagination_model = OpenAI_RAModel_Pagination(modelString=OPENAI_MODELSTRING, client=openAI_client)
-        gisting_model = OpenAI_RAModel_Gisting(modelString=OPENAI_MODELSTRING, client=openAI_client)
-        lookup_model = OpenAI_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client)
-        qa_model = OpenAI_QAModel_MultipleChoice(modelString=OPENAI_MODELSTRING, client=openAI_client)
+        if PAGINATION_BACKEND == "texttiling":
+            pagination_model = TextTiling_RAModel_Pagination()
+        else:
+            pagination_model = OpenAI_RAModel_Pagination(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
+        gisting_model = OpenAI_RAModel_Gisting(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
+        lookup_model = OpenAI_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
+        qa_model = OpenAI_QAModel_MultipleChoice(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
 
         # Initialize ReadAgent
-        readAgent = ReadAgent(pagination_model, gisting_model, lookup_model, qa_model)
+        readAgent = ReadAgent(pagination_model, gisting_model, lookup_model, qa_model, sentence_splitter=sentence_splitter)
 
         logging.info(f"Processing document {doc_id}...")
 
         # Extract document context
         document_context = doc_data['article']
 
-        readAgent.create_pages(document_context)
-        readAgent.save_pages(f"{STORED_PAGES_FOLDER_PATH}/{doc_id}.json")
-        
-        readAgent.shorten_pages()
-        readAgent.save_shortened_pages(f"{STORED_SHORTENED_PAGES_FOLDER_PATH}/{doc_id}.json")
+        if os.path.exists(pages_path):
+            # pagination of an interrupted run already finished, only the gists are missing
+            readAgent.load_pages(pages_path)
+            readAgent.shorten_pages(max_workers=GISTING_MAX_WORKERS)
+        elif PIPELINED_GISTING:
+            readAgent.create_and_shorten_pages(document_context, max_workers=GISTING_MAX_WORKERS, checkpoint_path=checkpoint_path)
+            readAgent.save_pages(pages_path)
+        else:
+            readAgent.create_pages(document_context, checkpoint_path=checkpoint_path)
+            readAgent.save_pages(pages_path)
+            
+            readAgent.shorten_pages(max_workers=GISTING_MAX_WORKERS)
+        readAgent.save_shortened_pages(shortened_pages_path)
 
         logging.info(f"Finished creating pages and shortened_pages for document {doc_id}.")
 
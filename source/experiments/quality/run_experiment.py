@@ -1,21 +1,30 @@
 import logging
 from source.method.ReadAgent import ReadAgent
-from source.method.QAModels import OpenAI_QAModel_MultipleChoice
-from source.method.RAModels import OpenAI_RAModel_Pagination, OpenAI_RAModel_Gisting, OpenAI_RAModel_Lookup
-
-from source.experiments.utils import save_jsonl, log_error, create_directories, load_json_file, load_jsonl_file, extract_number
+from source.method.AsyncReadAgent import AsyncReadAgent
+from source.method.QAModels import OpenAI_QAModel_MultipleChoice, AsyncOpenAI_QAModel_MultipleChoice
+from source.method.RAModels import OpenAI_RAModel_Pagination, OpenAI_RAModel_Gisting, OpenAI_RAModel_Lookup, BM25_RAModel_Lookup, Hybrid_RAModel_Lookup, AsyncOpenAI_RAModel_Pagination, AsyncOpenAI_RAModel_Gisting, AsyncOpenAI_RAModel_Lookup, AsyncBM25_RAModel_Lookup, AsyncHybrid_RAModel_Lookup
+from source.method.ResponseCache import ResponseCache
+from source.method.RateLimiter import configure_rate_limiter
+from source.method.Metrics import configure_metrics, advance_progress
+from source.method.Tracing import configure_tracing, trace_span
+from source.method.RetryPolicy import is_permanent_error
+
+from source.experiments.scheduler import QuestionScheduler, run_documents_async
+from source.experiments.jsonl_sink import JsonlSink
+from source.experiments.utils import save_jsonl, log_error, create_directories, load_json_file, load_jsonl_file, load_completed_question_ids, extract_number
 from datetime import datetime
 from config import OPENAI_API_KEY
 import os
+import asyncio
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
 
 # Constant Paths for precreated pages and shortened pages
 STORED_PAGES_FOLDER_PATH = "experiments/artifacts/pages/quality/dev/2025-04-07_14-44-readagent-precreate-pages_gpt4o-mini-Quality_dev"
 STORED_SHORTENED_PAGES_FOLDER_PATH = "experiments/artifacts/shortened_pages/quality/dev/2025-04-07_14-44-readagent-precreate-pages_gpt4o-mini-Quality_dev"
+PAGE_STORE_PATH = None # packed store of the precreated pages (python -m source.method.PageStore <pages folder> <shortened pages folder> <store folder>), used instead of the two folders above
+LAZY_PAGE_CACHE_SIZE = 16 # with a PAGE_STORE_PATH, full pages are decoded only when looked up, keeping this many per document; None decodes all pages up front
 STORED_ANSWERS_PATH = "experiments/artifacts/answers/quality/dev"
 PREPROCESSED_DATA_PATH = "data/quality/preprocessed/QuALITY.v1.0.1.htmlstripped_dev_preprocessed.json"
 LOG_DIR = "experiments/logs/"
@@ -23,12 +32,37 @@ LOG_DIR = "experiments/logs/"
 # Parameters
 #OPENAI_MODELSTRING = "gpt-4o-2024-11-20"
 OPENAI_MODELSTRING = "gpt-4o-mini-2024-07-18"
+OPENAI_BASE_URL = None # e.g. "http://127.0.0.1:8000/v1" for the local fake server (python -m source.benchmarks.fake_openai_server); None uses the OpenAI API or the OPENAI_BASE_URL environment variable
+RESPONSE_CACHE_PATH = None # e.g. "experiments/cache/responses.sqlite", identical prompts are then answered from this cache instead of the model (with zero token usage); None measures every call
+RATE_LIMIT_RPM = None # requests per minute of your OpenAI quota, shared by all threads; None disables client-side rate limiting
+RATE_LIMIT_TPM = None # tokens per minute of your OpenAI quota
+METRICS_PATH = None # e.g. "experiments/metrics/run.prom" (Prometheus text file) or "experiments/metrics/run.json" (JSON snapshot), rewritten on every progress line; None disables the export
+METRICS_INTERVAL = 60 # seconds between two progress lines with call counts, latencies, tokens/s and ETA; None disables the metrics unless METRICS_PATH is set
+TRACE_PATH = None # e.g. "experiments/traces/run.json", Chrome trace of documents, questions, model calls, API requests and retry waits for https://ui.perfetto.dev or chrome://tracing; None disables tracing
+USE_ASYNC = False # run all documents and questions in one asyncio event loop (AsyncOpenAI) instead of a thread pool
+MAX_IN_FLIGHT_REQUESTS = 200 # upper bound of concurrent API requests in async mode
+MAX_DOCUMENTS_IN_FLIGHT = 8 # documents loaded and answered at the same time in async mode, the others wait in dataset order
+RESUME_RUN_DATE_TIME = None # "%Y-%m-%d_%H-%M" date of an interrupted run, its answer files are continued and answered questions skipped
+MAX_WORKERS = None # threads answering questions in the threaded mode, None for the ThreadPoolExecutor default; 1 runs sequentially
+LOOKUP_BACKEND = "openai" # "openai" (LLM lookup over the whole gist memory), "bm25" (local BM25 page ranking, no API call) or "hybrid" (LLM lookup over the gists of the best BM25 pages)
+BM25_INDEX_ON = "pages" # what the bm25 and hybrid lookups rank, "pages" (full pages) or "gists"
+HYBRID_CANDIDATE_PAGES = 20 # gists shown to the LLM by the hybrid lookup
 
 # Load the API key into the environment
 os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
 
+def remove_answered_questions(grouped_data, completed_question_ids):
+    """Copy of the dataset without the questions whose answers are already stored."""
+    return {
+        doc_id: {**doc_data, 'questions': {
+            set_unique_id: [questionContent for questionContent in questions if questionContent['question_unique_id'] not in completed_question_ids]
+            for set_unique_id, questions in doc_data['questions'].items()
+        }}
+        for doc_id, doc_data in grouped_data.items()
+    }
+
 def run_experiment_for_all_docs(experiment_identifier, hyperparams):
-    current_date_time = datetime.now().strftime("%Y-%m-%d_%H-%M")
+    current_date_time = RESUME_RUN_DATE_TIME or datetime.now().strftime("%Y-%m-%d_%H-%M")
     stored_answers_file = f"{STORED_ANSWERS_PATH}/{current_date_time}-{experiment_identifier}.jsonl"
     stored_errors_file = f"{STORED_ANSWERS_PATH}/{current_date_time}-{experiment_identifier}_ERRORS.jsonl"
     
@@ -46,7 +80,7 @@ def run_experiment_for_all_docs(experiment_identifier, hyperparams):
         logger.handlers.clear()
 
     # File handler
-    file_handler = logging.FileHandler(log_file, mode="w")  # Write logs to file
+    file_handler = logging.FileHandler(log_file, mode="a" if RESUME_RUN_DATE_TIME else "w")  # Write logs to file, appending when resuming
     file_handler.setLevel(logging.INFO)  # Set log level for the file handler
     file_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
     file_handler.setFormatter(file_formatter)
@@ -64,106 +98,213 @@ def run_experiment_for_all_docs(experiment_identifier, hyperparams):
     # Load preprocessed dataset
     grouped_data = load_json_file(PREPROCESSED_DATA_PATH)
 
-    openAI_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"], max_retries=0)
+    # Only questions without a stored answer are scheduled, when resuming an interrupted run
+    completed_question_ids = load_completed_question_ids(stored_answers_file)
+    if completed_question_ids:
+        logging.info(f"Resuming {stored_answers_file}: skipping {len(completed_question_ids)} answered questions")
+        grouped_data = remove_answered_questions(grouped_data, completed_question_ids)
 
-    try:
-        #with ThreadPoolExecutor(max_workers=1) as executor: #optionally control amount of parallelity
-        with ThreadPoolExecutor() as executor:
-            logging.info("Using multithreaded Precreate_Pages")
-            futures = [
-                executor.submit(
-                    run_experiment_for_doc,
-                    doc_id,
-                    doc_data,
-                    openAI_client,
-                    hyperparams,
-                    stored_answers_file, 
-                    stored_errors_file
-                )
-                for doc_id, doc_data in grouped_data.items()
-            ]
+    openAI_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL, max_retries=0)
 
-            for future in as_completed(futures):
-                # check if a thread fails with exception
-                exception = future.exception()
-                if exception:
-                    logging.error(f"Error in page creation for a document: {exception}")
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH else None
+    configure_rate_limiter(RATE_LIMIT_RPM, RATE_LIMIT_TPM)
+    metrics = configure_metrics(METRICS_PATH, METRICS_INTERVAL)
+    tracer = configure_tracing(TRACE_PATH)
+    if metrics is not None:
+        metrics.set_total("questions", sum(len(questions) for doc_data in grouped_data.values() for questions in doc_data['questions'].values()))
+    results_sink = JsonlSink() # answers and errors are written in batches by one writer thread
 
-                    # Propagate the exception
-                    raise exception
+    try:
+        if USE_ASYNC:
+            logging.info(f"Using asyncio run_experiment with up to {MAX_IN_FLIGHT_REQUESTS} requests in flight")
+            asyncio.run(run_experiment_for_all_docs_async(grouped_data, hyperparams, stored_answers_file, stored_errors_file, response_cache, results_sink))
+        else:
+            logging.info("Using multithreaded run_experiment, one task per question")
+            scheduler = QuestionScheduler(max_workers=MAX_WORKERS)
+            scheduler.run(
+                ((doc_id, [questionContent for questions in doc_data['questions'].values() for questionContent in questions])
+                 for doc_id, doc_data in grouped_data.items()),
+                load_document=lambda doc_id: load_read_agent(doc_id, openAI_client, response_cache),
+                answer_question=lambda readAgent, doc_id, questionContent: run_experiment_for_question(
+                    readAgent, doc_id, questionContent, hyperparams, stored_answers_file, stored_errors_file, results_sink
+                )
+            )
 
     except Exception as e:
         logging.exception(f"While running experiments the following error ocurred: {e}")
 
+    results_sink.close()
+
+    if response_cache is not None:
+        logging.info(f"Response cache: {response_cache.stats()}")
+        response_cache.close()
+
+    if metrics is not None:
+        metrics.close()
+
+    if tracer is not None:
+        tracer.close()
+
     logging.info(f"Experiment {experiment_identifier} completed.")
 
-def run_experiment_for_doc(doc_id, doc_data, openAI_client, hyperparams, stored_answers_file, stored_errors_file):
-    
+def load_precreated_pages(readAgent, doc_id):
+    """Loads the precreated pages and shortened pages of a document, from the page store if there is one."""
+    if PAGE_STORE_PATH:
+        readAgent.load_pages(PAGE_STORE_PATH, doc_id=doc_id, cache_size=LAZY_PAGE_CACHE_SIZE)
+        readAgent.load_shortened_pages(PAGE_STORE_PATH, doc_id=doc_id)
+    else:
+        readAgent.load_pages(f"{STORED_PAGES_FOLDER_PATH}/{doc_id}.json")
+        readAgent.load_shortened_pages(f"{STORED_SHORTENED_PAGES_FOLDER_PATH}/{doc_id}.json")
+
+def load_read_agent(doc_id, openAI_client, response_cache=None):
+    """Creates the ReadAgent of a document, shared by the scheduled tasks of all its questions."""
+    # Initialize models
+    logging.info("Initializing models...")
+    pagination_model = OpenAI_RAModel_Pagination(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
+    gisting_model = OpenAI_RAModel_Gisting(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
+    if LOOKUP_BACKEND == "bm25":
+        lookup_model = BM25_RAModel_Lookup(index_on=BM25_INDEX_ON)
+    elif LOOKUP_BACKEND == "hybrid":
+        lookup_model = Hybrid_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, candidate_pages=HYBRID_CANDIDATE_PAGES, index_on=BM25_INDEX_ON)
+    else:
+        lookup_model = OpenAI_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
+    qa_model = OpenAI_QAModel_MultipleChoice(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache)
+
+    # Initialize ReadAgent
+    readAgent = ReadAgent(pagination_model, gisting_model, lookup_model, qa_model)
+
+    logging.info(f"Processing document {doc_id}...")
+
+    # Load precreated pages and shortened pages
+    load_precreated_pages(readAgent, doc_id)
+    logging.info(f"Loaded precreated pages and shortened_pages for document {doc_id}.")
+
+    # Compile the gist memory before the questions of the document are answered concurrently
+    readAgent.compile_memory()
+
+    return readAgent
+
+def run_experiment_for_question(readAgent, doc_id, questionContent, hyperparams, stored_answers_file, stored_errors_file, results_sink=None):
     try:
-        # Initialize models
-        logging.info("Initializing models...")
-        pagination_model = OpenAI_RAModel_Pagination(modelString=OPENAI_MODELSTRING, client=openAI_client)
-        gisting_model = OpenAI_RAModel_Gisting(modelString=OPENAI_MODELSTRING, client=openAI_client)
-        lookup_model = OpenAI_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client)
-        qa_model = OpenAI_QAModel_MultipleChoice(modelString=OPENAI_MODELSTRING, client=openAI_client)
+        with trace_span("question", "task", doc_id=doc_id, question_id=questionContent['question_unique_id']):
+            answer, looked_up_page_ids, used_tokens = readAgent.answer_question(
+                question=questionContent['question'],
+                options=questionContent['options'],
+                max_lookup_pages=hyperparams["max_lookup_pages"],
+                return_usage=True
+            )
+    except Exception as e:
+        advance_progress("questions")
+        if not is_permanent_error(e):
+            raise
+        # fails the same way on every attempt (e.g. context length exceeded), record it and move on
+        logging.error(f"Permanent error for document {doc_id}, question {questionContent['question_unique_id']}: {e}")
+        log_error(doc_id, questionContent['question_unique_id'], f"{type(e).__name__}: {e}", stored_errors_file, results_sink)
+        return
+
+    save_answer(doc_id, questionContent, answer, looked_up_page_ids, used_tokens, stored_answers_file, stored_errors_file, results_sink)
+    advance_progress("questions")
+
+async def run_experiment_for_all_docs_async(grouped_data, hyperparams, stored_answers_file, stored_errors_file, response_cache=None, results_sink=None):
+    """Async counterpart of the thread pool in run_experiment_for_all_docs: all documents and questions share one event loop, with at most MAX_DOCUMENTS_IN_FLIGHT documents loaded at a time."""
+    openAI_client = AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL, max_retries=0)
+    semaphore = asyncio.Semaphore(MAX_IN_FLIGHT_REQUESTS)
 
-        # Initialize ReadAgent
-        readAgent = ReadAgent(pagination_model, gisting_model, lookup_model, qa_model)
+    try:
+        async def run_document(doc_id, doc_data):
+            await run_experiment_for_doc_async(doc_id, doc_data, openAI_client, semaphore, hyperparams, stored_answers_file, stored_errors_file, response_cache, results_sink)
 
-        logging.info(f"Processing document {doc_id}...")
+        await run_documents_async(grouped_data.items(), run_document, MAX_DOCUMENTS_IN_FLIGHT)
+    finally:
+        await openAI_client.close()
 
-        # Load precreated pages and shortened pages
-        readAgent.load_pages(f"{STORED_PAGES_FOLDER_PATH}/{doc_id}.json")    
-        readAgent.load_shortened_pages(f"{STORED_SHORTENED_PAGES_FOLDER_PATH}/{doc_id}.json")
-        logging.info(f"Loaded precreated pages and shortened_pages for document {doc_id}.")
+async def run_experiment_for_doc_async(doc_id, doc_data, openAI_client, semaphore, hyperparams, stored_answers_file, stored_errors_file, response_cache=None, results_sink=None):
 
+    try:
+        # Initialize models
+        logging.info("Initializing async models...")
+        pagination_model = AsyncOpenAI_RAModel_Pagination(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, semaphore=semaphore)
+        gisting_model = AsyncOpenAI_RAModel_Gisting(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, semaphore=semaphore)
+        if LOOKUP_BACKEND == "bm25":
+            lookup_model = AsyncBM25_RAModel_Lookup(index_on=BM25_INDEX_ON)
+        elif LOOKUP_BACKEND == "hybrid":
+            lookup_model = AsyncHybrid_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, semaphore=semaphore, candidate_pages=HYBRID_CANDIDATE_PAGES, index_on=BM25_INDEX_ON)
+        else:
+            lookup_model = AsyncOpenAI_RAModel_Lookup(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, semaphore=semaphore)
+        qa_model = AsyncOpenAI_QAModel_MultipleChoice(modelString=OPENAI_MODELSTRING, client=openAI_client, cache=response_cache, semaphore=semaphore)
 
-        # Iterate over questions in the document
-        for set_unique_id, questions in doc_data['questions'].items():
-            logging.debug(f"Starting questions in set unique ID: {set_unique_id}")
-            for questionContent in questions:
-                options = questionContent['options']
-                question = questionContent['question']
-                question_id = questionContent['question_unique_id']
-                gold_choice = questionContent['gold_label']
-                question_hard = questionContent['difficult']
+        # Initialize ReadAgent
+        readAgent = AsyncReadAgent(pagination_model, gisting_model, lookup_model, qa_model)
 
-                # Answer the question
+        logging.info(f"Processing document {doc_id}...")
 
-                answer, looked_up_page_ids, used_input_tokens = readAgent.answer_question(
-                    question=question,
-                    options=options,
-                    max_lookup_pages=hyperparams["max_lookup_pages"]
-                )
+        # Load precreated pages and shortened pages and compile the gist memory, in a thread as both block the event loop
+        with trace_span("load_document", "task", doc_id=doc_id):
+            await asyncio.to_thread(load_precreated_pages, readAgent, doc_id)
+            await asyncio.to_thread(readAgent.compile_memory)
+        logging.info(f"Loaded precreated pages and shortened_pages for document {doc_id}.")
 
-                if isinstance(answer, str):
-                    predicted_choice = extract_number(answer)
-                    correct_choice = predicted_choice == gold_choice
-                    logging.info(
-                        f"Document ID: {doc_id}, Question ID: {question_id}, Predicted Choice: {predicted_choice}, Correct: {correct_choice}, Hard: {question_hard}"
+        async def answer_and_save(questionContent):
+            try:
+                with trace_span("question", "task", doc_id=doc_id, question_id=questionContent['question_unique_id']):
+                    answer, looked_up_page_ids, used_tokens = await readAgent.answer_question(
+                        question=questionContent['question'],
+                        options=questionContent['options'],
+                        max_lookup_pages=hyperparams["max_lookup_pages"],
+                        return_usage=True
                     )
+            except Exception as e:
+                advance_progress("questions")
+                if not is_permanent_error(e):
+                    raise
+                logging.error(f"Permanent error for document {doc_id}, question {questionContent['question_unique_id']}: {e}")
+                log_error(doc_id, questionContent['question_unique_id'], f"{type(e).__name__}: {e}", stored_errors_file, results_sink)
+                return
+            save_answer(doc_id, questionContent, answer, looked_up_page_ids, used_tokens, stored_answers_file, stored_errors_file, results_sink)
+            advance_progress("questions")
+
+        # All questions of the document are answered concurrently
+        await asyncio.gather(*(
+            answer_and_save(questionContent)
+            for questions in doc_data['questions'].values()
+            for questionContent in questions
+        ))
 
-                    # Store the answer
-                    result = {
-                        "document_id": doc_id,
-                        "question_id": question_id,
-                        "gold": gold_choice,
-                        "predicted_choice": predicted_choice,
-                        "correct_choice": correct_choice,
-                        "hard": question_hard,
-                        "predicted_answer": answer.replace("\n", " "),
-                        "looked_up_page_ids": looked_up_page_ids,
-                        "used_tokens": used_input_tokens,
-                    }
-                    save_jsonl(result, stored_answers_file)
-                    
-                else:
-                    log_error(doc_id, question_id, "No valid string answer", stored_errors_file)
-
-    except Exception as e:        
+    except Exception as e:
         logging.exception(f"Error running experiment for doc {doc_id}")
         raise e
 
+def save_answer(doc_id, questionContent, answer, looked_up_page_ids, used_tokens, stored_answers_file, stored_errors_file, results_sink=None):
+    question_id = questionContent['question_unique_id']
+    gold_choice = questionContent['gold_label']
+    question_hard = questionContent['difficult']
+
+    if isinstance(answer, str):
+        predicted_choice = extract_number(answer)
+        correct_choice = predicted_choice == gold_choice
+        logging.info(
+            f"Document ID: {doc_id}, Question ID: {question_id}, Predicted Choice: {predicted_choice}, Correct: {correct_choice}, Hard: {question_hard}"
+        )
+
+        # Store the answer
+        result = {
+            "document_id": doc_id,
+            "question_id": question_id,
+            "gold": gold_choice,
+            "predicted_choice": predicted_choice,
+            "correct_choice": correct_choice,
+            "hard": question_hard,
+            "predicted_answer": answer.replace("\n", " "),
+            "looked_up_page_ids": looked_up_page_ids,
+            "used_tokens": used_tokens["input_tokens"],
+            "output_tokens": used_tokens["output_tokens"],
+            "cached_tokens": used_tokens["cached_tokens"],
+        }
+        save_jsonl(result, stored_answers_file, results_sink)
+        
+    else:
+        log_error(doc_id, question_id, "No valid string answer", stored_errors_file, results_sink)
+
 def run_experiment_batch():
     """Run a batch of experiments with varying configurations."""
 
@@ -0,0 +1,142 @@
+import os
+import asyncio
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from source.method.Tracing import trace_span, traced_task
+
+
+class _LoadedDocument:
+    """A loaded document shared by the tasks of its questions, released when the last of them finishes."""
+
+    def __init__(self, doc_id, agent, pending):
+        self.doc_id = doc_id
+        self.agent = agent
+        self.pending = pending
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.agent = None
+                logging.debug(f"[Scheduler] released document {self.doc_id}")
+
+
+class QuestionScheduler:
+    """
+    Runs an experiment as one task per (document, question) instead of one task per document, so the questions of
+    a long document spread over all workers and the run no longer ends with a few documents answered serially.
+
+    Documents are loaded once, in dataset order, and all of their questions are queued back to back (document
+    affinity): only the documents currently being answered are held in memory, and each is dropped as soon as its
+    last question is done. Queueing blocks once max_pending questions are waiting or running (backpressure), so
+    loading never runs far ahead of answering.
+    """
+
+    def __init__(self, max_workers=None, max_pending=None):
+        """
+        Args:
+            max_workers (int): Worker threads answering questions, None for the ThreadPoolExecutor default.
+            max_pending (int): Questions queued or in flight before loading the next document blocks, defaults to 4 per worker.
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+
+    def run(self, documents, load_document, answer_question):
+        """
+        Args:
+            documents: Iterable of (doc_id, questions) pairs, questions being a list.
+            load_document (callable): load_document(doc_id) returns the agent shared by the questions of the document,
+                ready to be used by several threads (memory compiled), or None to skip the document.
+            answer_question (callable): answer_question(agent, doc_id, question) answers and stores one question.
+
+        Raises the first exception of a question or of loading a document after all other questions have run.
+        """
+        max_workers = self.max_workers or min(32, (os.cpu_count() or 1) + 4)  # ThreadPoolExecutor default
+        max_pending = self.max_pending or 4 * max_workers
+        slots = threading.BoundedSemaphore(max_pending)
+        errors = []
+
+        def collect_error(future):
+            if future.exception() is not None:
+                errors.append(future.exception())
+
+        logging.info(f"[Scheduler] answering questions with {max_workers} workers, at most {max_pending} questions queued")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for doc_id, questions in documents:
+                if not questions:
+                    continue
+
+                try:
+                    with trace_span("load_document", "task", doc_id=doc_id):
+                        agent = load_document(doc_id)
+                except Exception as e:
+                    logging.exception(f"Error loading document {doc_id}")
+                    errors.append(e)
+                    continue
+                if agent is None:
+                    continue
+
+                document = _LoadedDocument(doc_id, agent, len(questions))
+                for question in questions:
+                    slots.acquire()
+                    # the wait of the question in the executor queue is traced as a queued span
+                    future = executor.submit(traced_task(self._run_question, doc_id=doc_id), document, question, answer_question, slots)
+                    future.add_done_callback(collect_error)
+
+        if errors:
+            logging.error(f"[Scheduler] {len(errors)} task(s) failed")
+            raise errors[0]
+
+    @staticmethod
+    def _run_question(document, question, answer_question, slots):
+        try:
+            return answer_question(document.agent, document.doc_id, question)
+        except Exception:
+            logging.exception(f"Error answering a question of document {document.doc_id}")
+            raise
+        finally:
+            document.release()
+            slots.release()
+
+
+async def run_documents_async(documents, run_document, max_documents=8):
+    """
+    Async counterpart of QuestionScheduler for the asyncio runners: a pool of max_documents worker tasks takes the
+    documents in dataset order, so only the documents currently being answered are loaded and held in memory,
+    instead of all documents of the run before the first request is sent.
+
+    Args:
+        documents: Iterable of argument tuples, run_document(*arguments) is awaited once per tuple.
+        run_document (coroutine function): Loads a document and answers all of its questions.
+        max_documents (int): Documents loaded and answered at the same time.
+
+    Raises the first exception of a document after all other documents have run.
+    """
+    queue = asyncio.Queue()
+    for arguments in documents:
+        queue.put_nowait(arguments)
+    errors = []
+
+    async def worker():
+        while True:
+            try:
+                arguments = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await run_document(*arguments)
+            except Exception as e:
+                errors.append(e)
+
+    workers = max(1, min(max_documents or 1, queue.qsize()))
+    logging.info(f"[Scheduler] answering {queue.qsize()} documents with at most {workers} documents in flight")
+    await asyncio.gather(*(worker() for _ in range(workers)))
+
+    if errors:
+        logging.error(f"[Scheduler] {len(errors)} document(s) failed")
+        raise errors[0]
@@ -1,30 +1,41 @@
 import json
 import os
 import re
+import threading
 from bs4 import BeautifulSoup
 
-def save_jsonl(data, file_path):
+_append_lock = threading.Lock()
+
+def save_jsonl(data, file_path, sink=None):
     """
     Appends a single dictionary to a JSONL file.
+    With a JsonlSink the line is only queued and written in a batch by the sink's writer thread.
     """
-    with open(file_path, "a") as f:
+    if sink is not None:
+        sink.write(data, file_path)
+        return
+    with _append_lock, open(file_path, "a") as f:
         f.write(json.dumps(data) + "\n")
 
-def log_error(document_id, question_id, error_message, file_path):
+def log_error(document_id, question_id, error_message, file_path, sink=None):
     """Log errors during experiment execution."""
     error_data = {
         "documentId": document_id,
         "questionId": question_id,
         "error": error_message,
     }
-    with open(file_path, "a") as f:
-        f.write(json.dumps(error_data) + "\n")
+    save_jsonl(error_data, file_path, sink)
 
 def create_directories(paths):
     """Create directories if they don't exist."""
     for path in paths:
         os.makedirs(path, exist_ok=True)
 
+def remove_directory_if_empty(path):
+    """Remove a directory if it exists and is empty."""
+    if os.path.isdir(path) and not os.listdir(path):
+        os.rmdir(path)
+
 def load_json_file(file_path):
     """
     Load a dataset from a standard JSON file.
@@ -39,6 +50,28 @@ def load_jsonl_file(file_path):
     with open(file_path, "r") as f:
         return [json.loads(line) for line in f]
 
+def load_completed_question_ids(file_path):
+    """
+    Returns the set of question_ids already stored in an answers JSONL file, empty if the file does not exist.
+    A last line left incomplete by an interrupted run is cut off, so answers appended later start on a clean line.
+    """
+    if not os.path.exists(file_path):
+        return set()
+
+    with open(file_path, "rb") as f:
+        data = f.read()
+
+    complete_length = data.rfind(b"\n") + 1
+    if complete_length < len(data):
+        with open(file_path, "r+b") as f:
+            f.truncate(complete_length)
+
+    completed = set()
+    for line in data[:complete_length].decode("utf-8").splitlines():
+        if line.strip():
+            completed.add(json.loads(line)["question_id"])
+    return completed
+
 def extract_number(text):
     # Define the regex pattern to match a number between [[ ]]
     pattern = r'\[\[(\d+)\]\]'
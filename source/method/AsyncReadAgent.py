@@ -0,0 +1,164 @@
+import time
+import asyncio
+import logging
+
+from .ReadAgent import ReadAgent
+from .CompactPages import CompactPages, join_page
+from .ChatCompletions import add_token_usage
+from .Metrics import stage_metrics
+from source.method.utils import word_count_prefix_sums, save_pagination_checkpoint, remove_pagination_checkpoint
+
+
+class AsyncReadAgent(ReadAgent):
+    """
+    asyncio variant of ReadAgent, to be used with the AsyncOpenAI_* RA and QA models.
+    Pages, gists and questions are awaited as coroutines in one event loop, so a single process can keep
+    hundreds of requests in flight; the limit is the asyncio.Semaphore shared by the models.
+    Loading, saving and the compiled gist memory are inherited from ReadAgent.
+    """
+
+    @stage_metrics("create_pages")
+    async def create_pages( self,
+                            text: str,
+                            word_limit=600,
+                            start_threshold=280,
+                            max_retires=10,
+                            min_words_to_start_pagination = 350,
+                            allow_fallback_to_last=True,
+                            checkpoint_path=None
+                        ):
+
+        pages = []
+        async for page in self.iter_pages(text,
+                                          word_limit=word_limit,
+                                          start_threshold=start_threshold,
+                                          max_retires=max_retires,
+                                          min_words_to_start_pagination=min_words_to_start_pagination,
+                                          allow_fallback_to_last=allow_fallback_to_last,
+                                          checkpoint_path=checkpoint_path):
+            pages.append(page)
+
+        self.pages = CompactPages(pages)
+        if checkpoint_path:
+            await asyncio.to_thread(remove_pagination_checkpoint, checkpoint_path)
+
+        return self.pages
+
+    async def iter_pages(   self,
+                            text: str,
+                            word_limit=600,
+                            start_threshold=280,
+                            max_retires=10,
+                            min_words_to_start_pagination = 350,
+                            allow_fallback_to_last=True,
+                            checkpoint_path=None
+                        ):
+        """Async generator version of ReadAgent.iter_pages."""
+
+        # sentence splitting is CPU bound, keep it off the event loop
+        sentences = await asyncio.to_thread(self._split_sentences, text, word_limit)
+
+        logging.info(f"Split document into {len(sentences)} sentences.")
+        word_prefix = word_count_prefix_sums(sentences)
+
+        i = 0
+        pages = []
+        if checkpoint_path:
+            checkpoint = self._pagination_checkpoint(text, word_limit, start_threshold, min_words_to_start_pagination, allow_fallback_to_last)
+            i, pages = await asyncio.to_thread(self._restore_pagination, checkpoint_path, checkpoint, sentences)
+            for page in pages:
+                yield page
+
+        while i < len(sentences):
+            preceding, passage, end_tag, j, wcount = self._build_window(sentences, pages, i, word_limit, start_threshold, word_prefix)
+
+            pause_point = None
+            if wcount < min_words_to_start_pagination:
+                pause_point = len(sentences)
+            else:
+                response = await self.pagination_model.paginate(preceding, '\n'.join(passage), end_tag)
+
+                pause_point = self._resolve_pause_point(response, i, j, preceding, passage, end_tag, allow_fallback_to_last)
+
+            page = sentences[i:pause_point]
+            pages.append(page)
+            logging.debug(f"Paragraph {i}-{pause_point-1}: {page}")
+            i = pause_point
+            if checkpoint_path:
+                checkpoint["page_ends"].append(pause_point)
+                # the atomic write fsyncs, keep it off the event loop like the sentence split
+                await asyncio.to_thread(save_pagination_checkpoint, checkpoint, checkpoint_path)
+            yield page
+        logging.info(f"[Pagination] Done with {len(pages)} pages")
+
+    @stage_metrics("shorten_pages")
+    async def shorten_pages(self):
+
+        if not self.pages:  # Checks if list is empty
+            raise ValueError("Error: The pages array is empty.")
+
+        results = await asyncio.gather(*(self._shorten_page(i, join_page(self.pages, i)) for i in range(len(self.pages))))
+
+        self.shortened_pages = [shortened_text for shortened_text, _ in results]
+        self.gisting_latencies = [latency for _, latency in results]
+        logging.info(f"[Gisting] Shortened {len(self.shortened_pages)} pages in {sum(self.gisting_latencies):.2f}s of model time.")
+
+        return self.shortened_pages
+
+    @stage_metrics("create_and_shorten_pages")
+    async def create_and_shorten_pages(self, text: str, **pagination_kwargs):
+        """Async version of ReadAgent.create_and_shorten_pages, gisting tasks start as soon as a page is accepted."""
+        pages = []
+        tasks = []
+        async for page in self.iter_pages(text, **pagination_kwargs):
+            tasks.append(asyncio.create_task(self._shorten_page(len(pages), '\n'.join(page))))
+            pages.append(page)
+
+        results = await asyncio.gather(*tasks)
+
+        self.pages = CompactPages(pages)
+        self.shortened_pages = [shortened_text for shortened_text, _ in results]
+        self.gisting_latencies = [latency for _, latency in results]
+        if pagination_kwargs.get("checkpoint_path"):
+            await asyncio.to_thread(remove_pagination_checkpoint, pagination_kwargs["checkpoint_path"])
+        logging.info(f"[Gisting] Shortened {len(self.shortened_pages)} pages in {sum(self.gisting_latencies):.2f}s of model time (pipelined with pagination).")
+
+        return self.pages, self.shortened_pages
+
+    async def _shorten_page(self, i, page_text):
+        start = time.perf_counter()
+        shortened_text = await self.gisting_model.shorten_page(page_text)
+        latency = time.perf_counter() - start
+
+        logging.debug(f"[gist] page {i}: {shortened_text}")
+        logging.info(f"[Gisting] page {i} took {latency:.2f}s")
+
+        return shortened_text, latency
+
+    @stage_metrics("answer_question")
+    async def answer_question(self,
+        question,
+        options = None, #in case of multiple-choice
+        max_lookup_pages = 6,
+        return_usage = False
+        ):
+
+        lookupQuestion = self._lookup_question(question, options)
+
+        memory = self.compile_memory()
+
+        response, lookup_used_tokens = await self.lookup_model.lookup(memory.lookup_article, lookupQuestion, max_lookup_pages, article_tokens=memory.lookup_article_tokens)
+
+        page_ids = self._parse_lookup_response(response)
+
+        # Memory expansion after look-up, replacing the target shortened page with the original page
+        expanded_shortened_article = memory.expanded_article(page_ids)
+        logging.debug(f"Expanded shortened article: \n{expanded_shortened_article}")
+
+        answerString, qa_used_tokens = await self.qa_model.answer_question(expanded_shortened_article, question, options, context_tokens=lambda: memory.expanded_article_tokens(page_ids))
+
+        used_tokens = add_token_usage(lookup_used_tokens, qa_used_tokens)
+        if return_usage:
+            return answerString, page_ids, used_tokens
+
+        return answerString, page_ids, used_tokens["input_tokens"]
@@ -0,0 +1,199 @@
+import time
+import asyncio
+import logging
+import openai
+
+from .utils import count_tokens
+from .RateLimiter import get_rate_limiter, estimate_tokens, retry_after_seconds
+from .Metrics import get_metrics
+from .Tracing import get_tracer, trace_span
+
+
+def usage_to_dict(usage):
+    """Token usage reported by the API as a plain dict, or None if the response carried none."""
+    if usage is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+        "cached_tokens": getattr(details, "cached_tokens", None) if details is not None else None,
+    }
+
+def token_usage(response, estimate_input_tokens):
+    """
+    Tokens used by one request, {"input_tokens": int, "output_tokens": int, "cached_tokens": int}, as reported by the API.
+    Only if the response carries no usage, the input tokens are counted by estimate_input_tokens() and the output tokens
+    by encoding the (short) answer, so prompts are never re-encoded when the API counted them already.
+    :param estimate_input_tokens: Callable[[], int] - Fallback count of the prompt tokens.
+    """
+    usage = response.get("usage") or {}
+    input_tokens = usage.get("prompt_tokens")
+    output_tokens = usage.get("completion_tokens")
+    return {
+        "input_tokens": input_tokens if input_tokens is not None else estimate_input_tokens(),
+        "output_tokens": output_tokens if output_tokens is not None else count_tokens(response["content"]),
+        "cached_tokens": usage.get("cached_tokens") or 0,
+    }
+
+def prompt_token_estimate(prompt, context_tokens=None, prompt_without_context=None):
+    """
+    Fallback for token_usage. With a known token count of the context (e.g. from the per-page counts of the gist memory)
+    only the prompt around it is encoded, otherwise the whole prompt.
+    :param context_tokens: Callable[[], int] - Optional, token count of the context inserted into the prompt.
+    :param prompt_without_context: Callable[[], str] - The prompt rendered with an empty context.
+    """
+    def estimate():
+        if context_tokens is None:
+            return count_tokens(prompt)
+        return count_tokens(prompt_without_context()) + context_tokens()
+    return estimate
+
+def add_token_usage(*usages):
+    """Sum of token usages. A plain int counts as input tokens, as returned by lookup and QA models that only count those."""
+    total = {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+    for usage in usages:
+        if isinstance(usage, int):
+            usage = {"input_tokens": usage}
+        for key in total:
+            total[key] += usage.get(key, 0)
+    return total
+
+def create_chat_completion(client, modelString, messages, cache=None, **params):
+    """
+    Sends one chat completion request, the single path all RA and QA models use to reach the API.
+    :param cache: ResponseCache - Optional, identical requests (model, messages, params) are answered from it.
+    :param params: Decode parameters passed on to the API (max_tokens, temperature, seed, ...).
+    :return: dict - {"content": str, "usage": dict or None}, with "cache_hit": True and zero usage if answered from the cache.
+    """
+    metrics = get_metrics()
+    key = None
+    if cache is not None:
+        key = cache.make_key(modelString, messages, params)
+        response = cache.get(key)
+        if response is not None:
+            logging.debug(f"Response cache hit for {modelString} ({key[:12]})")
+            if metrics is not None:
+                metrics.record_cache_hit()
+            return _cached_response(response)
+
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        waited = limiter.acquire(estimate_tokens(messages, params.get("max_tokens")))
+        if metrics is not None and waited:
+            metrics.record_rate_limit_wait(waited)
+        tracer = get_tracer()
+        if tracer is not None and waited:
+            tracer.add_span("rate_limit_wait", "wait", time.perf_counter() - waited, waited)
+
+    start = time.perf_counter()
+    try:
+        with trace_span("api_request", "api", model=modelString):
+            raw_response = client.chat.completions.with_raw_response.create(
+                model=modelString,
+                messages=messages,
+                **params
+            )
+    except openai.RateLimitError as e:
+        _honour_retry_after(limiter, e)
+        if metrics is not None:
+            metrics.record_api_error(e)
+        raise
+    except Exception as e:
+        if metrics is not None:
+            metrics.record_api_error(e)
+        raise
+
+    response = _to_response(raw_response.parse())
+    if metrics is not None:
+        metrics.record_request(time.perf_counter() - start, response["usage"])
+
+    if cache is not None:
+        cache.put(key, response)
+
+    return response
+
+async def acreate_chat_completion(client, modelString, messages, cache=None, semaphore=None, **params):
+    """
+    Async version of create_chat_completion for an AsyncOpenAI client.
+    :param semaphore: asyncio.Semaphore - Optional, bounds the number of requests in flight; shared by all async models of a run.
+    :return: dict - {"content": str, "usage": dict or None}
+    """
+    metrics = get_metrics()
+    key = None
+    if cache is not None:
+        key = cache.make_key(modelString, messages, params)
+        # the SQLite lookup (and its last_access write) blocks, run it off the event loop like the write below
+        response = await asyncio.to_thread(cache.get, key)
+        if response is not None:
+            logging.debug(f"Response cache hit for {modelString} ({key[:12]})")
+            if metrics is not None:
+                metrics.record_cache_hit()
+            return _cached_response(response)
+
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        waited = await limiter.acquire_async(estimate_tokens(messages, params.get("max_tokens")))
+        if metrics is not None and waited:
+            metrics.record_rate_limit_wait(waited)
+        tracer = get_tracer()
+        if tracer is not None and waited:
+            tracer.add_span("rate_limit_wait", "wait", time.perf_counter() - waited, waited)
+
+    try:
+        if semaphore is None:
+            start = time.perf_counter()
+            with trace_span("api_request", "api", model=modelString):
+                raw_response = await client.chat.completions.with_raw_response.create(
+                    model=modelString,
+                    messages=messages,
+                    **params
+                )
+        else:
+            with trace_span("semaphore_wait", "wait"):
+                await semaphore.acquire()
+            try:
+                # the request time starts once the semaphore lets it through, waiting for it is not API latency
+                start = time.perf_counter()
+                with trace_span("api_request", "api", model=modelString):
+                    raw_response = await client.chat.completions.with_raw_response.create(
+                        model=modelString,
+                        messages=messages,
+                        **params
+                    )
+            finally:
+                semaphore.release()
+    except openai.RateLimitError as e:
+        _honour_retry_after(limiter, e)
+        if metrics is not None:
+            metrics.record_api_error(e)
+        raise
+    except Exception as e:
+        if metrics is not None:
+            metrics.record_api_error(e)
+        raise
+
+    response = _to_response(raw_response.parse())
+    if metrics is not None:
+        metrics.record_request(time.perf_counter() - start, response["usage"])
+
+    if cache is not None:
+        await asyncio.to_thread(cache.put, key, response)
+
+    return response
+
+def _honour_retry_after(limiter, exception):
+    """Pauses all callers of the shared rate limiter for the Retry-After the API sent with a 429."""
+    seconds = retry_after_seconds(exception)
+    if limiter is not None and seconds:
+        limiter.block_for(seconds)
+
+def _cached_response(response):
+    """A response answered from the cache: no tokens were spent on it, the usage stored with it is not reported again."""
+    return {**response, "usage": {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}, "cache_hit": True}
+
+def _to_response(completion):
+    return {
+        "content": completion.choices[0].message.content.strip(),
+        "usage": usage_to_dict(getattr(completion, "usage", None)),
+    }
@@ -0,0 +1,94 @@
+from array import array
+from collections.abc import Sequence
+
+
+class CompactPages(Sequence):
+    """
+    Compact List[List[str]] of the pages of one document. All sentences live in one text buffer, joined by '\n'
+    in page order, with array-based offset tables for the sentences and the pages, instead of one str object per
+    sentence. The '\n'-joined text of a page, as used for gisting and memory expansion, is a single slice of the
+    buffer. Indexing, iteration and len behave like the list of sentence lists it was built from.
+    """
+
+    __slots__ = ("_text", "_sentence_starts", "_page_starts")
+
+    def __init__(self, pages=()):
+        """
+        Args:
+            pages (Iterable[List[str]]): The pages as sentence lists.
+        """
+        sentences = []
+        # character offset of every sentence in _text, plus the end of the buffer (+1 for the missing last separator)
+        sentence_starts = array("Q", [0])
+        # sentence index of the first sentence of every page, plus the number of sentences
+        page_starts = array("Q", [0])
+
+        position = 0
+        for page in pages:
+            for sentence in page:
+                sentences.append(sentence)
+                position += len(sentence) + 1
+                sentence_starts.append(position)
+            page_starts.append(len(sentences))
+
+        self._text = '\n'.join(sentences)
+        self._sentence_starts = sentence_starts
+        self._page_starts = page_starts
+
+    def __len__(self):
+        return len(self._page_starts) - 1
+
+    def __getitem__(self, i):
+        """The sentences of page i, or a list of pages for a slice."""
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        first, end = self._page_range(i)
+        return [self.sentence(j) for j in range(first, end)]
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return len(self) == len(other) and all(self[i] == list(other[i]) for i in range(len(self)))
+        return NotImplemented
+
+    def __repr__(self):
+        return f"CompactPages({len(self)} pages, {self.sentence_count} sentences, {len(self._text)} characters)"
+
+    @property
+    def sentence_count(self):
+        return len(self._sentence_starts) - 1
+
+    def sentence(self, j):
+        """Sentence j of the document, counted over all pages."""
+        return self._text[self._sentence_starts[j]:self._sentence_starts[j + 1] - 1]
+
+    def page_text(self, i):
+        """The sentences of page i joined by '\\n', sliced from the buffer without joining."""
+        # hot path of every gisting call and memory expansion, _page_range is inlined
+        page_starts = self._page_starts
+        if i < 0:
+            i += len(page_starts) - 1
+        if i < 0 or i >= len(page_starts) - 1:
+            raise IndexError(f"Page {i} out of range for {len(self)} pages")
+        first, end = page_starts[i], page_starts[i + 1]
+        if first == end:
+            return ""
+        return self._text[self._sentence_starts[first]:self._sentence_starts[end] - 1]
+
+    def tolist(self):
+        """The pages as a plain List[List[str]], e.g. for JSON."""
+        return [self[i] for i in range(len(self))]
+
+    def _page_range(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(f"Page {i} out of range for {len(self)} pages")
+        return self._page_starts[i], self._page_starts[i + 1]
+
+
+def join_page(pages, i):
+    """The text of page i, its sentences joined by '\\n'. Uses page_text(i) of page providers that have one."""
+    page_text = getattr(pages, "page_text", None)
+    if page_text is not None:
+        return page_text(i)
+    return '\n'.join(pages[i])
@@ -0,0 +1,95 @@
+import logging
+import threading
+
+from .utils import count_tokens
+from .CompactPages import join_page
+
+
+class GistMemory:
+    def __init__(self, pages, shortened_pages, token_counts=None):
+        """
+        Compiled gist memory of one document. The lookup article and the unlabelled gist article are
+        rendered once, so answering a question only splices the looked-up pages into cached segments.
+
+        Args:
+            pages (List[List[str]]): The full pages (sentence lists) of the document. Page providers with a
+                page_text(i) method (e.g. CompactPages, LazyPages) are asked for the joined page directly.
+            shortened_pages (List[str]): The gist of every page.
+            token_counts (dict): Optional per-page token counts {"pages": List[int], "gists": List[int]}, e.g. stored
+                                 in a PageStore. Only needed if the API reports no usage, they are counted on first use otherwise.
+        """
+        if len(pages) != len(shortened_pages):
+            raise ValueError(f"Got {len(pages)} pages but {len(shortened_pages)} shortened pages.")
+
+        if token_counts is not None and not (len(token_counts["pages"]) == len(token_counts["gists"]) == len(pages)):
+            logging.warning(f"Ignoring token counts of {len(token_counts['pages'])} pages for a memory of {len(pages)} pages.")
+            token_counts = None
+        self._token_counts = token_counts
+        self._token_counts_lock = threading.Lock()
+
+        self.pages = pages
+        self.shortened_pages = shortened_pages
+
+        # gist memory with page ids, as shown to the lookup model
+        self.lookup_article = '\n'.join("<Page {}>\n".format(i) + shortened_text for i, shortened_text in enumerate(shortened_pages))
+
+        # gist memory without page ids, the base of every expanded article
+        self.gist_article = '\n'.join(shortened_pages)
+
+        # character span of every gist inside gist_article
+        self.gist_starts = []
+        self.gist_ends = []
+        position = 0
+        for shortened_text in shortened_pages:
+            self.gist_starts.append(position)
+            position += len(shortened_text)
+            self.gist_ends.append(position)
+            position += 1  # '\n' separator
+
+        logging.debug(f"Compiled gist memory with {len(shortened_pages)} pages ({len(self.lookup_article)} characters).")
+
+    def __len__(self):
+        return len(self.shortened_pages)
+
+    def page_text(self, page_id):
+        """The full page page_id with its sentences joined by '\\n'."""
+        return join_page(self.pages, page_id)
+
+    def expanded_article(self, page_ids):
+        """
+        Returns the gist article with the shortened pages in page_ids replaced by their full pages.
+        Equal to '\\n'.join(expanded_shortened_pages) of the uncompiled version.
+        """
+        if not page_ids:
+            return self.gist_article
+
+        segments = []
+        position = 0
+        for page_id in sorted(set(page_ids)):
+            segments.append(self.gist_article[position:self.gist_starts[page_id]])
+            segments.append(self.page_text(page_id))
+            position = self.gist_ends[page_id]
+        segments.append(self.gist_article[position:])
+
+        return ''.join(segments)
+
+    def token_counts(self):
+        """Token counts of every full page and every gist, {"pages": List[int], "gists": List[int]}, counted once per memory."""
+        with self._token_counts_lock:
+            if self._token_counts is None:
+                self._token_counts = {
+                    "pages": [count_tokens(self.page_text(i)) for i in range(len(self))],
+                    "gists": [count_tokens(shortened_text) for shortened_text in self.shortened_pages],
+                }
+            return self._token_counts
+
+    def lookup_article_tokens(self):
+        """Token count of lookup_article, from the per-page counts plus the <Page i> headers."""
+        headers = count_tokens(''.join("<Page {}>\n".format(i) for i in range(len(self))))
+        return headers + sum(self.token_counts()["gists"])
+
+    def expanded_article_tokens(self, page_ids):
+        """Token count of expanded_article(page_ids), from the per-page counts."""
+        token_counts = self.token_counts()
+        page_ids = set(page_ids)
+        return sum(token_counts["gists"]) + sum(token_counts["pages"][i] - token_counts["gists"][i] for i in page_ids)
@@ -0,0 +1,71 @@
+import re
+import math
+import heapq
+from collections import Counter
+
+from .utils import tokenize_words
+
+PAGE_HEADER = re.compile(r"(?:^|\n)<Page (\d+)>\n") # page headers of GistMemory.lookup_article
+
+
+class BM25Index:
+    def __init__(self, texts, k1=1.5, b=0.75):
+        """
+        Okapi BM25 index over the pages (or gists) of one document, built once and queried per question.
+        Texts are tokenized with tokenize_words, like the other local models.
+
+        Args:
+            texts (Iterable[str]): One text per page, the position is the page id. Read once, so a generator works.
+            k1 (float): Term frequency saturation.
+            b (float): Strength of the page length normalization.
+        """
+        self.k1 = k1
+        self.b = b
+
+        postings = {}
+        lengths = []
+        for page_id, text in enumerate(texts):
+            tokens = tokenize_words(text)
+            lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                postings.setdefault(term, []).append((page_id, frequency))
+
+        n = len(lengths)
+        average_length = (sum(lengths) / n) if n and sum(lengths) else 1.0
+        self.size = n
+        self.postings = postings
+        self.idf = {term: math.log(1 + (n - len(entries) + 0.5) / (len(entries) + 0.5)) for term, entries in postings.items()}
+        # length part of the BM25 denominator, per page
+        self._length_norm = [k1 * (1 - b + b * length / average_length) for length in lengths]
+
+    def __len__(self):
+        return self.size
+
+    def scores(self, query):
+        """BM25 score of every page for the query text, pages without a query term score 0."""
+        scores = [0.0] * self.size
+        for term, query_frequency in Counter(tokenize_words(query)).items():
+            entries = self.postings.get(term)
+            if not entries:
+                continue
+            idf = self.idf[term]
+            for page_id, frequency in entries:
+                scores[page_id] += query_frequency * idf * frequency * (self.k1 + 1) / (frequency + self._length_norm[page_id])
+        return scores
+
+    def top_k(self, query, k):
+        """Ids of the k best scoring pages with a score above 0, best first (ties go to the lower page id)."""
+        scores = self.scores(query)
+        best = heapq.nsmallest(k, (page_id for page_id in range(self.size) if scores[page_id] > 0), key=lambda page_id: (-scores[page_id], page_id))
+        return best
+
+
+def parse_lookup_article(shortened_article):
+    """
+    Splits a lookup article ("<Page i>\\n<gist>" blocks joined by '\\n', see GistMemory) into its pages.
+    :return: (List[int], List[str]) - The page ids and the gists, in the order of the article.
+    """
+    parts = PAGE_HEADER.split(shortened_article)
+    page_ids = [int(page_id) for page_id in parts[1::2]]
+    gists = parts[2::2]
+    return page_ids, gists
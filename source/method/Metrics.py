@@ -0,0 +1,402 @@
+import os
+import json
+import time
+import bisect
+import inspect
+import logging
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+
+from .utils import hidden_tmp_path
+from .Tracing import trace_span, get_tracer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300) # upper bounds in seconds, +Inf is implied
+MODEL_KINDS = ("pagination", "gisting", "lookup", "qa") # shown in the progress line, in pipeline order
+
+# kind of the model call running in the current thread or task, so requests and retries are labelled with it
+_model_kind = contextvars.ContextVar("model_kind", default="other")
+
+
+class Histogram:
+    """Latency histogram with the fixed LATENCY_BUCKETS, like a Prometheus histogram."""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1) # per bucket, not cumulative; the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate of the q-quantile, interpolated linearly inside its bucket (histogram_quantile of Prometheus)."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+                if i == len(LATENCY_BUCKETS):
+                    return lower
+                return lower + (LATENCY_BUCKETS[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return LATENCY_BUCKETS[-1]
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "buckets": dict(zip([*map(str, LATENCY_BUCKETS), "+Inf"], self.counts)),
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99)}
+
+
+class Metrics:
+    def __init__(self, path=None, interval=None):
+        """
+        Counters, latency histograms and progress of a run, shared by every model call and ReadAgent stage of the process.
+        The model calls and stages record into the instance installed with configure_metrics; without one, recording is skipped.
+        Every interval seconds a progress line with throughput and ETA is logged and the metrics are exported to path.
+
+        Args:
+            path (str): File the metrics are written to on every report and on close, in the Prometheus text format for
+                        a .prom path (e.g. for the node_exporter textfile collector) and as a JSON snapshot otherwise.
+            interval (float): Seconds between two reports, None for reports on close only.
+        """
+        self.path = path
+        self.interval = interval
+        self.started = time.monotonic()
+
+        self._lock = threading.Lock()
+        self._counters = {} # (name, labels) -> value, labels being a sorted tuple of (key, value) pairs
+        self._histograms = {} # (name, labels) -> Histogram
+        self._progress = {} # unit -> {"done", "total", "started"}
+        self._stop = threading.Event()
+        self._thread = None
+
+        if interval:
+            self._thread = threading.Thread(target=self._report_periodically, name="MetricsReporter", daemon=True)
+            self._thread.start()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def counter(self, name, **labels):
+        """Sum of the counter name over all label sets that contain the given labels."""
+        wanted = set(labels.items())
+        with self._lock:
+            return sum(value for (counter, counter_labels), value in self._counters.items() if counter == name and wanted <= set(counter_labels))
+
+    def histogram(self, name, **labels):
+        """The histogram of name with exactly the given labels, None if nothing was observed."""
+        with self._lock:
+            return self._histograms.get((name, tuple(sorted(labels.items()))))
+
+    # Progress
+
+    def set_total(self, unit, total):
+        """Sets the number of units (e.g. "questions", "documents") the run will process; the ETA is measured from here."""
+        with self._lock:
+            self._progress[unit] = {"done": 0, "total": total, "started": time.monotonic()}
+
+    def advance(self, unit, n=1):
+        with self._lock:
+            progress = self._progress.setdefault(unit, {"done": 0, "total": None, "started": time.monotonic()})
+            progress["done"] += n
+
+    def progress(self):
+        """{unit: {"done", "total", "per_second", "eta_seconds"}}, eta_seconds being None while it cannot be estimated."""
+        now = time.monotonic()
+        with self._lock:
+            progress = {unit: dict(p) for unit, p in self._progress.items()}
+        for unit, p in progress.items():
+            elapsed = now - p.pop("started")
+            p["per_second"] = p["done"] / elapsed if elapsed > 0 else 0.0
+            p["eta_seconds"] = None
+            if p["total"] is not None and p["per_second"] > 0:
+                p["eta_seconds"] = max(0, p["total"] - p["done"]) / p["per_second"]
+        return progress
+
+    # Recording, called by the model decorators, create_chat_completion and the retry policy
+
+    def record_model_call(self, kind, model, status, seconds):
+        """One call of an RA or QA model, retries and backoff sleeps included."""
+        self.inc("readagent_model_calls_total", kind=kind, model=model or "unknown", status=status)
+        self.observe("readagent_model_call_seconds", seconds, kind=kind)
+
+    def record_request(self, seconds, usage):
+        """One API request that got a response, with the token usage the API reported."""
+        kind = _model_kind.get()
+        self.inc("readagent_api_requests_total", kind=kind, cache="miss")
+        self.observe("readagent_api_request_seconds", seconds, kind=kind)
+        for usage_key, token_type in (("prompt_tokens", "input"), ("completion_tokens", "output"), ("cached_tokens", "cached")):
+            tokens = (usage or {}).get(usage_key)
+            if tokens:
+                self.inc("readagent_tokens_total", tokens, kind=kind, type=token_type)
+
+    def record_cache_hit(self):
+        self.inc("readagent_api_requests_total", kind=_model_kind.get(), cache="hit")
+
+    def record_api_error(self, exception):
+        error = getattr(exception, "status_code", None) or type(exception).__name__
+        self.inc("readagent_api_errors_total", kind=_model_kind.get(), error=str(error))
+
+    def record_retry(self, wait_seconds):
+        """One retry of a model call by tenacity, with the time it sleeps before the next attempt."""
+        kind = _model_kind.get()
+        self.inc("readagent_retries_total", kind=kind)
+        self.inc("readagent_retry_wait_seconds_total", wait_seconds, kind=kind)
+
+    def record_rate_limit_wait(self, seconds):
+        self.inc("readagent_rate_limit_wait_seconds_total", seconds, kind=_model_kind.get())
+
+    def record_stage(self, stage, seconds):
+        self.observe("readagent_stage_seconds", seconds, stage=stage)
+
+    # Reporting
+
+    def progress_line(self):
+        """One line with progress, throughput and ETA per unit, calls and latencies per model kind, tokens and retries."""
+        elapsed = time.monotonic() - self.started
+        parts = []
+        for unit, p in self.progress().items():
+            done = f"{p['done']}/{p['total']} {unit} ({100 * p['done'] / p['total']:.1f}%)" if p["total"] else f"{p['done']} {unit}"
+            eta = f", ETA {_duration(p['eta_seconds'])}" if p["eta_seconds"] is not None else ""
+            parts.append(f"{done}, {p['per_second']:.2f}/s{eta}")
+
+        calls = []
+        for kind in MODEL_KINDS:
+            histogram = self.histogram("readagent_model_call_seconds", kind=kind)
+            if histogram is not None:
+                calls.append(f"{kind} {histogram.count} p50 {histogram.quantile(0.5):.2f}s p95 {histogram.quantile(0.95):.2f}s")
+        if calls:
+            parts.append(", ".join(calls))
+
+        input_tokens = self.counter("readagent_tokens_total", type="input")
+        output_tokens = self.counter("readagent_tokens_total", type="output")
+        parts.append(f"tokens {_si(input_tokens)} in ({_si(input_tokens / elapsed if elapsed else 0)}/s), {_si(output_tokens)} out ({_si(output_tokens / elapsed if elapsed else 0)}/s)")
+        parts.append(f"{self.counter('readagent_retries_total'):.0f} retries, {self.counter('readagent_api_errors_total'):.0f} API errors, "
+                     f"{self.counter('readagent_api_requests_total', cache='hit'):.0f} cache hits")
+
+        return f"[Metrics] {_duration(elapsed)} elapsed | " + " | ".join(parts)
+
+    def snapshot(self):
+        """All metrics as a JSON-serializable dict."""
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), **histogram.to_dict()} for (name, labels), histogram in sorted(self._histograms.items())]
+        return {
+            "timestamp": time.time(),
+            "elapsed_seconds": time.monotonic() - self.started,
+            "progress": self.progress(),
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+    def to_prometheus(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip([*map(str, LATENCY_BUCKETS), "+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+
+        lines.append("# TYPE readagent_elapsed_seconds gauge")
+        lines.append(f"readagent_elapsed_seconds {time.monotonic() - self.started}")
+        progress = self.progress()
+        for gauge, field in (("readagent_progress_done", "done"), ("readagent_progress_total", "total"), ("readagent_eta_seconds", "eta_seconds")):
+            lines.append(f"# TYPE {gauge} gauge")
+            for unit, p in progress.items():
+                if p[field] is not None:
+                    lines.append(f"{gauge}{_labels((('unit', unit),))} {p[field]}")
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, path=None):
+        """Writes the metrics to path (default self.path), atomically so a scraper never reads a partial file."""
+        path = path or self.path
+        if not path:
+            return
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_path = hidden_tmp_path(path)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.snapshot(), f, indent=4)
+        os.replace(tmp_path, path)
+
+    def report(self):
+        logging.info(self.progress_line())
+        try:
+            self.export()
+        except OSError as e:
+            logging.error(f"Error exporting metrics to {self.path}: {e}")
+
+    def _report_periodically(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def close(self):
+        """Stops the periodic reports and writes the final report and export, once."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.report()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+def _si(value):
+    for threshold, suffix in ((1e9, "G"), (1e6, "M"), (1e3, "k")):
+        if value >= threshold:
+            return f"{value / threshold:.1f}{suffix}"
+    return f"{value:.0f}"
+
+def _duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+_metrics = None
+
+def configure_metrics(path=None, interval=None):
+    """
+    Installs the process-wide metrics recorded by all RA and QA models and ReadAgent stages, or removes them if
+    both path and interval are None. A previously installed instance is closed first.
+    """
+    global _metrics
+    if _metrics is not None:
+        _metrics.close()
+    if path is None and interval is None:
+        _metrics = None
+    else:
+        _metrics = Metrics(path, interval)
+        logging.info(f"Recording metrics, reported every {interval}s" + (f" to {path}" if path else ""))
+    return _metrics
+
+def get_metrics():
+    return _metrics
+
+def advance_progress(unit, n=1):
+    """Counts n processed units (e.g. a finished question) if metrics are installed."""
+    metrics = _metrics
+    if metrics is not None:
+        metrics.advance(unit, n)
+
+
+@contextmanager
+def _model_call(kind, name, model):
+    metrics = _metrics
+    token = _model_kind.set(kind)
+    start = time.perf_counter()
+    status = "error"
+    try:
+        with trace_span(name, "model", kind=kind, model=model):
+            yield
+        status = "ok"
+    finally:
+        _model_kind.reset(token)
+        if metrics is not None:
+            metrics.record_model_call(kind, model, status, time.perf_counter() - start)
+
+@contextmanager
+def _stage(stage, name):
+    metrics = _metrics
+    start = time.perf_counter()
+    try:
+        with trace_span(name, "stage"):
+            yield
+    finally:
+        if metrics is not None:
+            metrics.record_stage(stage, time.perf_counter() - start)
+
+def model_metrics(kind):
+    """
+    Decorator of the RA and QA model calls (sync and async): counts the call and its latency, retries included,
+    and labels the API requests and retries made inside it with kind. With a tracer installed (see Tracing), the
+    call is also a span of the trace. Put it above model_retry.
+    """
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def wrapper(self, *args, **kwargs):
+                if _metrics is None and get_tracer() is None:
+                    return await function(self, *args, **kwargs)
+                with _model_call(kind, function.__name__, getattr(self, "modelString", None)):
+                    return await function(self, *args, **kwargs)
+        else:
+            @wraps(function)
+            def wrapper(self, *args, **kwargs):
+                if _metrics is None and get_tracer() is None:
+                    return function(self, *args, **kwargs)
+                with _model_call(kind, function.__name__, getattr(self, "modelString", None)):
+                    return function(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def stage_metrics(stage):
+    """
+    Decorator of the ReadAgent stages (sync and async), records their wall-clock time in readagent_stage_seconds
+    and, with a tracer installed, as a span of the trace.
+    """
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def wrapper(*args, **kwargs):
+                if _metrics is None and get_tracer() is None:
+                    return await function(*args, **kwargs)
+                with _stage(stage, function.__qualname__):
+                    return await function(*args, **kwargs)
+        else:
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if _metrics is None and get_tracer() is None:
+                    return function(*args, **kwargs)
+                with _stage(stage, function.__qualname__):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
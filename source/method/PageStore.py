@@ -0,0 +1,294 @@
+import os
+import sys
+import mmap
+import json
+import array
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+
+from .utils import load_pages_from_json, load_shortened_pages_from_json, count_tokens
+
+DATA_FILE = "data.bin" # UTF-8 texts of all sentences and gists, back to back
+OFFSETS_FILE = "offsets.bin" # uint64 byte offsets into DATA_FILE, text k spans offsets[k]:offsets[k+1]
+INDEX_FILE = "index.json" # doc_id -> position of its texts, page sizes and token counts
+FORMAT_VERSION = 1
+
+
+class PageStore:
+    """
+    Packed, read-only store of the precreated pages and gists of a whole run, replacing one pretty-printed JSON
+    file per document and artifact. The data and offset files are memory-mapped, so opening the store only parses
+    the small index and loading a document decodes just its own byte range.
+
+    Per document the store holds its sentences (page by page) followed by its gists, as consecutive texts.
+    The index also keeps the token count of every page and gist, so token accounting never has to encode them again.
+    """
+
+    _open_stores = {}
+    _open_lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Folder written by PageStore.write.
+        """
+        self.path = path
+
+        with open(os.path.join(path, INDEX_FILE), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported page store version {index.get('version')} in {path}")
+        self.documents = index["documents"]
+
+        self._data_file = open(os.path.join(path, DATA_FILE), "rb")
+        self._offsets_file = open(os.path.join(path, OFFSETS_FILE), "rb")
+        self._data = self._map(self._data_file)
+        self._offsets_map = self._map(self._offsets_file)
+        self._offsets = memoryview(self._offsets_map).cast("Q")
+
+        logging.info(f"Opened page store {path} with {len(self.documents)} documents")
+
+    @staticmethod
+    def _map(f):
+        # mmap cannot map empty files
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def open(cls, path):
+        """Returns the store at path, opened once per process and shared by all threads and documents."""
+        key = os.path.abspath(path)
+        with cls._open_lock:
+            store = cls._open_stores.get(key)
+            if store is None:
+                store = cls._open_stores[key] = cls(path)
+            return store
+
+    def __contains__(self, doc_id):
+        return doc_id in self.documents
+
+    def __len__(self):
+        return len(self.documents)
+
+    def doc_ids(self):
+        return list(self.documents)
+
+    def text(self, k):
+        """Text number k of the store."""
+        return self._data[self._offsets[k]:self._offsets[k + 1]].decode("utf-8")
+
+    def pages(self, doc_id):
+        """
+        The pages of a document as sentence lists, like load_pages_from_json.
+        :return: List[List[str]]
+        """
+        document = self._document(doc_id)
+        k = document["first"]
+        pages = []
+        for page_size in document["page_sizes"]:
+            pages.append([self.text(k + s) for s in range(page_size)])
+            k += page_size
+        return pages
+
+    def shortened_pages(self, doc_id):
+        """
+        The gists of a document, like load_shortened_pages_from_json, or None if the store has none for it.
+        :return: List[str]
+        """
+        document = self._document(doc_id)
+        if not document["has_gists"]:
+            return None
+        first_gist = document["first"] + sum(document["page_sizes"])
+        return [self.text(first_gist + i) for i in range(len(document["page_sizes"]))]
+
+    def token_counts(self, doc_id):
+        """
+        Token counts of the pages ('\n'-joined) and gists of a document, as counted when the store was written.
+        :return: dict - {"pages": List[int], "gists": List[int]}, or None for stores without gists or counts.
+        """
+        document = self._document(doc_id)
+        if "gist_tokens" not in document:
+            return None
+        return {"pages": document["page_tokens"], "gists": document["gist_tokens"]}
+
+    def lazy_pages(self, doc_id, cache_size=16):
+        """The pages of a document as a LazyPages view, decoding full pages only when they are accessed."""
+        return LazyPages(self, doc_id, cache_size)
+
+    def _document(self, doc_id):
+        try:
+            return self.documents[doc_id]
+        except KeyError:
+            raise KeyError(f"Document {doc_id} is not in page store {self.path}") from None
+
+    def close(self):
+        self._offsets.release()
+        for mapped in (self._data, self._offsets_map):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        self._data_file.close()
+        self._offsets_file.close()
+        with PageStore._open_lock:
+            if PageStore._open_stores.get(os.path.abspath(self.path)) is self:
+                del PageStore._open_stores[os.path.abspath(self.path)]
+
+    @staticmethod
+    def write(path, documents):
+        """
+        Writes a store folder. The index is written last, so an interrupted write never looks like a valid store.
+        :param documents: Iterable of (doc_id, pages, shortened_pages), shortened_pages may be None.
+        :return: int - Number of documents written.
+        """
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+        index = {}
+        offsets = array.array("Q", [0])
+        position = 0
+
+        with open(os.path.join(path, DATA_FILE), "wb") as data_file:
+            def append(text):
+                nonlocal position
+                encoded = text.encode("utf-8")
+                data_file.write(encoded)
+                position += len(encoded)
+                offsets.append(position)
+
+            for doc_id, pages, shortened_pages in documents:
+                if shortened_pages is not None and len(shortened_pages) != len(pages):
+                    raise ValueError(f"Document {doc_id} has {len(pages)} pages but {len(shortened_pages)} shortened pages.")
+
+                index[doc_id] = {
+                    "first": len(offsets) - 1,
+                    "page_sizes": [len(page) for page in pages],
+                    "has_gists": shortened_pages is not None,
+                }
+                if shortened_pages is not None:
+                    index[doc_id]["page_tokens"] = [count_tokens('\n'.join(page)) for page in pages]
+                    index[doc_id]["gist_tokens"] = [count_tokens(shortened_text) for shortened_text in shortened_pages]
+                for page in pages:
+                    for sentence in page:
+                        append(sentence)
+                for shortened_text in shortened_pages or []:
+                    append(shortened_text)
+
+        with open(os.path.join(path, OFFSETS_FILE), "wb") as offsets_file:
+            offsets.tofile(offsets_file)
+
+        with open(index_path, "w", encoding="utf-8") as f:
+            json.dump({"version": FORMAT_VERSION, "documents": index}, f)
+
+        logging.info(f"Wrote page store {path} with {len(index)} documents ({position} bytes of text)")
+        return len(index)
+
+
+class LazyPages(Sequence):
+    """
+    Read-only List[List[str]] view of the pages of one document in a PageStore. Only the index and the page
+    positions are kept in memory; a page is decoded from the mapped store when it is accessed, and the joined
+    text of the most recently used pages is kept in a small LRU cache shared by all threads of the document.
+    """
+
+    def __init__(self, store, doc_id, cache_size=16):
+        """
+        Args:
+            store (PageStore): Open store holding the document.
+            doc_id (str): Document whose pages are provided.
+            cache_size (int): Number of page texts kept decoded.
+        """
+        self.store = store
+        self.doc_id = doc_id
+        self.cache_size = cache_size
+
+        document = store._document(doc_id)
+        # text index of the first sentence of every page, plus the end of the last page
+        self._page_starts = [document["first"]]
+        for page_size in document["page_sizes"]:
+            self._page_starts.append(self._page_starts[-1] + page_size)
+
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._page_starts) - 1
+
+    def __getitem__(self, i):
+        """The sentences of page i (decoded on every access, use page_text for the joined page)."""
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        start, end = self._page_range(i)
+        return [self.store.text(k) for k in range(start, end)]
+
+    def page_text(self, i):
+        """The sentences of page i joined by '\n', as used for memory expansion, from the LRU cache if possible."""
+        start, end = self._page_range(i)
+        with self._cache_lock:
+            text = self._cache.get(start)
+            if text is not None:
+                self._cache.move_to_end(start)
+                self.hits += 1
+                return text
+
+        text = '\n'.join(self.store.text(k) for k in range(start, end))
+
+        with self._cache_lock:
+            self.misses += 1
+            self._cache[start] = text
+            self._cache.move_to_end(start)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return text
+
+    def page_texts(self):
+        """
+        The joined text of every page in order, decoded straight from the store one page at a time and not kept in
+        the LRU cache. For single passes over the whole document, e.g. building a BM25 index, that would otherwise
+        evict the pages being looked up.
+        """
+        for start, end in zip(self._page_starts, self._page_starts[1:]):
+            yield '\n'.join(self.store.text(k) for k in range(start, end))
+
+    def _page_range(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(f"Page {i} out of range for document {self.doc_id} with {len(self)} pages")
+        return self._page_starts[i], self._page_starts[i + 1]
+
+
+def convert_folders(pages_folder, shortened_pages_folder, store_path):
+    """Packs the {doc_id}.json files of a precreate run (pages and shortened pages folders) into a PageStore."""
+    doc_ids = sorted(
+        os.path.splitext(file)[0]
+        for file in os.listdir(pages_folder)
+        if file.endswith(".json") and not file.startswith(".") and os.path.isfile(os.path.join(pages_folder, file))
+    )
+
+    def documents():
+        for doc_id in doc_ids:
+            pages = load_pages_from_json(os.path.join(pages_folder, f"{doc_id}.json"))
+            if pages is None:
+                logging.error(f"Skipping document {doc_id}, its pages could not be loaded.")
+                continue
+            shortened_pages = None
+            if shortened_pages_folder and os.path.exists(os.path.join(shortened_pages_folder, f"{doc_id}.json")):
+                shortened_pages = load_shortened_pages_from_json(os.path.join(shortened_pages_folder, f"{doc_id}.json"))
+            yield doc_id, pages, shortened_pages
+
+    return PageStore.write(store_path, documents())
+
+
+if __name__ == "__main__":
+    # python -m source.method.PageStore <pages folder> <shortened pages folder> <store folder>
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if len(sys.argv) != 4:
+        print("Usage: python -m source.method.PageStore <pages folder> <shortened pages folder> <store folder>")
+        sys.exit(1)
+    convert_folders(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -1,44 +1,42 @@
 import os
 import logging
-import tiktoken
 
 from openai import OpenAI
 from abc import ABC, abstractmethod
 from .utils import buildMultipleChoiceQuestionText
-
-from tenacity import retry, stop_after_attempt, wait_exponential, after_log, before_sleep_log
+from .ChatCompletions import create_chat_completion, acreate_chat_completion, token_usage, prompt_token_estimate
+from .RetryPolicy import model_retry
+from .Metrics import model_metrics
 
 logger = logging.getLogger(__name__)
 
-tokenizer = tiktoken.get_encoding("cl100k_base")
-
 class BaseQAModel(ABC):
     @abstractmethod
-    def answer_question(self, context, question):
+    def answer_question(self, context, question, options, context_tokens=None):
+        """
+        Answers the question from the context.
+        :param context_tokens: Callable[[], int] - Optional token count of the context, only called if the API reports no usage.
+        :return: (str, dict) - The answer and its token usage, see ChatCompletions.token_usage.
+        """
         pass
 
 class OpenAI_QAModel_MultipleChoice(BaseQAModel):
-    def __init__(self, modelString, client):
+    def __init__(self, modelString, client, cache=None):
         """
         Initializes the OpenAI model with the model name set in the modelString
 
         Args:
             modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
         """
         self.modelString = modelString
         self.client = client
+        self.cache = cache
 
-    @retry(wait=wait_exponential(multiplier=1, max=60), 
-        stop=stop_after_attempt(10), 
-        before_sleep=before_sleep_log(logger, logging.INFO), 
-        after=after_log(logger, logging.INFO), 
-        reraise=True)
-    def answer_question(
-        self, context, question, options
-    ):
+    def build_prompt(self, context, question, options):
         questionAndOptions = buildMultipleChoiceQuestionText(question, options)
 
-        prompt = f'''
+        return f'''
 [Start of Context]:
 
 {context}
@@ -56,53 +54,63 @@ Based on the context provided, select the most accurate answer to the question f
 Start with a short explanation and then provide your answer as [[1]] or [[2]] or [[3]] or [[4]]. 
 For example, if you think the most accurate answer is the first option, respond with [[1]].
 '''
+
+    def build_request(self, context, question, options):
+        """Messages and decode parameters of the QA request, shared with AsyncOpenAI_QAModel_MultipleChoice."""
+        prompt = self.build_prompt(context, question, options)
+
         promptLog = f"\n\n#### Prompting {self.modelString}: ####\n\n{prompt}\n\n#### End of Prompt ####\n\n"
         logging.debug(promptLog)
 
-        used_input_tokens = len(tokenizer.encode(prompt))
-
-        response = self.client.chat.completions.create(
-            model=self.modelString,
-            messages=[
+        return {
+            "messages": [
                 {"role": "system", "content": "You are Question Answering Portal"},
                 {
                     "role": "user",
                     "content": prompt,
                 },
             ],
-            temperature=0,
-            seed = 42,
+            "temperature": 0,
+            "seed": 42,
+        }
 
-        )
-
-        answerString = response.choices[0].message.content.strip()
+    def parse_response(self, response, request, question, options, context_tokens=None):
+        """
+        :return: (str, dict) - The answer and its token usage, see ChatCompletions.token_usage.
+        """
+        prompt = request["messages"][-1]["content"]
+        answerString = response["content"]
+        used_tokens = token_usage(response, prompt_token_estimate(prompt, context_tokens, lambda: self.build_prompt("", question, options)))
         
         answerLog = f"\n\n#### {self.modelString} Response: ####\n\n{answerString}\n\n#### End of Response ####\n\n"
         logging.debug(answerLog)
         
-        return answerString, used_input_tokens
+        return answerString, used_tokens
+
+    @model_metrics("qa")
+    @model_retry(logger)
+    def answer_question(
+        self, context, question, options, context_tokens=None
+    ):
+        request = self.build_request(context, question, options)
+        response = create_chat_completion(self.client, self.modelString, cache=self.cache, **request)
+        return self.parse_response(response, request, question, options, context_tokens)
 
 class OpenAI_QAModel_Generation(BaseQAModel):
-    def __init__(self, modelString, client):
+    def __init__(self, modelString, client, cache=None):
         """
         Initializes the OpenAI model with the model name set in the modelString
 
         Args:
             modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
         """
         self.modelString = modelString
         self.client = client
+        self.cache = cache
 
-    @retry(wait=wait_exponential(multiplier=1, max=60), 
-        stop=stop_after_attempt(10), 
-        before_sleep=before_sleep_log(logger, logging.INFO), 
-        after=after_log(logger, logging.INFO), 
-        reraise=True)
-    def answer_question(
-        self, context, question, options
-    ):
-
-        prompt = f'''
+    def build_prompt(self, context, question):
+        return f'''
 [Start of Context]:
 
 {context}
@@ -122,30 +130,90 @@ class OpenAI_QAModel_Generation(BaseQAModel):
 - If the answer is **not explicitly stated** in the context, respond with: "Not found in context."
 
 '''
+
+    def build_request(self, context, question, options):
+        """Messages and decode parameters of the QA request, the options are not part of the prompt."""
+        prompt = self.build_prompt(context, question)
+
         promptLog = f"\n\n#### Prompting {self.modelString}: ####\n\n{prompt}\n\n#### End of Prompt ####\n\n"
         logging.debug(promptLog)
         #print(promptLog)
 
-        used_input_tokens = len(tokenizer.encode(prompt))
-
-        response = self.client.chat.completions.create(
-            model=self.modelString,
-            messages=[
+        return {
+            "messages": [
                 {"role": "system", "content": "You are Question Answering Portal"},
                 {
                     "role": "user",
                     "content": prompt,
                 },
             ],
-            temperature=0,
-            seed = 42,
-
-        )
+            "temperature": 0,
+            "seed": 42,
+        }
 
-        answerString = response.choices[0].message.content.strip()
+    def parse_response(self, response, request, question, options, context_tokens=None):
+        """
+        :return: (str, dict) - The answer and its token usage, see ChatCompletions.token_usage.
+        """
+        prompt = request["messages"][-1]["content"]
+        answerString = response["content"]
+        used_tokens = token_usage(response, prompt_token_estimate(prompt, context_tokens, lambda: self.build_prompt("", question)))
         
         answerLog = f"\n\n#### {self.modelString} Response: ####\n\n{answerString}\n\n#### End of Response ####\n\n"
         logging.debug(answerLog)
         #print(answerLog)
         
-        return answerString, used_input_tokens
\ No newline at end of file
+        return answerString, used_tokens
+
+    @model_metrics("qa")
+    @model_retry(logger)
+    def answer_question(
+        self, context, question, options, context_tokens=None
+    ):
+        request = self.build_request(context, question, options)
+        response = create_chat_completion(self.client, self.modelString, cache=self.cache, **request)
+        return self.parse_response(response, request, question, options, context_tokens)
+
+class AsyncOpenAI_QAModel_MultipleChoice(OpenAI_QAModel_MultipleChoice):
+    def __init__(self, modelString, client, cache=None, semaphore=None):
+        """
+        Async variant of OpenAI_QAModel_MultipleChoice for an AsyncOpenAI client.
+
+        Args:
+            modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
+            semaphore (asyncio.Semaphore): Optional limit of requests in flight, shared across models.
+        """
+        super().__init__(modelString, client, cache)
+        self.semaphore = semaphore
+
+    @model_metrics("qa")
+    @model_retry(logger)
+    async def answer_question(
+        self, context, question, options, context_tokens=None
+    ):
+        request = self.build_request(context, question, options)
+        response = await acreate_chat_completion(self.client, self.modelString, cache=self.cache, semaphore=self.semaphore, **request)
+        return self.parse_response(response, request, question, options, context_tokens)
+
+class AsyncOpenAI_QAModel_Generation(OpenAI_QAModel_Generation):
+    def __init__(self, modelString, client, cache=None, semaphore=None):
+        """
+        Async variant of OpenAI_QAModel_Generation for an AsyncOpenAI client.
+
+        Args:
+            modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
+            semaphore (asyncio.Semaphore): Optional limit of requests in flight, shared across models.
+        """
+        super().__init__(modelString, client, cache)
+        self.semaphore = semaphore
+
+    @model_metrics("qa")
+    @model_retry(logger)
+    async def answer_question(
+        self, context, question, options, context_tokens=None
+    ):
+        request = self.build_request(context, question, options)
+        response = await acreate_chat_completion(self.client, self.modelString, cache=self.cache, semaphore=self.semaphore, **request)
+        return self.parse_response(response, request, question, options, context_tokens)
@@ -1,36 +1,35 @@
 import os
+import re
+import math
+import asyncio
 import logging
-import tiktoken
+import threading
 
-from tenacity import retry, stop_after_attempt, wait_exponential, after_log, before_sleep_log
+from collections import Counter, OrderedDict
+from .utils import tokenize_words
+from .LexicalIndex import BM25Index, parse_lookup_article
+from .CompactPages import join_page
+from .ChatCompletions import create_chat_completion, acreate_chat_completion, token_usage, prompt_token_estimate
+from .RetryPolicy import model_retry
+from .Metrics import model_metrics
 
 logger = logging.getLogger(__name__)
 
-tokenizer = tiktoken.get_encoding("cl100k_base")
-
 class OpenAI_RAModel_Pagination():
-    def __init__(self, modelString, client):
+    def __init__(self, modelString, client, cache=None):
         """
         Initializes the OpenAI model with the model name set in the modelString
 
         Args:
             modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
         """
         self.modelString = modelString
         self.client = client
+        self.cache = cache
 
-    @retry(wait=wait_exponential(multiplier=1, max=60), 
-        stop=stop_after_attempt(10), 
-        before_sleep=before_sleep_log(logger, logging.INFO), 
-        after=after_log(logger, logging.INFO), 
-        reraise=True)
-    def paginate(
-        self, preceding_text, passage_text, end_tag, max_decode_steps: int = 512
-    ):
-        """
-        Generates Answers to specified multiple choice questions and options optimized for QuALITY benchmark.
-        """
-        pagination_prompt = f"""
+    def build_prompt(self, preceding_text, passage_text, end_tag):
+        return f"""
 You are given a passage that is taken from a larger meeting transcript.
 There are some numbered labels between the paragraphs (like <0>) in the passage.
 Please choose one label at a natural transition in the passage.
@@ -49,51 +48,145 @@ Passage:
 # passage_text: a chunk of text.
 # end_tag: a string, whose value is "" if the text is at the end of the article, and otherwise "\n...".
 
+    def build_request(self, preceding_text, passage_text, end_tag, max_decode_steps: int = 512):
+        """Messages and decode parameters of the pagination request, shared with AsyncOpenAI_RAModel_Pagination."""
+        pagination_prompt = self.build_prompt(preceding_text, passage_text, end_tag)
 
         promptLog = f"\n\n#### Prompting {self.modelString}: ####\n\n{pagination_prompt}\n\n#### End of Prompt ####\n\n"
         logging.debug(promptLog)
 
-        raw_response = self.client.chat.completions.with_raw_response.create(
-            model=self.modelString,
-            max_tokens=max_decode_steps,
-            temperature=0,
-            seed = 42,
-            messages=[
+        return {
+            "messages": [
               {'role': 'user', 'content': pagination_prompt},
-            ]
-          )
-
-        completion = raw_response.parse()    
-        answerString = completion.choices[0].message.content.strip()
+            ],
+            "max_tokens": max_decode_steps,
+            "temperature": 0,
+            "seed": 42,
+        }
+
+    def parse_response(self, response):
+        answerString = response["content"]
         
         answerLog = f"\n\n#### {self.modelString} Response: ####\n\n{answerString}\n\n#### End of Response ####\n\n"
         logging.debug(answerLog)
         
         return answerString
 
+    @model_metrics("pagination")
+    @model_retry(logger)
+    def paginate(
+        self, preceding_text, passage_text, end_tag, max_decode_steps: int = 512
+    ):
+        """
+        Generates Answers to specified multiple choice questions and options optimized for QuALITY benchmark.
+        """
+        request = self.build_request(preceding_text, passage_text, end_tag, max_decode_steps)
+        response = create_chat_completion(self.client, self.modelString, cache=self.cache, **request)
+        return self.parse_response(response)
+
+class TextTiling_RAModel_Pagination():
+    def __init__(self, window_words=100):
+        """
+        Local drop-in for OpenAI_RAModel_Pagination that picks the pause point without any API call.
+        Every numbered label in the passage is scored TextTiling-style by the lexical cohesion of the
+        words before and after it; the label at the deepest cohesion valley is chosen.
+
+        Args:
+            window_words (int): Number of content words compared on each side of a label.
+        """
+        self.modelString = "texttiling"
+        self.window_words = window_words
+
+    @model_metrics("pagination")
+    def paginate(
+        self, preceding_text, passage_text, end_tag, max_decode_steps: int = 512
+    ):
+        """
+        Chooses a label of the passage, answering in the same form as the LLM paginator ("<57>\n Because ...").
+        """
+        # re.split with a capturing group alternates text blocks and label numbers:
+        # [block_0, label_1, block_1, ..., label_n, block_n]
+        parts = re.split(r"\n<(\d+)>(?=\n|$)", passage_text)
+        blocks = [tokenize_words(block) for block in parts[0::2]]
+        labels = [int(label) for label in parts[1::2]]
+
+        if not labels:
+            return "No label found in passage."
+
+        blocks[0] = tokenize_words(preceding_text) + blocks[0]
+        if end_tag:
+            blocks[-1] = blocks[-1] + tokenize_words(end_tag)
+
+        similarities = []
+        for gap in range(1, len(blocks)):
+            before = self._window(blocks[gap - 1::-1], reverse=True)
+            after = self._window(blocks[gap:], reverse=False)
+            if not after and not end_tag:
+                # the last label closes the document, which is a perfect transition
+                similarities.append(0.0)
+            else:
+                similarities.append(self._cosine(Counter(before), Counter(after)))
+
+        depths = self._depth_scores(similarities)
+
+        # deepest valley wins, ties go to the lower similarity and then to the later label
+        best = max(range(len(labels)), key=lambda k: (depths[k], -similarities[k], k))
+        answerString = f"<{labels[best]}>\n Because the lexical cohesion drops to {similarities[best]:.3f} at this label (depth {depths[best]:.3f})."
+
+        answerLog = f"\n\n#### {self.modelString} Response: ####\n\n{answerString}\n\n#### End of Response ####\n\n"
+        logging.debug(answerLog)
+
+        return answerString
+
+    def _window(self, blocks, reverse):
+        words = []
+        for block in blocks:
+            words.extend(reversed(block) if reverse else block)
+            if len(words) >= self.window_words:
+                break
+        return words[:self.window_words]
+
+    @staticmethod
+    def _cosine(a, b):
+        if not a or not b:
+            return 0.0
+        dot = sum(count * b[word] for word, count in a.items() if word in b)
+        norm = math.sqrt(sum(c * c for c in a.values())) * math.sqrt(sum(c * c for c in b.values()))
+        return dot / norm
+
+    @staticmethod
+    def _depth_scores(similarities):
+        """TextTiling depth score: how far a gap lies below the highest peaks reached by climbing to either side."""
+        depths = []
+        for k, similarity in enumerate(similarities):
+            left = similarity
+            for previous in reversed(similarities[:k]):
+                if previous < left:
+                    break
+                left = previous
+            right = similarity
+            for following in similarities[k + 1:]:
+                if following < right:
+                    break
+                right = following
+            depths.append((left - similarity) + (right - similarity))
+        return depths
+
 class OpenAI_RAModel_Gisting():
-    def __init__(self, modelString, client):
+    def __init__(self, modelString, client, cache=None):
         """
         Initializes the OpenAI model with the model name set in the modelString
 
         Args:
             modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
         """
         self.modelString = modelString
         self.client = client
+        self.cache = cache
 
-    @retry(wait=wait_exponential(multiplier=1, max=60), 
-        stop=stop_after_attempt(10), 
-        before_sleep=before_sleep_log(logger, logging.INFO), 
-        after=after_log(logger, logging.INFO), 
-        reraise=True)
-    def shorten_page(
-        self, page, max_decode_steps: int = 512
-    ):
-        """
-        Generates Answers to specified multiple choice questions and options optimized for QuALITY benchmark.
-        """
-        shorten_prompt = f"""
+    def build_prompt(self, page):
+        return f"""
 Please shorten the following passage.
 Just give me a shortened version. DO NOT explain your reason.
 
@@ -101,55 +194,57 @@ Passage:
 {page}
 
 """
-# preceding_text: a fraction of previous context
-# passage_text: a chunk of text.
-# end_tag: a string, whose value is "" if the text is at the end of the article, and otherwise "\n...".
-
+    def build_request(self, page, max_decode_steps: int = 512):
+        """Messages and decode parameters of the gisting request."""
+        shorten_prompt = self.build_prompt(page)
 
         promptLog = f"\n\n#### Prompting {self.modelString}: ####\n\n{shorten_prompt}\n\n#### End of Prompt ####\n\n"
         logging.debug(promptLog)
 
-        raw_response = self.client.chat.completions.with_raw_response.create(
-            model=self.modelString,
-            max_tokens=max_decode_steps,
-            temperature=0,
-            seed = 42,
-            messages=[
+        return {
+            "messages": [
               {'role': 'user', 'content': shorten_prompt},
-            ]
-          )
-
-        completion = raw_response.parse()    
-        answerString = completion.choices[0].message.content.strip()
+            ],
+            "max_tokens": max_decode_steps,
+            "temperature": 0,
+            "seed": 42,
+        }
+
+    def parse_response(self, response):
+        answerString = response["content"]
         
         answerLog = f"\n\n#### {self.modelString} Response: ####\n\n{answerString}\n\n#### End of Response ####\n\n"
         logging.debug(answerLog)
         
         return answerString
 
+    @model_metrics("gisting")
+    @model_retry(logger)
+    def shorten_page(
+        self, page, max_decode_steps: int = 512
+    ):
+        """
+        Generates Answers to specified multiple choice questions and options optimized for QuALITY benchmark.
+        """
+        request = self.build_request(page, max_decode_steps)
+        response = create_chat_completion(self.client, self.modelString, cache=self.cache, **request)
+        return self.parse_response(response)
+
 class OpenAI_RAModel_Lookup():
-    def __init__(self, modelString, client):
+    def __init__(self, modelString, client, cache=None):
         """
         Initializes the OpenAI model with the model name set in the modelString
 
         Args:
             modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
         """
         self.modelString = modelString
         self.client = client
+        self.cache = cache
 
-    @retry(wait=wait_exponential(multiplier=1, max=60), 
-        stop=stop_after_attempt(10), 
-        before_sleep=before_sleep_log(logger, logging.INFO), 
-        after=after_log(logger, logging.INFO), 
-        reraise=True)
-    def lookup(
-        self, shortened_article, question, max_lookup_pages, max_decode_steps: int = 512
-    ):
-        """
-        Generates Answers to specified multiple choice questions and options optimized for QuALITY benchmark.
-        """
-        lookup_prompt = f"""
+    def build_prompt(self, shortened_article, question, max_lookup_pages):
+        return f"""
 The following text is what you remembered from reading an article and a multiple choice question related to it.
 You may read 1 to {max_lookup_pages} page(s) of the article again to refresh your memory to prepare yourselve for the question.
 Please respond with which page(s) you would like to read.
@@ -169,29 +264,273 @@ Question:
 Take a deep breath and tell me: Which 1 to {max_lookup_pages} page(s) would you like to read again?
 
 """
-# preceding_text: a fraction of previous context
-# passage_text: a chunk of text.
-# end_tag: a string, whose value is "" if the text is at the end of the article, and otherwise "\n...".
-
-        used_input_tokens = len(tokenizer.encode(lookup_prompt))
+    def build_request(self, shortened_article, question, max_lookup_pages, max_decode_steps: int = 512):
+        """Messages and decode parameters of the lookup request."""
+        lookup_prompt = self.build_prompt(shortened_article, question, max_lookup_pages)
 
         promptLog = f"\n\n#### Prompting {self.modelString}: ####\n\n{lookup_prompt}\n\n#### End of Prompt ####\n\n"
         logging.debug(promptLog)
 
-        raw_response = self.client.chat.completions.with_raw_response.create(
-            model=self.modelString,
-            max_tokens=max_decode_steps,
-            temperature=0,
-            seed = 42,
-            messages=[
+        return {
+            "messages": [
               {'role': 'user', 'content': lookup_prompt},
-            ]
-          )
+            ],
+            "max_tokens": max_decode_steps,
+            "temperature": 0,
+            "seed": 42,
+        }
 
-        completion = raw_response.parse()    
-        answerString = completion.choices[0].message.content.strip()
+    def parse_response(self, response, request, question, max_lookup_pages, article_tokens=None):
+        """
+        :return: (str, dict) - The response and its token usage, see ChatCompletions.token_usage.
+        """
+        lookup_prompt = request["messages"][-1]["content"]
+        answerString = response["content"]
+        used_tokens = token_usage(response, prompt_token_estimate(lookup_prompt, article_tokens, lambda: self.build_prompt("", question, max_lookup_pages)))
         
         answerLog = f"\n\n#### {self.modelString} Response: ####\n\n{answerString}\n\n#### End of Response ####\n\n"
         logging.debug(answerLog)
         
-        return answerString, used_input_tokens
\ No newline at end of file
+        return answerString, used_tokens
+
+    @model_metrics("lookup")
+    @model_retry(logger)
+    def lookup(
+        self, shortened_article, question, max_lookup_pages, max_decode_steps: int = 512, article_tokens=None
+    ):
+        """
+        Generates Answers to specified multiple choice questions and options optimized for QuALITY benchmark.
+        article_tokens (Callable[[], int]) optionally counts the tokens of shortened_article, it is only called if the API reports no usage.
+        :return: (str, dict) - The response and its token usage, see ChatCompletions.token_usage.
+        """
+        request = self.build_request(shortened_article, question, max_lookup_pages, max_decode_steps)
+        response = create_chat_completion(self.client, self.modelString, cache=self.cache, **request)
+        return self.parse_response(response, request, question, max_lookup_pages, article_tokens)
+
+
+class BM25_RAModel_Lookup():
+    def __init__(self, index_on="pages", k1=1.5, b=0.75, cache_size=8):
+        """
+        Local drop-in for OpenAI_RAModel_Lookup that ranks the pages of the article with BM25 instead of
+        asking an LLM, and answers in the same form ("I want to look up Page [7, 12] ..."). No API call is
+        made and no tokens are reported. The index of a document is built on its first question.
+
+        Args:
+            index_on (str): "pages" indexes the full pages, "gists" the shortened pages. Full pages are only known
+                            for memories compiled by ReadAgent.compile_memory, otherwise the gists are indexed.
+                            Lazy pages of a page store are decoded once to build the index, not kept decoded.
+            k1 (float): BM25 term frequency saturation.
+            b (float): BM25 length normalization.
+            cache_size (int): Number of documents whose index is kept.
+        """
+        if index_on not in ("pages", "gists"):
+            raise ValueError(f"index_on must be 'pages' or 'gists', got {index_on}")
+        self.modelString = f"bm25-{index_on}"
+        self.index_on = index_on
+        self.k1 = k1
+        self.b = b
+        self.cache_size = cache_size
+
+        self._memories = OrderedDict()
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register_memory(self, memory):
+        """Called by ReadAgent.compile_memory, makes the full pages behind memory.lookup_article available."""
+        with self._lock:
+            self._remember(self._memories, memory.lookup_article, memory)
+
+    def index(self, shortened_article):
+        """(page_ids, gists, BM25Index) of the article, position k of the index is page page_ids[k] with gist gists[k]."""
+        with self._lock:
+            entry = self._indexes.get(shortened_article)
+            if entry is not None:
+                self._indexes.move_to_end(shortened_article)
+                return entry
+
+            memory = self._memories.get(shortened_article)
+            if memory is not None:
+                page_ids = list(range(len(memory)))
+                gists = list(memory.shortened_pages)
+                if self.index_on == "pages":
+                    # LazyPages are streamed from the page store once per document, without filling their LRU cache
+                    page_texts = getattr(memory.pages, "page_texts", None)
+                    texts = page_texts() if page_texts is not None else (join_page(memory.pages, i) for i in page_ids)
+                else:
+                    texts = gists
+            else:
+                if self.index_on == "pages":
+                    logging.warning("[BM25 lookup] full pages of the article are unknown, indexing its gists")
+                page_ids, gists = parse_lookup_article(shortened_article)
+                texts = gists
+
+            entry = (page_ids, gists, BM25Index(texts, k1=self.k1, b=self.b))
+            self._remember(self._indexes, shortened_article, entry)
+            logging.info(f"[BM25 lookup] indexed {len(page_ids)} {self.index_on}")
+            return entry
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def rank(self, shortened_article, question, k):
+        """Ids of the k pages of the article that match the question best, pages without any matching word are left out."""
+        page_ids, _, index = self.index(shortened_article)
+        return [page_ids[position] for position in index.top_k(question, k)]
+
+    @model_metrics("lookup")
+    def lookup(
+        self, shortened_article, question, max_lookup_pages, max_decode_steps: int = 512, article_tokens=None
+    ):
+        """
+        Chooses the max_lookup_pages pages that match the question best.
+        """
+        chosen = self.rank(shortened_article, question, max_lookup_pages)
+
+        answerString = f"I want to look up Page {chosen} to answer the question."
+
+        answerLog = f"\n\n#### {self.modelString} Response: ####\n\n{answerString}\n\n#### End of Response ####\n\n"
+        logging.debug(answerLog)
+
+        return answerString, {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+
+
+class Hybrid_RAModel_Lookup(OpenAI_RAModel_Lookup):
+    def __init__(self, modelString, client, cache=None, candidate_pages=20, index_on="pages"):
+        """
+        LLM lookup over a prefiltered gist memory: BM25 first ranks the pages for the question and only the gists
+        of the candidate_pages best pages, with their original <Page i> ids, are put into the lookup prompt.
+        Articles with at most candidate_pages pages, or without any page matching the question, are sent whole.
+
+        Args:
+            modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
+            candidate_pages (int): Number of gists shown to the LLM.
+            index_on (str): What BM25 ranks, "pages" (full pages) or "gists", see BM25_RAModel_Lookup.
+        """
+        super().__init__(modelString, client, cache)
+        self.candidate_pages = candidate_pages
+        self.prefilter = BM25_RAModel_Lookup(index_on=index_on)
+
+    def register_memory(self, memory):
+        self.prefilter.register_memory(memory)
+
+    def prefilter_article(self, shortened_article, question):
+        """The lookup article reduced to the gists of the candidate pages, in page order."""
+        page_ids, gists, _ = self.prefilter.index(shortened_article)
+        if len(page_ids) <= self.candidate_pages:
+            return shortened_article
+
+        candidates = set(self.prefilter.rank(shortened_article, question, self.candidate_pages))
+        if not candidates:
+            return shortened_article
+
+        logging.info(f"[Hybrid lookup] prompting with {len(candidates)} of {len(page_ids)} gists")
+        return '\n'.join("<Page {}>\n".format(page_id) + gist for page_id, gist in zip(page_ids, gists) if page_id in candidates)
+
+    def lookup(
+        self, shortened_article, question, max_lookup_pages, max_decode_steps: int = 512, article_tokens=None
+    ):
+        # the token count of the whole article does not apply to the reduced one, which is short enough to encode
+        return super().lookup(self.prefilter_article(shortened_article, question), question, max_lookup_pages, max_decode_steps)
+
+class AsyncOpenAI_RAModel_Pagination(OpenAI_RAModel_Pagination):
+    def __init__(self, modelString, client, cache=None, semaphore=None):
+        """
+        Async variant of OpenAI_RAModel_Pagination for an AsyncOpenAI client.
+
+        Args:
+            modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
+            semaphore (asyncio.Semaphore): Optional limit of requests in flight, shared across models.
+        """
+        super().__init__(modelString, client, cache)
+        self.semaphore = semaphore
+
+    @model_metrics("pagination")
+    @model_retry(logger)
+    async def paginate(
+        self, preceding_text, passage_text, end_tag, max_decode_steps: int = 512
+    ):
+        request = self.build_request(preceding_text, passage_text, end_tag, max_decode_steps)
+        response = await acreate_chat_completion(self.client, self.modelString, cache=self.cache, semaphore=self.semaphore, **request)
+        return self.parse_response(response)
+
+class AsyncOpenAI_RAModel_Gisting(OpenAI_RAModel_Gisting):
+    def __init__(self, modelString, client, cache=None, semaphore=None):
+        """
+        Async variant of OpenAI_RAModel_Gisting for an AsyncOpenAI client.
+
+        Args:
+            modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
+            semaphore (asyncio.Semaphore): Optional limit of requests in flight, shared across models.
+        """
+        super().__init__(modelString, client, cache)
+        self.semaphore = semaphore
+
+    @model_metrics("gisting")
+    @model_retry(logger)
+    async def shorten_page(
+        self, page, max_decode_steps: int = 512
+    ):
+        request = self.build_request(page, max_decode_steps)
+        response = await acreate_chat_completion(self.client, self.modelString, cache=self.cache, semaphore=self.semaphore, **request)
+        return self.parse_response(response)
+
+class AsyncOpenAI_RAModel_Lookup(OpenAI_RAModel_Lookup):
+    def __init__(self, modelString, client, cache=None, semaphore=None):
+        """
+        Async variant of OpenAI_RAModel_Lookup for an AsyncOpenAI client.
+
+        Args:
+            modelName (str): The OpenAI model.
+            cache (ResponseCache): Optional persistent response cache in front of the client.
+            semaphore (asyncio.Semaphore): Optional limit of requests in flight, shared across models.
+        """
+        super().__init__(modelString, client, cache)
+        self.semaphore = semaphore
+
+    @model_metrics("lookup")
+    @model_retry(logger)
+    async def lookup(
+        self, shortened_article, question, max_lookup_pages, max_decode_steps: int = 512, article_tokens=None
+    ):
+        request = self.build_request(shortened_article, question, max_lookup_pages, max_decode_steps)
+        response = await acreate_chat_completion(self.client, self.modelString, cache=self.cache, semaphore=self.semaphore, **request)
+        return self.parse_response(response, request, question, max_lookup_pages, article_tokens)
+
+
+class AsyncBM25_RAModel_Lookup(BM25_RAModel_Lookup):
+    """Async variant of BM25_RAModel_Lookup, the ranking runs in a worker thread to keep the event loop free."""
+
+    async def lookup(
+        self, shortened_article, question, max_lookup_pages, max_decode_steps: int = 512, article_tokens=None
+    ):
+        return await asyncio.to_thread(super().lookup, shortened_article, question, max_lookup_pages, max_decode_steps, article_tokens)
+
+
+class AsyncHybrid_RAModel_Lookup(AsyncOpenAI_RAModel_Lookup):
+    def __init__(self, modelString, client, cache=None, semaphore=None, candidate_pages=20, index_on="pages"):
+        """
+        Async variant of Hybrid_RAModel_Lookup for an AsyncOpenAI client.
+
+        Args:
+            semaphore (asyncio.Semaphore): Optional limit of requests in flight, shared across models.
+            candidate_pages (int): Number of gists shown to the LLM.
+            index_on (str): What BM25 ranks, "pages" (full pages) or "gists".
+        """
+        super().__init__(modelString, client, cache, semaphore)
+        self.candidate_pages = candidate_pages
+        self.prefilter = BM25_RAModel_Lookup(index_on=index_on)
+
+    register_memory = Hybrid_RAModel_Lookup.register_memory
+    prefilter_article = Hybrid_RAModel_Lookup.prefilter_article
+
+    async def lookup(
+        self, shortened_article, question, max_lookup_pages, max_decode_steps: int = 512, article_tokens=None
+    ):
+        shortened_article = await asyncio.to_thread(self.prefilter_article, shortened_article, question)
+        return await super().lookup(shortened_article, question, max_lookup_pages, max_decode_steps)
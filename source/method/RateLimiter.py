@@ -0,0 +1,126 @@
+import time
+import asyncio
+import logging
+import threading
+
+from email.utils import parsedate_to_datetime
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        """
+        Client-side token bucket for the OpenAI quota, shared by every model call of the process.
+        Each call reserves one request and its estimated tokens before it is sent and sleeps until the
+        reservation is covered, so the run stays at the quota instead of bouncing off 429s.
+        A Retry-After from the API pauses all callers (block_for).
+
+        Args:
+            requests_per_minute (int): Request quota, None for no request limit.
+            tokens_per_minute (int): Token quota, None for no token limit.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        now = time.monotonic()
+        self._lock = threading.Lock()
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._updated = now
+        self._blocked_until = now
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _reserve(self, tokens):
+        """Takes one request and the tokens from the buckets (which may go negative) and returns how long the caller has to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            wait = max(0.0, self._blocked_until - now)
+            if self.requests_per_minute:
+                self._requests -= 1
+                if self._requests < 0:
+                    wait = max(wait, -self._requests * 60 / self.requests_per_minute)
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens * 60 / self.tokens_per_minute)
+            return wait
+
+    def acquire(self, tokens=0):
+        """Blocks the calling thread until a request with the given number of tokens fits into the quota."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            logging.debug(f"[RateLimiter] waiting {wait:.2f}s for {tokens} tokens")
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens=0):
+        """Same as acquire, for coroutines."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            logging.debug(f"[RateLimiter] waiting {wait:.2f}s for {tokens} tokens")
+            await asyncio.sleep(wait)
+        return wait
+
+    def block_for(self, seconds):
+        """Holds back all further requests for the given number of seconds, e.g. from a Retry-After header."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        logging.info(f"[RateLimiter] API asked to retry after {seconds:.2f}s, pausing all requests")
+
+
+_rate_limiter = None
+
+def configure_rate_limiter(requests_per_minute=None, tokens_per_minute=None):
+    """Installs the process-wide rate limiter used by all RA and QA models, or removes it if both limits are None."""
+    global _rate_limiter
+    if requests_per_minute is None and tokens_per_minute is None:
+        _rate_limiter = None
+    else:
+        _rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        logging.info(f"Rate limiting model calls to {requests_per_minute} requests/min and {tokens_per_minute} tokens/min")
+    return _rate_limiter
+
+def get_rate_limiter():
+    return _rate_limiter
+
+def estimate_tokens(messages, max_tokens=None):
+    """
+    Cheap token estimate of a request for the token bucket (~4 characters per token), plus the completion
+    budget, which the API also counts against the token quota.
+    """
+    characters = sum(len(message["content"]) for message in messages)
+    return characters // 4 + (max_tokens or 0)
+
+def retry_after_seconds(exception):
+    """Seconds from the Retry-After(-ms) header of an API error response, or None."""
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+    return None
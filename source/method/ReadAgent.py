@@ -9,8 +9,18 @@ import json
 
 import logging
 import os
+import time
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .QAModels import BaseQAModel
-from source.method.utils import (count_words, parse_pause_point, save_pages_to_json, load_pages_from_json, save_shortened_pages_to_json, load_shortened_pages_from_json, buildMultipleChoiceQuestionText, buildMultipleChoiceQuestionTextWithoutNumbers, safe_sentence_split)
+from .GistMemory import GistMemory
+from .PageStore import PageStore
+from .CompactPages import CompactPages, join_page
+from .ChatCompletions import add_token_usage
+from .Metrics import stage_metrics
+from .Tracing import traced_task
+from source.method.utils import (parse_pause_point, save_pages_to_json, load_pages_from_json, save_shortened_pages_to_json, load_shortened_pages_from_json, buildMultipleChoiceQuestionText, buildMultipleChoiceQuestionTextWithoutNumbers, safe_sentence_split, word_count_prefix_sums, save_pagination_checkpoint, load_pagination_checkpoint, remove_pagination_checkpoint, token_counts_path, save_token_counts, load_token_counts)
 
 #only for testing, later delete?
 from .QAModels import OpenAI_QAModel_MultipleChoice
@@ -31,44 +41,80 @@ except LookupError:
     nltk.download('punkt_tab')
 
 class ReadAgent:
-    def __init__(self, pagination_model, gisting_model, lookup_model, qa_model):    
+    def __init__(self, pagination_model, gisting_model, lookup_model, qa_model, sentence_splitter=None):    
         self.pages = []
         self.shortened_pages = []
         self.shortened_article = ""
+        self.gisting_latencies = []
+        self.memory = None
+        self.stored_token_counts = None # (shortened_pages, per-page token counts) loaded from a PageStore or a token counts file
         self.pagination_model = pagination_model
         self.gisting_model = gisting_model
         self.lookup_model = lookup_model
         self.qa_model = qa_model
+        self.sentence_splitter = sentence_splitter # optional SentenceSplitter, caches and parallelizes the sentence split
 
+    @stage_metrics("create_pages")
     def create_pages(   self, 
                         text: str,
                         word_limit=600,
                         start_threshold=280,
                         max_retires=10,
                         min_words_to_start_pagination = 350,
-                        allow_fallback_to_last=True 
+                        allow_fallback_to_last=True,
+                        checkpoint_path=None
                     ):
+        """
+        Splits the text into pages with the pagination model.
+        :param checkpoint_path: str - Optional, the pagination state is saved there after every accepted page and an
+                                existing checkpoint of the same text is resumed; it is removed once all pages exist.
+        """
+
+        pages = list(self.iter_pages(text,
+                                     word_limit=word_limit,
+                                     start_threshold=start_threshold,
+                                     max_retires=max_retires,
+                                     min_words_to_start_pagination=min_words_to_start_pagination,
+                                     allow_fallback_to_last=allow_fallback_to_last,
+                                     checkpoint_path=checkpoint_path))
+
+        self.pages = CompactPages(pages)
+        if checkpoint_path:
+            remove_pagination_checkpoint(checkpoint_path)
+        
+        return self.pages
+
+    def iter_pages( self, 
+                    text: str,
+                    word_limit=600,
+                    start_threshold=280,
+                    max_retires=10,
+                    min_words_to_start_pagination = 350,
+                    allow_fallback_to_last=True,
+                    checkpoint_path=None
+                ):
+        """
+        Generator version of create_pages, yielding every page as soon as its pause point is accepted.
+        Does not set self.pages, use create_pages or create_and_shorten_pages for that.
+        With a checkpoint_path, pages restored from the checkpoint are yielded first and the final checkpoint is
+        left in place, the caller removes it once the pages are stored.
+        """
 
         #using nltk sentences since datasets do not safely split paragraphs at \n
-        sentences = safe_sentence_split(text, word_limit)
+        sentences = self._split_sentences(text, word_limit)
 
         logging.info(f"Split document into {len(sentences)} sentences.")
+        word_prefix = word_count_prefix_sums(sentences)
 
         i = 0
         pages = []
+        if checkpoint_path:
+            checkpoint = self._pagination_checkpoint(text, word_limit, start_threshold, min_words_to_start_pagination, allow_fallback_to_last)
+            i, pages = self._restore_pagination(checkpoint_path, checkpoint, sentences)
+            yield from pages
+
         while i < len(sentences):
-            preceding = "" if i == 0 else "...\n" + '\n'.join(pages[-1])
-            passage = [sentences[i]]
-            wcount = count_words(sentences[i])
-            j = i + 1
-            while wcount < word_limit and j < len(sentences):
-                wcount += count_words(sentences[j])
-                if wcount >= start_threshold:
-                    passage.append(f"<{j}>")
-                passage.append(sentences[j])
-                j += 1
-            passage.append(f"<{j}>")
-            end_tag = "" if j == len(sentences) else sentences[j] + "\n..."
+            preceding, passage, end_tag, j, wcount = self._build_window(sentences, pages, i, word_limit, start_threshold, word_prefix)
 
             pause_point = None
             if wcount < min_words_to_start_pagination:
@@ -76,85 +122,311 @@ class ReadAgent:
             else:
                 response = self.pagination_model.paginate(preceding, '\n'.join(passage), end_tag)
                 
-                pause_point = parse_pause_point(response)
-
-                if pause_point and (pause_point <= i or pause_point > j):
-                    logging.info(f"passage:\n{passage},\nresponse:\n{response}\n")
-                    logging.info(f"i:{i} j:{j} pause_point:{pause_point}")
-                    pause_point = None
-                if pause_point is None:
-                    if allow_fallback_to_last:
-                        pause_point = j
-                    else:
-                        raise ValueError(f"preceding: {preceding}, passage: {passage}, end_tag: {end_tag}, \n\nresponse: {response}\n")
+                pause_point = self._resolve_pause_point(response, i, j, preceding, passage, end_tag, allow_fallback_to_last)
 
             page = sentences[i:pause_point]
             pages.append(page)            
             logging.debug(f"Paragraph {i}-{pause_point-1}: {page}")
             i = pause_point
+            if checkpoint_path:
+                checkpoint["page_ends"].append(pause_point)
+                save_pagination_checkpoint(checkpoint, checkpoint_path)
+            yield page
         logging.info(f"[Pagination] Done with {len(pages)} pages")
 
-        self.pages = pages
-        
-        return pages
+    @stage_metrics("split_sentences")
+    def _split_sentences(self, text, max_words):
+        if self.sentence_splitter is not None:
+            return self.sentence_splitter.split(text, max_words)
+        return safe_sentence_split(text, max_words)
+
+    def _pagination_checkpoint(self, text, word_limit, start_threshold, min_words_to_start_pagination, allow_fallback_to_last):
+        """
+        An empty checkpoint, fingerprinted so that it is only resumed for the same text, paginator and pagination settings.
+        The sync and async variant of a paginator (OpenAI_RAModel_Pagination, AsyncOpenAI_RAModel_Pagination) choose the same
+        pause points and share their checkpoints.
+        """
+        return {
+            "text_sha256": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+            "pagination_backend": type(self.pagination_model).__name__.removeprefix("Async"),
+            "pagination_model": getattr(self.pagination_model, "modelString", None),
+            "word_limit": word_limit,
+            "start_threshold": start_threshold,
+            "min_words_to_start_pagination": min_words_to_start_pagination,
+            "allow_fallback_to_last": allow_fallback_to_last,
+            "page_ends": [],
+        }
+
+    def _restore_pagination(self, checkpoint_path, checkpoint, sentences):
+        """
+        Restores the accepted pages of an interrupted pagination into the given empty checkpoint.
+        :return: (i, pages) - The sentence index to continue at and the pages accepted before it.
+        """
+        stored = load_pagination_checkpoint(checkpoint_path)
+        if stored is None:
+            return 0, []
+
+        fingerprint = [key for key in checkpoint if key != "page_ends"]
+        page_ends = stored.get("page_ends", [])
+        if any(stored.get(key) != checkpoint[key] for key in fingerprint) or page_ends != sorted(set(page_ends)) or (page_ends and page_ends[-1] > len(sentences)):
+            logging.warning(f"Pagination checkpoint {checkpoint_path} does not match the document or the pagination settings, starting over.")
+            return 0, []
 
-    def shorten_pages(self):
+        pages = []
+        i = 0
+        for pause_point in page_ends:
+            pages.append(sentences[i:pause_point])
+            i = pause_point
+        checkpoint["page_ends"] = list(page_ends)
+
+        logging.info(f"[Pagination] Resuming from checkpoint {checkpoint_path} at sentence {i} of {len(sentences)} with {len(pages)} pages")
+        return i, pages
+
+    def _build_window(self, sentences, pages, i, word_limit, start_threshold, word_prefix):
+        """
+        Builds the pagination request for the page starting at sentence i:
+        the preceding page, the labelled passage (list of lines), the end tag, the index j after the
+        window and the word count of the window.
+        word_prefix holds the word-count prefix sums of the sentences (word_count_prefix_sums), so both window
+        bounds are binary searches and no sentence is counted again when the windows of two pages overlap.
+        """
+        preceding = "" if i == 0 else "...\n" + '\n'.join(pages[-1])
+        start_words = word_prefix[i]
+
+        # the window ends after the first sentence that brings it to word_limit words, or at the end of the text
+        j = int(np.searchsorted(word_prefix, start_words + word_limit, side="left"))
+        j = min(max(j, i + 1), len(sentences))
+        # sentence m gets a label once the window words up to and including it reach start_threshold
+        labelled = int(np.searchsorted(word_prefix, start_words + start_threshold, side="left")) - 1
+        labelled = min(max(labelled, i + 1), j)
+
+        passage = sentences[i:labelled]
+        for m in range(labelled, j):
+            passage.append(f"<{m}>")
+            passage.append(sentences[m])
+        passage.append(f"<{j}>")
+        wcount = int(word_prefix[j] - start_words)
+        end_tag = "" if j == len(sentences) else sentences[j] + "\n..."
+
+        return preceding, passage, end_tag, j, wcount
+
+    def _resolve_pause_point(self, response, i, j, preceding, passage, end_tag, allow_fallback_to_last):
+        """Parses the paginator response into a pause point in (i, j], falling back to j if allowed."""
+        pause_point = parse_pause_point(response)
+
+        if pause_point and (pause_point <= i or pause_point > j):
+            logging.info(f"passage:\n{passage},\nresponse:\n{response}\n")
+            logging.info(f"i:{i} j:{j} pause_point:{pause_point}")
+            pause_point = None
+        if pause_point is None:
+            if allow_fallback_to_last:
+                pause_point = j
+            else:
+                raise ValueError(f"preceding: {preceding}, passage: {passage}, end_tag: {end_tag}, \n\nresponse: {response}\n")
+
+        return pause_point
+
+    @stage_metrics("create_and_shorten_pages")
+    def create_and_shorten_pages(self, text: str, max_workers=8, **pagination_kwargs):
+        """
+        Pipelined create_pages + shorten_pages: every page is handed to the gisting stage as soon as
+        pagination accepts it, so the gisting calls run while the sequential pagination chain continues.
+        :param max_workers: int - Maximum number of gisting calls in flight at the same time.
+        :param pagination_kwargs: Passed on to iter_pages (word_limit, start_threshold, checkpoint_path, ...).
+        """
+        pages = []
+        futures = []
+        checkpoint_path = pagination_kwargs.get("checkpoint_path")
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for i, page in enumerate(self.iter_pages(text, **pagination_kwargs)):
+                pages.append(page)
+                futures.append(executor.submit(traced_task(self._shorten_page, page=i), i, '\n'.join(page)))
+
+            results = [future.result() for future in futures]
+
+        self.pages = CompactPages(pages)
+        self.shortened_pages = [shortened_text for shortened_text, _ in results]
+        self.gisting_latencies = [latency for _, latency in results]
+        if checkpoint_path:
+            remove_pagination_checkpoint(checkpoint_path)
+        logging.info(f"[Gisting] Shortened {len(self.shortened_pages)} pages in {sum(self.gisting_latencies):.2f}s of model time "
+                     f"(pipelined with pagination, max_workers={max_workers}).")
+
+        return self.pages, self.shortened_pages
+
+    @stage_metrics("shorten_pages")
+    def shorten_pages(self, max_workers=1):
+        """
+        Gists every page with the gisting model.
+        :param max_workers: int - Maximum number of gisting calls in flight at the same time.
+                            Pages are independent of each other, so values > 1 send them concurrently;
+                            the order of the shortened pages always follows the order of the pages.
+        """
         
         if not self.pages:  # Checks if list is empty
             raise ValueError("Error: The pages array is empty.")
 
-        shortened_pages = []
-        for i, page in enumerate(self.pages):
-            shortened_text = self.gisting_model.shorten_page('\n'.join(page))
-            
-            shortened_pages.append(shortened_text)
-            logging.debug(f"[gist] page {i}: {shortened_text}")
+        shortened_pages = [None] * len(self.pages)
+        latencies = [None] * len(self.pages)
+
+        if max_workers is None or max_workers <= 1:
+            for i in range(len(self.pages)):
+                shortened_pages[i], latencies[i] = self._shorten_page(i, join_page(self.pages, i))
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(traced_task(self._shorten_page, page=i), i, join_page(self.pages, i)): i
+                    for i in range(len(self.pages))
+                }
+                for future in as_completed(futures):
+                    i = futures[future]
+                    shortened_pages[i], latencies[i] = future.result()
         
         self.shortened_pages = shortened_pages
-        logging.info(f"[Gisting] Shortened {len(shortened_pages)} pages.")
+        self.gisting_latencies = latencies
+        logging.info(f"[Gisting] Shortened {len(shortened_pages)} pages in {sum(latencies):.2f}s of model time "
+                     f"(max page {max(latencies):.2f}s, max_workers={max_workers}).")
 
         return shortened_pages
 
+    def _shorten_page(self, i, page_text):
+        start = time.perf_counter()
+        shortened_text = self.gisting_model.shorten_page(page_text)
+        latency = time.perf_counter() - start
 
-    def save_pages(self, path):
-        save_pages_to_json(self.pages, path)
+        logging.debug(f"[gist] page {i}: {shortened_text}")
+        logging.info(f"[Gisting] page {i} took {latency:.2f}s")
 
-    def load_pages(self, path):
-        self.pages = load_pages_from_json(path)
+        return shortened_text, latency
 
-    def save_shortened_pages(self, path):
-        save_shortened_pages_to_json(self.shortened_pages, path)
 
-    def load_shortened_pages(self, path):
-        self.shortened_pages = load_shortened_pages_from_json(path)
+    def save_pages(self, path):
+        save_pages_to_json([list(page) for page in self.pages], path)
+
+    @stage_metrics("load_pages")
+    def load_pages(self, path, doc_id=None, cache_size=None):
+        """
+        Loads the pages from a JSON file, or with a doc_id, from the PageStore folder at path.
+        With a cache_size the store's pages are not decoded up front: self.pages becomes a LazyPages view that
+        decodes a page when it is looked up and keeps the cache_size most recently used pages.
+        """
+        if doc_id is not None and cache_size:
+            self.pages = PageStore.open(path).lazy_pages(doc_id, cache_size)
+        elif doc_id is not None:
+            self.pages = CompactPages(PageStore.open(path).pages(doc_id))
+        else:
+            pages = load_pages_from_json(path)
+            self.pages = CompactPages(pages) if pages is not None else None
 
+    def save_shortened_pages(self, path):
+        """
+        Saves the shortened pages as JSON and, next to them (utils.token_counts_path), the token counts of the pages
+        and gists, so that runs loading the JSON artifacts do not encode every page again.
+        """
+        if self.pages is not None and len(self.pages) == len(self.shortened_pages):
+            # written first: counts without their gists file are ignored, the gists file marks the document as done
+            token_counts = GistMemory(self.pages, self.shortened_pages).token_counts()
+            save_token_counts({"gists_sha256": self._gists_sha256(self.shortened_pages), **token_counts}, token_counts_path(path))
+        save_shortened_pages_to_json(self.shortened_pages, path)
 
+    @staticmethod
+    def _gists_sha256(shortened_pages):
+        return hashlib.sha256(json.dumps(shortened_pages, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _load_token_counts(self, path):
+        """Token counts saved with the shortened pages file at path, None if missing or saved for other gists."""
+        stored = load_token_counts(token_counts_path(path))
+        if stored is None or self.shortened_pages is None:
+            return None
+        if stored.get("gists_sha256") != self._gists_sha256(self.shortened_pages):
+            logging.warning(f"Ignoring the token counts of {path}, they were saved for other shortened pages.")
+            return None
+        return {"pages": stored["pages"], "gists": stored["gists"]}
+
+    @stage_metrics("load_shortened_pages")
+    def load_shortened_pages(self, path, doc_id=None):
+        """
+        Loads the shortened pages from a JSON file, or with a doc_id, from the PageStore folder at path.
+        Token counts stored with them are used by compile_memory instead of counting the pages again.
+        """
+        if doc_id is not None:
+            store = PageStore.open(path)
+            self.shortened_pages = store.shortened_pages(doc_id)
+            self.stored_token_counts = (self.shortened_pages, store.token_counts(doc_id))
+        else:
+            self.shortened_pages = load_shortened_pages_from_json(path)
+            self.stored_token_counts = (self.shortened_pages, self._load_token_counts(path))
+
+
+    @stage_metrics("compile_memory")
+    def compile_memory(self):
+        """
+        Returns the compiled GistMemory of the current pages and shortened pages.
+        It is rebuilt only when self.pages or self.shortened_pages have been replaced since the last call.
+        """
+        memory = self.memory
+        if memory is None or memory.pages is not self.pages or memory.shortened_pages is not self.shortened_pages:
+            token_counts = None
+            if self.stored_token_counts is not None and self.stored_token_counts[0] is self.shortened_pages:
+                token_counts = self.stored_token_counts[1]
+            memory = GistMemory(self.pages, self.shortened_pages, token_counts)
+            self.memory = memory
+            self.shortened_article = memory.lookup_article
+            # local lookup models (e.g. BM25_RAModel_Lookup) index the full pages behind the lookup article
+            register_memory = getattr(self.lookup_model, "register_memory", None)
+            if register_memory is not None:
+                register_memory(memory)
+        return memory
+
+    @stage_metrics("answer_question")
     def answer_question(self,
         question,
         options = None, #in case of multiple-choice
-        max_lookup_pages = 6
+        max_lookup_pages = 6,
+        return_usage = False
         ):
+        """
+        Looks up pages of the gist memory for the question and answers it from the expanded article.
+        :param return_usage: bool - Return the token usage dict of both calls (input, output and cached tokens, see
+                             ChatCompletions.token_usage) instead of only the number of input tokens.
+        :return: (str, List[int], int or dict) - The answer, the looked up page ids and the used tokens.
+        """
 
+        lookupQuestion = self._lookup_question(question, options)
+
+        #lookup prompt, rendered once per document:
+        memory = self.compile_memory()
+        shortened_article = memory.lookup_article
+
+        # token counts of the article are only computed if the API reports no usage
+        response, lookup_used_tokens = self.lookup_model.lookup(shortened_article, lookupQuestion, max_lookup_pages, article_tokens=memory.lookup_article_tokens)
+
+        page_ids = self._parse_lookup_response(response)
+
+        # Memory expansion after look-up, replacing the target shortened page with the original page
+        expanded_shortened_article = memory.expanded_article(page_ids)
+        logging.debug(f"Expanded shortened article: \n{expanded_shortened_article}")
+
+        #prompt_answer = prompt_answer_template.format(expanded_shortened_article, q, '\n'.join(options_i))
+        answerString, qa_used_tokens = self.qa_model.answer_question(expanded_shortened_article, question, options, context_tokens=lambda: memory.expanded_article_tokens(page_ids))
+
+        used_tokens = add_token_usage(lookup_used_tokens, qa_used_tokens)
+        if return_usage:
+            return answerString, page_ids, used_tokens
+
+        return answerString, page_ids, used_tokens["input_tokens"]
+
+    def _lookup_question(self, question, options):
         #for MC baking the options into the retrievalQuestion:
         lookupQuestion = question
         if options:
             lookupQuestion = buildMultipleChoiceQuestionTextWithoutNumbers(question, options)
+        return lookupQuestion
 
-        #lookup prompt:
-        model_choices = []
-        lookup_page_ids = []
-        shortened_pages_pidx = []
-
-        for i, shortened_text in enumerate(self.shortened_pages):
-            shortened_pages_pidx.append("<Page {}>\n".format(i) + shortened_text)
-        shortened_article = '\n'.join(shortened_pages_pidx)
-
-        expanded_gist_word_counts = []
+    def _parse_lookup_response(self, response):
+        """Extracts the valid page ids from a lookup response like "I want to look up Page [7, 12] to ..."."""
         page_ids = []
 
-
-        response, lookup_used_input_tokens = self.lookup_model.lookup(shortened_article, lookupQuestion, max_lookup_pages)
-
         try: start = response.index('[')
         except ValueError: start = len(response)
         try: end = response.index(']')
@@ -172,21 +444,4 @@ class ReadAgent:
 
         logging.info(f"Model chose to look up page {page_ids}")
 
-        # Memory expansion after look-up, replacing the target shortened page with the original page
-        expanded_shortened_pages = self.shortened_pages[:]
-        if len(page_ids) > 0:
-            for page_id in page_ids:
-                expanded_shortened_pages[page_id] = '\n'.join(self.pages[page_id])
-
-        expanded_shortened_article = '\n'.join(expanded_shortened_pages)
-        logging.debug(f"Expanded shortened article: \n{expanded_shortened_article}")
-
-        #prompt_answer = prompt_answer_template.format(expanded_shortened_article, q, '\n'.join(options_i))
-        answerString, qa_used_input_tokens = self.qa_model.answer_question(expanded_shortened_article, question, options)
-
-        used_total_input_tokens = qa_used_input_tokens + lookup_used_input_tokens
-
-        return answerString, page_ids, used_total_input_tokens
-
-
-
+        return page_ids
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+
+class ResponseCache:
+    def __init__(self, path, max_size_mb=1024):
+        """
+        Persistent, content-addressed cache of model responses in a SQLite file.
+        Entries are keyed by model string, prompt messages and decode parameters, so only identical
+        requests are served from disk. One instance can be shared by all threads of a run.
+
+        Args:
+            path (str): Location of the SQLite file, parent folders are created.
+            max_size_mb (float): Upper bound for the stored responses. When it is exceeded the least
+                                 recently used entries are evicted until 90% of the bound is left.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._size_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        logging.info(f"Opened response cache {path} ({self._size_bytes / 1024 / 1024:.1f} MB)")
+
+    @staticmethod
+    def make_key(modelString, messages, params):
+        """SHA-256 over the model string, the prompt messages and the decode parameters."""
+        payload = json.dumps({"model": modelString, "messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached response for key or None."""
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        """Stores a JSON-serializable response under key and evicts old entries if the cache is too big."""
+        value = json.dumps(response, ensure_ascii=False)
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            previous = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._size_bytes += size - (previous[0] if previous else 0)
+            if self._size_bytes > self.max_size_bytes:
+                self._evict(int(self.max_size_bytes * 0.9))
+
+    def _evict(self, target_size_bytes):
+        keys = []
+        for key, size in self._connection.execute("SELECT key, size FROM responses ORDER BY last_access ASC"):
+            if self._size_bytes <= target_size_bytes:
+                break
+            keys.append((key,))
+            self._size_bytes -= size
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self.evictions += len(keys)
+        logging.info(f"Evicted {len(keys)} entries from response cache {self.path}")
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_mb": round(self._size_bytes / 1024 / 1024, 2),
+            }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
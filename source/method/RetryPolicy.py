@@ -0,0 +1,85 @@
+import time
+import logging
+import openai
+
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential, after_log, before_sleep_log
+
+from .RateLimiter import retry_after_seconds
+from .Metrics import get_metrics
+from .Tracing import get_tracer
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}  # plus every 5xx
+
+# Errors that will fail the same way on every attempt (context length exceeded, invalid request, bad key, unknown model).
+# They are raised immediately and the runners log them per question to the _ERRORS.jsonl file.
+PERMANENT_ERRORS = (
+    openai.BadRequestError,
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+    openai.NotFoundError,
+    openai.UnprocessableEntityError,
+)
+
+
+def is_retryable_error(exception):
+    """
+    True for transient API errors (429, 5xx, timeouts, dropped connections) that are worth another attempt.
+    Exceptions that do not come from the API keep the old behaviour and are retried as well.
+    """
+    if isinstance(exception, PERMANENT_ERRORS):
+        return False
+    if isinstance(exception, openai.APIStatusError):
+        return exception.status_code in RETRYABLE_STATUS_CODES or exception.status_code >= 500
+    return True
+
+def is_permanent_error(exception):
+    return not is_retryable_error(exception)
+
+
+class wait_retry_after:
+    """Tenacity wait strategy: the Retry-After the API sent with the error if there is one, else exponential backoff."""
+
+    def __init__(self, multiplier=1, max=60):
+        self.max = max
+        self.fallback = wait_exponential(multiplier=multiplier, max=max)
+
+    def __call__(self, retry_state):
+        exception = retry_state.outcome.exception() if retry_state.outcome else None
+        seconds = retry_after_seconds(exception) if exception is not None else None
+        if seconds is not None:
+            return min(seconds, self.max)
+        return self.fallback(retry_state)
+
+
+def count_retry(logger):
+    """
+    Tenacity before_sleep hook: counts the retry and its wait in the installed metrics, records the wait as a
+    retry_wait span of the installed tracer and logs it like before_sleep_log.
+    """
+    log = before_sleep_log(logger, logging.INFO)
+
+    def before_sleep(retry_state):
+        sleep = retry_state.next_action.sleep if retry_state.next_action else 0.0
+        metrics = get_metrics()
+        if metrics is not None:
+            metrics.record_retry(sleep)
+        tracer = get_tracer()
+        if tracer is not None:
+            exception = retry_state.outcome.exception() if retry_state.outcome else None
+            tracer.add_span("retry_wait", "wait", time.perf_counter(), sleep, attempt=retry_state.attempt_number,
+                            error=type(exception).__name__ if exception is not None else None)
+        log(retry_state)
+    return before_sleep
+
+
+def model_retry(logger, max_attempts=10):
+    """
+    The retry decorator of all RA and QA model calls (sync and async): up to max_attempts tries on transient
+    errors, waiting for Retry-After or exponentially up to 60s, while permanent errors are re-raised at once.
+    """
+    return retry(wait=wait_retry_after(multiplier=1, max=60),
+        stop=stop_after_attempt(max_attempts),
+        retry=retry_if_exception(is_retryable_error),
+        before_sleep=count_retry(logger),
+        after=after_log(logger, logging.INFO),
+        reraise=True)
@@ -0,0 +1,174 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import nltk
+
+from source.method.utils import hidden_tmp_path, split_long_sentences
+
+CHUNK_CHARS = 200_000 # texts longer than two chunks are split in paragraph-aligned chunks of about this size
+OVERLAP_CHARS = 2_000 # every chunk is tokenized with this much of its neighbours' text on both sides
+TRUSTED_MARGIN_CHARS = 1_000 # sentence boundaries closer than this to a chunk edge are taken from the neighbour
+
+
+_tokenizer = None
+
+def _punkt_tokenizer():
+    """The Punkt tokenizer behind nltk.tokenize.sent_tokenize, created once per process."""
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = nltk.tokenize.PunktTokenizer("english")
+    return _tokenizer
+
+def _sentence_spans(chunk, offset):
+    """Worker function: (start, end) character spans of the sentences of a chunk that starts at offset of the text."""
+    return [(offset + s, offset + e) for s, e in _punkt_tokenizer().span_tokenize(chunk)]
+
+def _sentences(text):
+    """Worker function: the sentences of the whole text."""
+    return [text[s:e] for s, e in _sentence_spans(text, 0)]
+
+
+class SentenceSplitter:
+    def __init__(self, cache_path=None, processes=None):
+        """
+        Sentence segmentation for pagination with an on-disk cache and an optional process pool.
+        Produces the same sentences as safe_sentence_split. One instance can be shared by all threads of a run.
+
+        The NLTK sentences of a text are cached by the SHA-256 of the text alone; max_words only cuts overlong
+        sentences afterwards, so re-paginating with another word_limit or start_threshold never splits again.
+        With processes, NLTK runs in worker processes and does not hold the GIL of the pagination threads.
+        Long texts are cut at paragraph breaks into chunks that are tokenized in parallel with some overlap;
+        Punkt decides every boundary from the tokens right around it, so only boundaries away from the chunk
+        edges are kept and the result equals splitting the whole text at once.
+
+        Args:
+            cache_path (str): Folder for the cached sentence lists, None disables the cache.
+            processes (int): Size of the process pool, None splits in the calling thread. The pool is forked, so
+                             the splitter has to be created before the caller starts any thread.
+        """
+        self.cache_path = cache_path
+        self.processes = processes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+        if cache_path:
+            os.makedirs(cache_path, exist_ok=True)
+
+        if processes and "fork" not in multiprocessing.get_all_start_methods():
+            logging.warning("Sentence splitter worker processes need the fork start method, splitting in the calling threads instead")
+            self.processes = processes = None
+
+        if processes:
+            # the workers are forked, which is only safe while the process has no other threads (locks held by a
+            # thread, e.g. of a logging handler or the MetricsReporter, would stay locked in the children forever);
+            # spawned workers would instead re-import the __main__ script, whose module level truncates its log file
+            if threading.active_count() > 1:
+                raise RuntimeError(f"SentenceSplitter with worker processes must be created before any other thread is started, "
+                                   f"running threads: {[thread.name for thread in threading.enumerate()]}")
+            self._pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork"))
+            self._pool.submit(int).result()
+
+        logging.info(f"Sentence splitter with cache {cache_path} and {processes or 0} worker processes")
+
+    def split(self, text, max_words=600):
+        """Splits text into sentences of at most max_words words, like safe_sentence_split."""
+        return split_long_sentences(self.naive_sentences(text), max_words)
+
+    def naive_sentences(self, text):
+        """The NLTK sentences of text, from the cache if possible."""
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        sentences = self._load(key)
+        if sentences is not None:
+            with self._lock:
+                self.hits += 1
+            return sentences
+
+        with self._lock:
+            self.misses += 1
+        if self._pool is None:
+            sentences = nltk.tokenize.sent_tokenize(text)
+        else:
+            sentences = self._split_in_pool(text)
+        self._store(key, sentences)
+        return sentences
+
+    def _split_in_pool(self, text):
+        cuts = self._chunk_cuts(text)
+        if len(cuts) == 2:
+            return self._pool.submit(_sentences, text).result()
+
+        futures = {start: self._submit_chunk(text, start, end) for start, end in zip(cuts, cuts[1:])}
+
+        sentences = []
+        k = 0
+        while k < len(cuts) - 1:
+            start, end = cuts[k], cuts[k + 1]
+            chunk_end = min(len(text), end + OVERLAP_CHARS)
+            spans = [(s, e) for s, e in futures.pop(start).result() if start <= s < end]
+
+            if spans and spans[-1][1] > chunk_end - TRUSTED_MARGIN_CHARS and chunk_end < len(text):
+                # the last sentence runs into the overlap and may be cut off there, split this chunk and the next one together
+                logging.debug(f"Sentence at {spans[-1][0]} crosses the chunk boundary at {end}, merging chunks.")
+                futures.pop(end).cancel()
+                del cuts[k + 1]
+                futures[start] = self._submit_chunk(text, start, cuts[k + 1])
+                continue
+
+            sentences.extend(text[s:e] for s, e in spans)
+            k += 1
+        return sentences
+
+    def _submit_chunk(self, text, start, end):
+        chunk_start, chunk_end = max(0, start - OVERLAP_CHARS), min(len(text), end + OVERLAP_CHARS)
+        return self._pool.submit(_sentence_spans, text[chunk_start:chunk_end], chunk_start)
+
+    @staticmethod
+    def _chunk_cuts(text):
+        """Chunk boundaries [0, ..., len(text)], each at a paragraph break (or any whitespace) after a multiple of CHUNK_CHARS."""
+        cuts = [0]
+        while len(text) - cuts[-1] > 2 * CHUNK_CHARS:
+            target = cuts[-1] + CHUNK_CHARS
+            cut = text.find("\n", target, target + CHUNK_CHARS // 2)
+            if cut == -1:
+                cut = text.find(" ", target, target + CHUNK_CHARS // 2)
+            if cut == -1:
+                break
+            cuts.append(cut)
+        cuts.append(len(text))
+        return cuts
+
+    def _load(self, key):
+        if not self.cache_path:
+            return None
+        try:
+            with open(os.path.join(self.cache_path, f"{key}.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable sentence cache entry {key}: {e}")
+            return None
+
+    def _store(self, key, sentences):
+        if not self.cache_path:
+            return
+        path = os.path.join(self.cache_path, f"{key}.json")
+        tmp_path = f"{hidden_tmp_path(path)}.{threading.get_ident()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(sentences, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "processes": self.processes or 0}
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
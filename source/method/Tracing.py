@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+import weakref
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+# ids (doc_id, question_id, page, ...) of the enclosing spans, attached to every span opened inside them
+_trace_args = contextvars.ContextVar("trace_args", default={})
+
+
+class Tracer:
+    def __init__(self, path):
+        """
+        Span tracer writing the Chrome trace event format (JSON array), viewable in https://ui.perfetto.dev or chrome://tracing.
+        Every span is a complete ("X") event on the track of the thread it ran in; coroutines get a track per asyncio task,
+        so concurrent questions of the async runners do not overlap on the event loop's thread. Spans carry the ids of
+        their enclosing spans (e.g. doc_id and question_id), set with span(..., doc_id=...) or traced_task.
+
+        Events are streamed to the file as they end, so the trace of an interrupted run can still be opened
+        (both viewers accept the array without its closing bracket). One instance can be shared by all threads.
+
+        Args:
+            path (str): The trace file, e.g. experiments/traces/run.json.
+        """
+        self.path = path
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.events = 0
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8", buffering=1 << 20)
+        self._file.write("[")
+        self._tracks = set()
+        self._task_tracks = weakref.WeakKeyDictionary()
+        self._next_task_track = 1
+        self._write({"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": "ReadAgent"}})
+
+    def _write(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(("\n" if self.events == 0 else ",\n") + line)
+            self.events += 1
+
+    def _track(self):
+        """Track id of the caller: its asyncio task inside an event loop, its thread otherwise. Named on first use."""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+
+        thread = threading.current_thread()
+        # worker threads and the event loop name their tracks concurrently, the lookups and inserts are locked
+        # so every track id is given and named once, _write takes the lock itself
+        with self._lock:
+            if task is None:
+                tid, name = threading.get_ident(), thread.name
+            else:
+                tid = self._task_tracks.get(task)
+                if tid is None:
+                    tid = self._task_tracks[task] = self._next_task_track
+                    self._next_task_track += 1
+                name = f"{thread.name} {task.get_name()}"
+            first_use = tid not in self._tracks
+            self._tracks.add(tid)
+
+        if first_use:
+            self._write({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}})
+        return tid
+
+    def add_span(self, name, category, start, duration, **args):
+        """
+        Records a span that started at start (time.perf_counter() seconds) and lasted duration seconds, e.g. a wait
+        measured elsewhere. Enclosing ids and args are attached, args with the value None are left out.
+        """
+        args = {key: value for key, value in {**_trace_args.get(), **args}.items() if value is not None}
+        self._write({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - self.origin) * 1e6, 1),
+            "dur": round(duration * 1e6, 1),
+            "pid": self.pid,
+            "tid": self._track(),
+            "args": args,
+        })
+
+    @contextmanager
+    def span(self, name, category="", **args):
+        """
+        Records the enclosed block as a span. Args that identify work (doc_id, question_id, page) are also attached to
+        every span opened inside the block, in this thread or task. Exceptions are recorded as the error arg.
+        """
+        ids = _ids(args)
+        token = _trace_args.set({**_trace_args.get(), **ids}) if ids else None
+        error = None
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            if token is not None:
+                _trace_args.reset(token)
+            self.add_span(name, category, start, duration, error=error, **args)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        """Closes the JSON array and the file, once."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write("\n]\n")
+            self._file.close()
+            self._file = None
+        logging.info(f"Wrote {self.events} trace events to {self.path}")
+
+
+_tracer = None
+
+def configure_tracing(path=None):
+    """
+    Installs the process-wide tracer used by the RA and QA models, the ReadAgent stages and the scripts, or removes it
+    if path is None. A previously installed tracer is closed first.
+    """
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = Tracer(path) if path else None
+    if _tracer is not None:
+        logging.info(f"Tracing to {path}")
+    return _tracer
+
+def get_tracer():
+    return _tracer
+
+def trace_span(name, category="", **args):
+    """tracer.span of the installed tracer, or a no-op context manager without one."""
+    tracer = _tracer
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, category, **args)
+
+def traced_task(function, name=None, **args):
+    """
+    Wraps function for executor.submit: the time the task waits in the executor queue is recorded as a "queued" span,
+    and with a name, the call itself as a span of that name. The enclosing ids of the submitting thread and args
+    (e.g. doc_id) are attached to both and to all spans inside the call. Returns function unchanged without a tracer.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return function
+    submitted = time.perf_counter()
+    enclosing = _trace_args.get()
+
+    @wraps(function)
+    def run(*function_args, **function_kwargs):
+        token = _trace_args.set({**enclosing, **_ids(args)})
+        try:
+            tracer.add_span("queued", "executor", submitted, time.perf_counter() - submitted, **args)
+            if name is None:
+                return function(*function_args, **function_kwargs)
+            with tracer.span(name, "task", **args):
+                return function(*function_args, **function_kwargs)
+        finally:
+            _trace_args.reset(token)
+    return run
+
+
+def _ids(args):
+    """The args that identify the work of a span and are passed on to the spans inside it."""
+    return {key: value for key, value in args.items() if value is not None and (key.endswith("_id") or key == "page")}
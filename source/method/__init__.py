@@ -1,3 +1,13 @@
 from .ReadAgent import ReadAgent
-from .QAModels import (BaseQAModel, OpenAI_QAModel_MultipleChoice, OpenAI_QAModel_Generation)
-from .RAModels import (OpenAI_RAModel_Pagination, OpenAI_RAModel_Gisting, OpenAI_RAModel_Lookup)
\ No newline at end of file
+from .AsyncReadAgent import AsyncReadAgent
+from .GistMemory import GistMemory
+from .CompactPages import CompactPages
+from .PageStore import (PageStore, LazyPages)
+from .LexicalIndex import BM25Index
+from .QAModels import (BaseQAModel, OpenAI_QAModel_MultipleChoice, OpenAI_QAModel_Generation, AsyncOpenAI_QAModel_MultipleChoice, AsyncOpenAI_QAModel_Generation)
+from .RAModels import (OpenAI_RAModel_Pagination, TextTiling_RAModel_Pagination, OpenAI_RAModel_Gisting, OpenAI_RAModel_Lookup, BM25_RAModel_Lookup, Hybrid_RAModel_Lookup, AsyncOpenAI_RAModel_Pagination, AsyncOpenAI_RAModel_Gisting, AsyncOpenAI_RAModel_Lookup, AsyncBM25_RAModel_Lookup, AsyncHybrid_RAModel_Lookup)
+from .ResponseCache import ResponseCache
+from .SentenceSplitter import SentenceSplitter
+from .RateLimiter import (RateLimiter, configure_rate_limiter, get_rate_limiter)
+from .RetryPolicy import (PERMANENT_ERRORS, is_retryable_error, is_permanent_error, model_retry)
+from .Metrics import (Metrics, configure_metrics, get_metrics)
\ No newline at end of file
@@ -1,13 +1,38 @@
 import json
 import logging
 import os
+import re
 import nltk
+import tiktoken
+import numpy as np
 
 
 def count_words(text):
     """Simple word counting."""
     return len(text.split())
 
+_tokenizer = None
+
+def count_tokens(text):
+    """Number of cl100k_base tokens of text, for token counts the API did not report."""
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = tiktoken.get_encoding("cl100k_base")
+    return len(_tokenizer.encode(text))
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself him
+himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only or other
+our ours ourselves out over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which while who whom why will
+with would you your yours yourself yourselves
+""".split())
+
+def tokenize_words(text):
+    """Lowercased word tokens without stopwords, used by the local (non-LLM) models."""
+    return [token for token in re.findall(r"[a-z0-9]+(?:'[a-z]+)?", text.lower()) if token not in STOPWORDS]
+
 def parse_pause_point(text):
     text = text.strip("Break point: ")
     if text[0] != '<':
@@ -33,6 +58,11 @@ def buildMultipleChoiceQuestionTextWithoutNumbers(questionString, options):
     return f'{questionString} \nOptions: \n{choicesString}'
 
 
+def hidden_tmp_path(path):
+    """Temporary file next to path for atomic writes (write, then os.replace); hidden, so folder listings skip it."""
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f".{name}.tmp")
+
 def save_pages_to_json(pages, file_path):
     """
     Saves the pages (list of lists of sentences) as a JSON file.
@@ -40,8 +70,11 @@ def save_pages_to_json(pages, file_path):
     :param file_path: str - The output JSON file path.
     """
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
+        # written to a temporary file first, so an interrupted run never leaves a truncated pages file behind
+        tmp_path = hidden_tmp_path(file_path)
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(pages, f, indent=4, ensure_ascii=False)  # Pretty-print for readability
+        os.replace(tmp_path, file_path)
         logging.info(f"Successfully saved {len(pages)} pages to {file_path}")
     except Exception as e:
         logging.error(f"Error saving pages: {e}")
@@ -86,8 +119,10 @@ def save_shortened_pages_to_json(shortened_pages, path):
         raise ValueError("There are no shortened pages to store.")
 
     try:
-        with open(path, "w", encoding="utf-8") as file:
+        tmp_path = hidden_tmp_path(path)
+        with open(tmp_path, "w", encoding="utf-8") as file:
             json.dump(shortened_pages, file, indent=4, ensure_ascii=False)  # Pretty JSON format
+        os.replace(tmp_path, path)
         logging.info(f"Successfully saved shortened pages to {path}")
     except Exception as e:
         logging.error(f"Error saving shortened pages: {e}")
@@ -128,8 +163,92 @@ def load_shortened_pages_from_json(path):
         logging.error(f"Failed to load shortened pages from {path}: {e}")
         return None
 
+def token_counts_path(shortened_pages_path):
+    """
+    Sidecar of a shortened pages file with the token counts of its pages and gists, e.g. .doc1.tokens.json next to
+    doc1.json. Hidden, so folder listings of the shortened pages skip it.
+    """
+    folder, name = os.path.split(shortened_pages_path)
+    return os.path.join(folder, f".{os.path.splitext(name)[0]}.tokens.json")
+
+def save_token_counts(token_counts, path):
+    """
+    Writes the token counts of a document atomically, like save_pagination_checkpoint.
+    :param token_counts: dict - {"gists_sha256": str, "pages": List[int], "gists": List[int]}.
+    :param path: str - File path, see token_counts_path.
+    """
+    tmp_path = hidden_tmp_path(path)
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(token_counts, file)
+    os.replace(tmp_path, path)
+
+def load_token_counts(path):
+    """
+    Loads token counts written by save_token_counts.
+    :return: dict or None if there are no (readable) counts, e.g. for artifacts precreated before they were saved.
+    """
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.warning(f"Ignoring unreadable token counts {path}: {e}")
+        return None
+
+def save_pagination_checkpoint(checkpoint, path):
+    """
+    Writes the pagination state of a document atomically: the JSON goes to a temporary file which then
+    replaces the checkpoint, so a crash while writing never leaves a truncated checkpoint behind.
+    :param checkpoint: dict - Fingerprint of the paginated text and the sentence indices where the accepted pages end.
+    :param path: str - File path of the checkpoint.
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        # created with the first checkpoint, so runs that are never interrupted leave no folder behind
+        os.makedirs(folder, exist_ok=True)
+    tmp_path = hidden_tmp_path(path)
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(checkpoint, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+def load_pagination_checkpoint(path):
+    """
+    Loads a pagination checkpoint written by save_pagination_checkpoint.
+    :return: dict or None if there is no (readable) checkpoint.
+    """
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.warning(f"Ignoring unreadable pagination checkpoint {path}: {e}")
+        return None
+
+def remove_pagination_checkpoint(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+def word_count_prefix_sums(sentences):
+    """
+    Word counts of the sentences as prefix sums: entry k is the number of words in sentences[:k].
+    :return: np.ndarray - int64 array of length len(sentences) + 1, starting with 0.
+    """
+    prefix = np.zeros(len(sentences) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((count_words(sentence) for sentence in sentences), dtype=np.int64, count=len(sentences)), out=prefix[1:])
+    return prefix
+
 def safe_sentence_split(text, max_words=600):
     naive_sentences = nltk.tokenize.sent_tokenize(text)
+    return split_long_sentences(naive_sentences, max_words)
+
+def split_long_sentences(naive_sentences, max_words=600):
+    """Cuts sentences of more than max_words words into chunks of max_words words."""
     final_sentences = []
     
     for sent in naive_sentences: